@@ -0,0 +1,143 @@
+""" augment.py
+batched data augmentation on the device, applied to whole [N, C, H, W] batches in [-1, 1] after
+get_batch() (instead of per image in the loader workers).
+
+ops (--augment, '+' separated; per image size with --augment_table, e.g. '4:none,64:xflip,256:xflip+rotate'):
+  + xflip:   horizontal flip.
+  + rotate:  rotation by up to --augment_rotate degrees (bilinear, reflection padding).
+  + color:   brightness, contrast and saturation (each drawn separately, scaled by --augment_color).
+every op is applied to every image with probability p, with its own random parameters. the
+parameters of iteration t are drawn on the cpu from a generator seeded by (seed, t, call), so a
+resumed run augments exactly like an uninterrupted one.
+all ops are differentiable: D sees augmented reals and augmented fakes (also in the G step), so
+the augmentations do not leak into the generated images (as in ADA, Karras et al. 2020).
+
+adaptive p (--ada_target > 0): every --ada_interval iterations
+    r = mean(sign(D(real) - 0.5))        (0.5: midway between the real / fake labels of the loss)
+is compared with the target, and p moves by batchsize * interval / (--ada_kimg * 1000) towards
+more augmentation when D is overconfident on reals (r > target), less otherwise.
+"""
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+from .dataloader import mix64
+
+
+OPS = ['xflip', 'rotate', 'color']
+
+
+def augment_table(default='', spec=''):
+    # {imsize: [ops]} for 4 .. 1024: default ops, with per-size overrides ('none': no augmentation).
+    parse = lambda s: [op for op in s.split('+') if op.strip() and op != 'none']
+    table = {int(pow(2, r)): parse(default) for r in range(2, 11)}
+    for item in spec.split(','):
+        if item.strip():
+            imsize, ops = item.split(':')
+            table[int(imsize)] = parse(ops)
+    for ops in table.values():
+        for op in ops:
+            if op not in OPS:
+                raise ValueError('unknown augmentation {} (expected one of {}).'.format(op, ', '.join(OPS)))
+    return table
+
+
+class batch_augment:
+    def __init__(self, table, p=0.0, rotate=10.0, color=0.2, seed=0, ada_target=0.0, ada_interval=4, ada_kimg=100):
+        self.table = table
+        self.p = p
+        self.rotate = rotate
+        self.color = color
+        self.seed = seed
+        self.ada_target = ada_target
+        self.ada_interval = ada_interval
+        self.ada_kimg = ada_kimg
+        self.calls = 0              # calls in the current iteration.
+        self.step = -1
+        self.signs = []             # mean(sign(D(real) - 0.5)) per iteration since the last adjustment.
+        self.rt = None
+
+    def active(self, imsize):
+        return self.p > 0 and len(self.table.get(imsize, [])) > 0
+
+    def generator(self, step):
+        # cpu generator for call #k of iteration `step`.
+        if step != self.step:
+            self.step, self.calls = step, 0
+        self.calls = self.calls + 1
+        key = np.array([(step << 8) + self.calls], dtype=np.uint64)
+        return torch.Generator().manual_seed(int(mix64(key, self.seed & 0xffffffffffffffff)[0]) >> 1)
+
+    def __call__(self, x, step):
+        ''' x: [N, C, H, W] in [-1, 1]; returns the augmented batch (x itself if inactive). '''
+        ops = self.table.get(x.size(-1), [])
+        if self.p <= 0 or len(ops) == 0:
+            return x
+        g = self.generator(step)
+        N = x.size(0)
+        mask = lambda: torch.rand(N, generator=g) < self.p
+        if 'xflip' in ops:
+            idx = mask().nonzero().squeeze(1).to(x.device)
+            if len(idx) > 0:
+                x = x.index_copy(0, idx, x.index_select(0, idx).flip(3))
+        if 'rotate' in ops:
+            m = mask()
+            angle = (torch.rand(N, generator=g) * 2 - 1) * math.radians(self.rotate)
+            idx = m.nonzero().squeeze(1)
+            if len(idx) > 0:
+                a = angle[idx]
+                theta = torch.zeros(len(idx), 2, 3)
+                theta[:, 0, 0], theta[:, 0, 1] = a.cos(), -a.sin()
+                theta[:, 1, 0], theta[:, 1, 1] = a.sin(), a.cos()
+                theta, idx = theta.to(x.device, x.dtype), idx.to(x.device)
+                grid = F.affine_grid(theta, [len(idx)] + list(x.shape[1:]), align_corners=False)
+                y = F.grid_sample(x.index_select(0, idx), grid, mode='bilinear', padding_mode='reflection', align_corners=False)
+                x = x.index_copy(0, idx, y)
+        if 'color' in ops:
+            # brightness (shift), contrast (scale around the image mean) and saturation (scale around
+            # the luma) are all affine in the colors: one [C, C] matrix and offset per image, one pass.
+            s, C = self.color, x.size(1)
+            b = torch.randn(N, generator=g) * s * mask()
+            c = torch.exp(torch.randn(N, generator=g) * s * mask())
+            v = torch.exp(torch.randn(N, generator=g) * 2 * s * mask())
+            eye = torch.eye(C).expand(N, C, C)
+            sat = eye
+            if C == 3:
+                luma = torch.tensor([0.299, 0.587, 0.114]).expand(N, 1, 3)
+                sat = v.view(N, 1, 1) * eye + (1 - v).view(N, 1, 1) * torch.ones(N, 3, 1) @ luma
+            sat, b, c = sat.to(x.device, x.dtype), b.to(x.device, x.dtype), c.to(x.device, x.dtype)
+            A = sat * c.view(N, 1, 1)
+            mean = x.mean(dim=(1, 2, 3))
+            offset = sat.sum(dim=2) * ((1 - c) * mean + b).view(N, 1)      # sat @ (((1 - c) * mean + b) * ones)
+            # images without color changes get A = I, offset = 0 and come out bit-exact.
+            x = torch.baddbmm(offset.unsqueeze(2), A, x.reshape(N, C, -1)).view_as(x)
+        return x
+
+    def update(self, fx, batchsize):
+        '''
+        call with D's outputs on the real batch every iteration; adjusts p every ada_interval calls.
+        returns the latest r (None before the first adjustment).
+        '''
+        if self.ada_target <= 0:
+            return self.rt
+        self.signs.append(torch.sign(fx.detach().float() - 0.5).mean())
+        if len(self.signs) >= self.ada_interval:
+            self.rt = torch.stack(self.signs).mean().item()     # one host sync per interval.
+            adjust = np.sign(self.rt - self.ada_target) * batchsize * len(self.signs) / (self.ada_kimg * 1000.0)
+            self.p = float(min(1.0, max(0.0, self.p + adjust)))
+            self.signs = []
+        return self.rt
+
+    def state_dict(self):
+        return {'p': self.p, 'signs': [float(v) for v in self.signs]}
+
+    def load_state_dict(self, state):
+        self.p = state['p']
+        self.signs = [torch.tensor(v) for v in state.get('signs', [])]
+
+
+def get_augment(config):
+    # batch_augment configured from the augment_* / ada_* options in config.py.
+    return batch_augment(augment_table(config.augment, config.augment_table), p=config.augment_p,
+                         rotate=config.augment_rotate, color=config.augment_color, seed=config.random_seed,
+                         ada_target=config.ada_target, ada_interval=config.ada_interval, ada_kimg=config.ada_kimg)
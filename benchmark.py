@@ -0,0 +1,476 @@
+""" benchmark.py
+micro-benchmarks for the data and model paths.
+usage: python -m rgen.benchmark <name> [options]
+"""
+import argparse
+import time
+
+
+def print_table(header, rows):
+    widths = [max(len(str(x)) for x in col) for col in zip(header, *rows)]
+    fmt = '  '.join('{:>%d}' % w for w in widths)
+    print(fmt.format(*header))
+    for row in rows:
+        print(fmt.format(*row))
+
+
+def bench_decode(args):
+    ''' per-resolution decode throughput: full decode vs. reduced-size (draft) decode. '''
+    from PIL import Image
+    from .dataloader import image_folder, draft_loader, full_loader
+
+    paths = [p for p, _ in image_folder(root=args.root).samples][:args.n_images]
+    rows = []
+    for resl in range(2, args.max_resl + 1):
+        imsize = int(pow(2, resl))
+        rates = []
+        for loader in [full_loader, draft_loader(imsize)]:
+            start = time.time()
+            for path in paths:
+                loader(path).resize((imsize, imsize), Image.NEAREST)
+            rates.append(len(paths) / (time.time() - start))
+        rows.append([imsize, '{:.1f}'.format(rates[0]), '{:.1f}'.format(rates[1]), '{:.2f}x'.format(rates[1] / rates[0])])
+    print_table(['imsize', 'full img/s', 'draft img/s', 'speedup'], rows)
+
+
+def bench_build(args):
+    ''' resume/inference startup: grow/flush replay vs. direct construction, both followed by load_state_dict. '''
+    import io
+    import contextlib
+    from . import network as net
+    from .config import config
+
+    rows = []
+    for resl in range(args.min_resl, args.max_resl + 1):
+        times = {}
+        for Net in [net.Generator, net.Discriminator]:
+            state_dict = Net(config, resl=resl, init=False).state_dict()
+            start = time.time()
+            with contextlib.redirect_stdout(io.StringIO()):
+                model = Net(config)
+                for r in range(3, resl + 1):
+                    model.flush_network()
+                    model.grow_network(r)
+                model.flush_network()
+            try:
+                model.load_state_dict(state_dict)
+                times[Net.__name__, 'replay'] = time.time() - start
+            except RuntimeError:
+                times[Net.__name__, 'replay'] = None         # grow_network() stops at resl 9.
+            start = time.time()
+            model = Net(config, resl=resl, init=False)
+            model.load_state_dict(state_dict)
+            times[Net.__name__, 'direct'] = time.time() - start
+        row = [int(pow(2, resl))]
+        for name in ['Generator', 'Discriminator']:
+            replay, direct = times[name, 'replay'], times[name, 'direct']
+            row += ['n/a' if replay is None else '{:.2f}s'.format(replay), '{:.2f}s'.format(direct),
+                    'n/a' if replay is None else '{:.1f}x'.format(replay / direct)]
+        rows.append(row)
+    print_table(['imsize', 'G replay', 'G direct', 'G speedup', 'D replay', 'D direct', 'D speedup'], rows)
+
+
+def mbstd_reference(layer, x):
+    # straightforward per-sample version of minibatch_std_concat_layer, used to check the fused one.
+    import torch
+    N, C, H, W = x.size()
+    std = lambda t: torch.sqrt(t.var(0, unbiased=False) + 1e-8)
+    mode = layer.averaging
+    if mode == 'all':       maps = [std(x).mean(0, keepdim=True)] * N
+    elif mode == 'flat':    maps = [torch.sqrt(x.var(unbiased=False) + 1e-8).expand(1, H, W)] * N
+    elif mode == 'spatial': maps = [std(x).mean((1, 2), keepdim=True).expand(C, H, W)] * N
+    elif mode == 'none':    maps = [std(x)] * N
+    elif mode == 'gpool':   maps = [x.mean((0, 2, 3)).view(C, 1, 1).expand(C, H, W)] * N
+    else:
+        F, M = layer.num_new_features, N // layer.group_size(N)
+        maps = [std(x[i % M::M]).view(F, -1, H, W).mean((1, 2, 3)).view(F, 1, 1).expand(F, H, W) for i in range(N)]
+    return torch.cat([x, torch.stack(maps)], 1)
+
+
+def bench_mbstd(args):
+    ''' minibatch_std_concat_layer: max error against the reference, and forward+backward time per mode. '''
+    import torch
+    from .custom_layers import minibatch_std_concat_layer
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    x = torch.randn(args.batch, args.channels, args.imsize, args.imsize, device=device, requires_grad=True)
+    rows = []
+    for mode in args.modes.split(','):
+        layer = minibatch_std_concat_layer(mode, num_new_features=args.num_new_features)
+        with torch.no_grad():
+            err = (layer(x) - mbstd_reference(layer, x)).abs().max().item()
+        for _ in range(3):
+            layer(x).sum().backward()          # warm-up.
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(args.n_iter):
+            layer(x).sum().backward()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = (time.time() - start) / args.n_iter
+        rows.append([mode, layer.out_channels(args.channels), '{:.1e}'.format(err), '{:.3f}ms'.format(elapsed * 1000),
+                     '{:.0f}'.format(args.batch / elapsed)])
+    print_table(['mode', 'channels out', 'max err', 'fwd+bwd', 'samples/s'], rows)
+
+
+def saved_bytes(fn):
+    ''' runs fn() and returns (result, bytes of all distinct storages autograd saved for backward). '''
+    import torch
+    storages = {}
+
+    def pack(t):
+        if t.device.type != 'meta':
+            storages[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn()
+    return out, sum(storages.values())
+
+
+def bench_fused(args):
+    ''' generator with and without the fused conv + leaky + pixelnorm layers: saved activations, peak memory, speed, error. '''
+    import copy
+    import torch
+    from . import network as net
+    from .config import config
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    rows = []
+    for resl in range(args.min_resl, args.max_resl + 1):
+        cfg = copy.copy(config)
+        cfg.flag_fused = False
+        G = net.Generator(cfg, resl=resl).to(device)
+        cfg.flag_fused = True
+        Gf = net.Generator(cfg, resl=resl, init=False).to(device)
+        Gf.load_state_dict(G.state_dict())
+        net.set_equalized_scales(Gf, net.get_equalized_scales(G))
+        z = torch.randn(args.batch, config.nz, device=device)
+        result = {}
+        for name, model in [('unfused', G), ('fused', Gf)]:
+            if device == 'cuda':
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+            start = time.time()
+            out, saved = saved_bytes(lambda: model(z))
+            out.square().mean().backward()
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            peak = torch.cuda.max_memory_allocated() if device == 'cuda' else None
+            grads = torch.cat([p.grad.flatten() for p in model.parameters()])
+            result[name] = (out.detach(), grads, saved, peak, time.time() - start)
+        (y, g, saved, peak, t), (yf, gf, saved_f, peak_f, t_f) = result['unfused'], result['fused']
+        rel = lambda a, b: ((a - b).abs().max() / b.abs().max()).item()
+        mb = lambda b: 'n/a' if b is None else '{:.1f}MB'.format(b / 2 ** 20)
+        rows.append([int(pow(2, resl)), mb(saved), mb(saved_f), '{:.2f}x'.format(saved / float(saved_f)), mb(peak), mb(peak_f),
+                     '{:.2f}s'.format(t), '{:.2f}s'.format(t_f), '{:.1e}'.format(rel(yf, y)), '{:.1e}'.format(rel(gf, g))])
+    print_table(['imsize', 'saved', 'saved fused', 'saving', 'peak', 'peak fused', 'fwd+bwd', 'fused', 'out err', 'grad err'], rows)
+
+
+def bench_fadein(args):
+    ''' train step time per transition stage with and without skipping the zero-weight fade-in branch. '''
+    import torch
+    from . import network as net
+    from .config import config
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    # stage: (G fade-in alpha, D fade-in alpha); None = flushed.
+    stages = [('gtrns', 0.5, 0.0), ('gstab', 1.0, 0.0), ('dtrns', None, 0.5), ('dstab', None, 1.0)]
+    rows = []
+    for resl in range(args.min_resl, args.max_resl + 1):
+        imsize = int(pow(2, resl))
+        for phase, g_alpha, d_alpha in stages:
+            G = net.Generator(config, resl=resl, fadein=g_alpha is not None).to(device)
+            D = net.Discriminator(config, resl=resl, fadein=True).to(device)
+            nets = [(G, g_alpha), (D, d_alpha)]
+            for m, alpha in nets:
+                if alpha is not None:
+                    m.model.fadein_block.alpha = alpha
+            z = torch.randn(args.batch, config.nz, device=device)
+            x = torch.randn(args.batch, config.nc, imsize, imsize, device=device)
+
+            def step():
+                G.zero_grad()
+                D.zero_grad()
+                fake = G(z)
+                loss = (D(x) - 1).pow(2).mean() + D(fake.detach()).pow(2).mean() + (D(fake) - 1).pow(2).mean()
+                loss.backward()
+                return loss.item()
+
+            times, losses = [], []
+            for skip in [False, True]:
+                for m, alpha in nets:
+                    if alpha is not None:
+                        m.model.concat_block.bind(m.model.fadein_block if skip else None)
+                losses.append(step())            # warm-up (and the loss for the comparison).
+                if device == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.time()
+                for _ in range(args.n_iter):
+                    step()
+                if device == 'cuda':
+                    torch.cuda.synchronize()
+                times.append((time.time() - start) / args.n_iter)
+            rows.append([imsize, phase, '{:.1f}'.format(1000 * times[0]), '{:.1f}'.format(1000 * times[1]),
+                         '{:.2f}x'.format(times[0] / times[1]), '{:.1e}'.format(abs(losses[0] - losses[1]))])
+    print_table(['imsize', 'phase', 'both ms', 'skip ms', 'speedup', 'loss diff'], rows)
+
+
+def bench_project(args):
+    ''' latent projection throughput (targets/min) and quality per (slots, restarts), on targets G generated itself. '''
+    import torch
+    from . import network as net
+    from .config import config
+    from .project import projector, psnr
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    G = net.Generator(config, resl=args.resl).to(device).eval()
+    for p in G.parameters():
+        p.requires_grad_(False)
+    with torch.no_grad():
+        x = G(torch.randn(args.n_targets, config.nz, generator=torch.Generator().manual_seed(1)).to(device))
+    rows = []
+    for spec in args.configs.split(','):
+        slots, restarts = [int(v) for v in spec.split('x')]
+        engine = projector(G, config.nz, slots, restarts, max_steps=args.max_steps, patience=args.patience)
+        start = time.time()
+        results = list(engine.run((i, i, x[i]) for i in range(args.n_targets)))
+        elapsed = time.time() - start
+        rows.append([slots, restarts, '{:.1f}'.format(60 * len(results) / elapsed), '{:.1f}'.format(sum(r['steps'] for r in results) / float(len(results))),
+                     '{:.2f}'.format(sum(psnr(r['pixel']) for r in results) / len(results))])
+    print_table(['slots', 'restarts', 'targets/min', 'steps/target', 'psnr dB'], rows)
+
+
+def bench_nearest(args):
+    ''' nearest-neighbor search throughput: brute force over full-resolution images vs. the compact float16 index. '''
+    import os
+    import json
+    import tempfile
+    import numpy as np
+    import torch
+    import torch.nn.functional as F
+    from .nearest import nn_index
+
+    g = torch.Generator().manual_seed(0)
+    imsize = int(pow(2, args.resl))
+    train = torch.rand(args.n_train, 3, imsize, imsize, generator=g).mul_(2).sub_(1)
+    queries = torch.rand(args.n_queries, 3, imsize, imsize, generator=g).mul_(2).sub_(1)
+    rows = []
+
+    # brute force: full-resolution float32 pixels through the same batched search.
+    flat = train.flatten(1)
+    with tempfile.TemporaryDirectory() as path:
+        np.save(os.path.join(path, 'codes.npy'), flat.numpy())
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'paths': []}, f)
+        index = nn_index(path)
+        start = time.time()
+        for i in range(0, len(queries), args.batch):
+            index.search(queries[i:i + args.batch].flatten(1), args.k, args.chunk)
+        elapsed = time.time() - start
+    rows.append(['brute', flat.size(1), '{:.1f}'.format(flat.numel() * 4 / 2 ** 20), '{:.0f}'.format(len(queries) / elapsed)])
+
+    for spec in args.configs.split(','):
+        kind = spec.rstrip('0123456789')
+        dims = int(spec[len(kind):])
+        if kind == 'pixel':
+            embed = lambda x: F.adaptive_avg_pool2d(x, dims).flatten(1)
+        else:
+            proj = torch.randn(flat.size(1), dims, generator=g)     # same cost as a fitted PCA projection.
+            embed = lambda x: x.flatten(1) @ proj
+        with tempfile.TemporaryDirectory() as path:
+            codes = torch.cat([embed(train[i:i + 256]) for i in range(0, len(train), 256)]).half().numpy()
+            np.save(os.path.join(path, 'codes.npy'), codes)
+            with open(os.path.join(path, 'meta.json'), 'w') as f:
+                json.dump({'paths': []}, f)
+            index = nn_index(path)
+            start = time.time()
+            for i in range(0, len(queries), args.batch):
+                index.search(embed(queries[i:i + args.batch]), args.k, args.chunk)
+            elapsed = time.time() - start
+        rows.append([spec, codes.shape[1], '{:.1f}'.format(codes.nbytes / 2 ** 20), '{:.0f}'.format(len(queries) / elapsed)])
+    print_table(['index', 'dims', 'MB', 'queries/s'], rows)
+
+
+def bench_augment(args):
+    ''' cost per batch of xflip + rotate + color: PIL per image (as in loader workers) vs. batched tensors. '''
+    import random
+    import numpy as np
+    import torch
+    from PIL import Image, ImageEnhance
+    from .augment import batch_augment, augment_table
+
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+    rows = []
+    for resl in range(args.min_resl, args.max_resl + 1):
+        imsize = int(pow(2, resl))
+        x = torch.randint(0, 256, (args.batch, 3, imsize, imsize), dtype=torch.uint8, generator=torch.Generator().manual_seed(0))
+        images = [Image.fromarray(img) for img in x.permute(0, 2, 3, 1).numpy()]
+        rng = random.Random(0)
+
+        def pil(img):
+            if rng.random() < args.p:
+                img = img.transpose(Image.FLIP_LEFT_RIGHT)
+            if rng.random() < args.p:
+                img = img.rotate(rng.uniform(-10, 10), resample=Image.BILINEAR)
+            for enhance in (ImageEnhance.Brightness, ImageEnhance.Contrast, ImageEnhance.Color):
+                if rng.random() < args.p:
+                    img = enhance(img).enhance(float(np.exp(rng.gauss(0, 0.2))))
+            return np.asarray(img)
+        start = time.time()
+        for _ in range(args.n_iter):
+            [pil(img) for img in images]
+        times = [(time.time() - start) / args.n_iter]
+
+        for device in devices:
+            aug = batch_augment(augment_table('xflip+rotate+color'), p=args.p)
+            xd = x.to(device).float().mul_(2.0 / 255.0).sub_(1.0)
+            aug(xd, 0)
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            start = time.time()
+            for i in range(args.n_iter):
+                aug(xd, i + 1)
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            times.append((time.time() - start) / args.n_iter)
+        row = [imsize, args.batch] + ['{:.2f}'.format(1000 * t) for t in times] + ['{:.1f}x'.format(times[0] / times[1])]
+        rows.append(row)
+    print_table(['imsize', 'batch', 'PIL ms'] + ['{} ms'.format(d) for d in devices] + ['PIL / cpu'], rows)
+
+
+# import-time budget per entry module, in ms on top of `import torch` (measured by `imports`).
+# tools must also start without pulling in any training-only module.
+STARTUP_BUDGET = {
+    'config': 20,
+    'checkpoint': 50,
+    'network': 100,
+    'utils': 50,
+    'dataloader': 200,
+    'trainer': 300,
+}
+TOOLS = ['config', 'checkpoint', 'network', 'utils']
+TRAINING_ONLY = ['dataloader', 'trainer', 'tf_recorder', 'tensorboardX', 'torchvision.datasets', 'matplotlib', 'scipy']
+
+
+def import_profile(module):
+    '''
+    runs `python -X importtime` in a fresh interpreter that has already imported torch, and
+    returns {module: (self_us, cumulative_us)} for everything the entry module adds on top.
+    '''
+    import sys
+    import subprocess
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import torch; import {}'.format(module)],
+                         capture_output=True, text=True, check=True).stderr
+    profile = {}
+    for line in out.splitlines():
+        parts = line[len('import time:'):].split('|')
+        if not line.startswith('import time:') or not parts[0].strip().isdigit():
+            continue
+        name = parts[2].strip()
+        if name == 'torch':
+            profile = {}            # everything so far came in with torch.
+        else:
+            profile[name] = (int(parts[0]), int(parts[1]))
+    return profile
+
+
+def bench_imports(args):
+    ''' per-module import cost of each entry point on top of torch, checked against STARTUP_BUDGET. '''
+    package = __package__ or 'rgen'
+    rows = []
+    failed = False
+    for name in STARTUP_BUDGET:
+        module = '{}.{}'.format(package, name)
+        profile = import_profile(module)
+        total = sum(cumulative for m, (_, cumulative) in profile.items() if m == module or m == package)
+        heavy = sorted(((cumulative, m) for m, (_, cumulative) in profile.items() if '.' not in m and m != package), reverse=True)
+        leaks = []
+        if name in TOOLS:
+            leaks = [m for m in TRAINING_ONLY if m in profile or '{}.{}'.format(package, m) in profile]
+        ok = total / 1000.0 <= STARTUP_BUDGET[name] and not leaks
+        failed = failed or not ok
+        rows.append([name, '{:.0f}ms'.format(total / 1000.0), '{}ms'.format(STARTUP_BUDGET[name]), 'ok' if ok else 'OVER',
+                     ', '.join('{}:{:.0f}ms'.format(m, c / 1000.0) for c, m in heavy[:args.top]) or '-',
+                     ', '.join(leaks) or '-'])
+    print_table(['entry', 'import', 'budget', 'status', 'heaviest imports', 'training-only'], rows)
+    if failed:
+        raise SystemExit(1)
+
+
+BENCHMARKS = {
+    'decode': bench_decode,
+    'build': bench_build,
+    'imports': bench_imports,
+    'mbstd': bench_mbstd,
+    'fused': bench_fused,
+    'fadein': bench_fadein,
+    'project': bench_project,
+    'nearest': bench_nearest,
+    'augment': bench_augment,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('PGGAN benchmarks')
+    subparsers = parser.add_subparsers(dest='name')
+
+    p = subparsers.add_parser('decode')
+    p.add_argument('--root', type=str, required=True)       # image folder root with training images.
+    p.add_argument('--n_images', type=int, default=200)
+    p.add_argument('--max_resl', type=int, default=8)
+
+    p = subparsers.add_parser('build')
+    p.add_argument('--min_resl', type=int, default=8)
+    p.add_argument('--max_resl', type=int, default=10)
+
+    p = subparsers.add_parser('imports')
+    p.add_argument('--top', type=int, default=3)        # heaviest imports to list per entry.
+
+    p = subparsers.add_parser('mbstd')
+    p.add_argument('--batch', type=int, default=64)
+    p.add_argument('--channels', type=int, default=512)
+    p.add_argument('--imsize', type=int, default=4)        # the layer runs at 4x4 in the discriminator.
+    p.add_argument('--num_new_features', type=int, default=1)
+    p.add_argument('--modes', type=str, default='all,flat,spatial,none,gpool,group4,group64')
+    p.add_argument('--n_iter', type=int, default=50)
+
+    p = subparsers.add_parser('fused')
+    p.add_argument('--min_resl', type=int, default=5)
+    p.add_argument('--max_resl', type=int, default=8)
+    p.add_argument('--batch', type=int, default=4)
+
+    p = subparsers.add_parser('project')
+    p.add_argument('--resl', type=int, default=5)
+    p.add_argument('--n_targets', type=int, default=32)
+    p.add_argument('--configs', type=str, default='1x1,1x4,16x1,16x4')    # slots x restarts.
+    p.add_argument('--max_steps', type=int, default=200)
+    p.add_argument('--patience', type=int, default=30)
+
+    p = subparsers.add_parser('nearest')
+    p.add_argument('--resl', type=int, default=6)
+    p.add_argument('--n_train', type=int, default=20000)
+    p.add_argument('--n_queries', type=int, default=256)
+    p.add_argument('--configs', type=str, default='pixel64,pixel16,pca256')     # pixel<size>: downsampled, pca<dims>: projected.
+    p.add_argument('--k', type=int, default=5)
+    p.add_argument('--batch', type=int, default=64)
+    p.add_argument('--chunk', type=int, default=65536)
+
+    p = subparsers.add_parser('augment')
+    p.add_argument('--min_resl', type=int, default=3)
+    p.add_argument('--max_resl', type=int, default=8)
+    p.add_argument('--batch', type=int, default=16)
+    p.add_argument('--p', type=float, default=1.0)         # probability of each op.
+    p.add_argument('--n_iter', type=int, default=10)
+
+    p = subparsers.add_parser('fadein')
+    p.add_argument('--min_resl', type=int, default=3)
+    p.add_argument('--max_resl', type=int, default=6)
+    p.add_argument('--batch', type=int, default=16)
+    p.add_argument('--n_iter', type=int, default=10)
+
+    args, _ = parser.parse_known_args()
+    if args.name not in BENCHMARKS:
+        parser.print_help()
+    else:
+        BENCHMARKS[args.name](args)
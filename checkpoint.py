@@ -0,0 +1,302 @@
+""" checkpoint.py
+single-file checkpoint format.
+
+one file holds G, D, both optimizers and the scalar training state (stored once):
+    {'format', 'version', 'refs',
+     'resl', 'epoch', 'globalTick', 'globalIter', 'stack', 'learning_rate', 'phase', 'kimgs',
+     'complete': {'gen', 'dis'}, 'flush': {'gen', 'dis'}, 'data': {'seed', 'position'}, 'augment': {'p', 'signs'},
+     'gen': {'state_dict', 'scales'}, 'dis': {'state_dict', 'scales'},
+     'opt_g', 'opt_d'}
+
+files are loaded memory-mapped when torch supports it, so a tool that only needs the
+generator only pages in the generator tensors.
+with delta=True, tensors that did not change since the previous checkpoint are not written
+again; 'refs' maps them to the file (in the same directory) that holds the data.
+
+usage:
+    python -m rgen.checkpoint convert --dis dis_R5_T100_x.pth.tar --gen gen_R5_T100_x.pth.tar --out ckpt_R5_T100.pth
+    python -m rgen.checkpoint convert --dir repo/model
+    python -m rgen.checkpoint materialize --src ckpt_R5_T150.pth --out full.pth
+"""
+import os
+import re
+import glob
+import hashlib
+import argparse
+import torch
+
+
+FORMAT = 'rgen-ckpt'
+VERSION = 1
+SECTIONS = ['gen', 'dis', 'opt_g', 'opt_d']
+STATE_KEYS = ['resl', 'epoch', 'globalTick', 'globalIter', 'stack', 'learning_rate', 'phase', 'kimgs']
+
+
+def load(path):
+    # memory-mapped if possible (torch >= 2.1 and zipfile serialization).
+    try:
+        return torch.load(path, map_location='cpu', mmap=True)
+    except (TypeError, RuntimeError):
+        return torch.load(path, map_location='cpu')
+
+
+def tensor_digest(t):
+    t = t.detach().cpu().contiguous().reshape(-1)
+    h = hashlib.blake2b(digest_size=16)
+    h.update('{}{}'.format(t.dtype, t.numel()).encode())
+    h.update(t.view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+def map_tensors(obj, fn, key):
+    # rebuild a nested dict/list structure, replacing every tensor with fn('a/b/c', tensor).
+    if torch.is_tensor(obj):
+        return fn(key, obj)
+    if isinstance(obj, dict):
+        return {k: map_tensors(v, fn, '{}/{}'.format(key, k)) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(map_tensors(v, fn, '{}/{}'.format(key, i)) for i, v in enumerate(obj))
+    return obj
+
+
+def child(obj, part):
+    if isinstance(obj, dict):
+        return part if part in obj else int(part)
+    return int(part)
+
+
+def get_by_key(obj, key):
+    for part in key.split('/'):
+        obj = obj[child(obj, part)]
+    return obj
+
+
+def set_by_key(obj, key, value):
+    parts = key.split('/')
+    for part in parts[:-1]:
+        obj = obj[child(obj, part)]
+    obj[child(obj, parts[-1])] = value
+
+
+def optimizer_state_dict(optimizer, model):
+    '''
+    optimizer state keyed by parameter name instead of position.
+    after a flush the optimizer still holds the dropped low-resolution parameters, so positions
+    do not match a freshly built network; names do. dropped parameters are left out.
+    '''
+    names = {id(p): n for n, p in model.named_parameters()}
+    state = {}
+    groups = []
+    for group in optimizer.param_groups:
+        params = [p for p in group['params'] if id(p) in names]
+        for p in params:
+            if p in optimizer.state:
+                state[names[id(p)]] = optimizer.state[p]
+        groups.append(dict({k: v for k, v in group.items() if k != 'params'}, params=[names[id(p)] for p in params]))
+    return {'state': state, 'param_groups': groups}
+
+
+def load_optimizer_state_dict(optimizer, model, saved):
+    # inverse of optimizer_state_dict(). parameters without saved state start fresh.
+    names = {id(p): n for n, p in model.named_parameters()}
+    current = optimizer.state_dict()
+    state = {}
+    groups = []
+    for cur, old, group in zip(current['param_groups'], saved['param_groups'], optimizer.param_groups):
+        for index, p in zip(cur['params'], group['params']):
+            if names.get(id(p)) in saved['state']:
+                state[index] = saved['state'][names[id(p)]]
+        groups.append(dict({k: v for k, v in old.items() if k != 'params'}, params=cur['params']))
+    optimizer.load_state_dict({'state': state, 'param_groups': groups})
+
+
+def name_positional_state(opt_state, candidates):
+    '''
+    converts a positional (legacy) optimizer state_dict to the by-name layout, using the first
+    list of parameter names that has the right length. returns None if none fits.
+    '''
+    n_params = sum(len(g['params']) for g in opt_state['param_groups'])
+    for names in candidates:
+        if len(names) != n_params:
+            continue
+        state = {}
+        groups = []
+        offset = 0
+        for group in opt_state['param_groups']:
+            params = names[offset:offset + len(group['params'])]
+            for index, name in zip(group['params'], params):
+                if index in opt_state['state']:
+                    state[name] = opt_state['state'][index]
+            offset = offset + len(group['params'])
+            groups.append(dict({k: v for k, v in group.items() if k != 'params'}, params=params))
+        return {'state': state, 'param_groups': groups}
+    return None
+
+
+class checkpoint_writer:
+    '''
+    writes single-file checkpoints.
+    with delta=True it remembers a digest for every tensor it wrote, and the next save
+    stores a reference instead of the data for tensors that are bit-identical.
+    '''
+    def __init__(self, delta=False):
+        self.delta = delta
+        self.owners = {}            # key --> (digest, file holding the data)
+
+    def save(self, path, state):
+        dirname, fname = os.path.split(path)
+        refs = {}
+        owners = {}
+
+        def visit(key, t):
+            if not self.delta:
+                return t
+            digest = tensor_digest(t)
+            prev = self.owners.get(key)
+            if prev is not None and prev[0] == digest and os.path.exists(os.path.join(dirname, prev[1])):
+                refs[key] = prev[1]
+                owners[key] = prev
+                return None
+            owners[key] = (digest, fname)
+            return t
+
+        payload = {'format': FORMAT, 'version': VERSION}
+        for k, v in state.items():
+            payload[k] = map_tensors(v, visit, k) if k in SECTIONS else v
+        payload['refs'] = refs
+
+        tmp_path = path + '.tmp'
+        torch.save(payload, tmp_path)
+        os.replace(tmp_path, path)          # never leave a half-written checkpoint behind.
+        self.owners = owners
+        return len(refs)
+
+
+def load_checkpoint(path, sections=None):
+    '''
+    loads a single-file checkpoint lazily.
+    only tensors of the requested sections (default: all) have their delta references resolved.
+    '''
+    ckpt = load(path)
+    if not isinstance(ckpt, dict) or ckpt.get('format') != FORMAT:
+        raise ValueError('{} is not a single-file checkpoint. convert it with `python -m rgen.checkpoint convert`.'.format(path))
+    bases = {}
+    for key, fname in ckpt['refs'].items():
+        if sections is not None and key.split('/')[0] not in sections:
+            continue
+        if fname not in bases:
+            bases[fname] = load(os.path.join(os.path.dirname(path), fname))
+        set_by_key(ckpt, key, get_by_key(bases[fname], key))
+    return ckpt
+
+
+def load_network(path, target):
+    '''
+    returns (state_dict, scales, info) of one network ('gen' or 'dis') from either a
+    single-file checkpoint or a legacy gen_*/dis_* .pth.tar file.
+    info holds the training state plus 'fadein' (network is mid-transition) and 'complete'.
+    scales is None for legacy files.
+    '''
+    ckpt = load(path)
+    if isinstance(ckpt, dict) and ckpt.get('format') == FORMAT:
+        ckpt = load_checkpoint(path, sections=[target])
+        info = {k: ckpt[k] for k in STATE_KEYS if k in ckpt}
+        info['fadein'] = ckpt['flush'][target]
+        info['complete'] = ckpt['complete'][target]
+        return ckpt[target]['state_dict'], ckpt[target].get('scales'), info
+    info = {k: ckpt[k] for k in STATE_KEYS if k in ckpt}
+    info['fadein'] = ckpt.get('flush', False)
+    info['complete'] = ckpt.get('complete', 0.0)
+    return ckpt['state_dict'], None, info
+
+
+def load_model(path, target, config):
+    '''
+    builds the Generator ('gen') or Discriminator ('dis') stored in a checkpoint of either format,
+    directly at its resolution and fade-in state, with the fade-in alpha restored.
+    returns (model, info); see load_network() for info.
+    '''
+    from math import floor
+    from . import network as net
+
+    state_dict, scales, info = load_network(path, target)
+    Net = net.Generator if target == 'gen' else net.Discriminator
+    model = Net(config, resl=int(floor(info['resl'])), fadein=info['fadein'], init=False)
+    model.load_state_dict(state_dict)
+    if scales is not None:
+        net.set_equalized_scales(model, scales)
+    if info['fadein']:
+        model.model.fadein_block.alpha = info['complete'] / 100.0
+    return model, info
+
+
+def convert_legacy(dis_path, gen_path, out_path):
+    '''
+    merges a legacy dis_*/gen_* .pth.tar pair into one single-file checkpoint.
+    legacy optimizer states are positional; they are named against the network structure the
+    optimizer was created for (fade-in at floor(resl)), which needs the model options in config.
+    '''
+    from math import floor
+    from . import network as net
+    from .config import config
+
+    D = load(dis_path)
+    G = load(gen_path)
+    state = {k: D[k] for k in STATE_KEYS if k in D}
+    state['complete'] = {'gen': G['complete'], 'dis': D['complete']}
+    state['flush'] = {'gen': G['flush'], 'dis': D['flush']}
+    state['gen'] = {'state_dict': G['state_dict'], 'scales': None}
+    state['dis'] = {'state_dict': D['state_dict'], 'scales': None}
+    resl = int(floor(D['resl']))
+    for key, ckpt, Net in [('opt_g', G, net.Generator), ('opt_d', D, net.Discriminator)]:
+        candidates = []
+        for fadein in [resl > 2, False]:
+            model = Net(config, resl=resl, fadein=fadein, init=False)
+            candidates.append([n for n, _ in model.named_parameters()])
+        state[key] = name_positional_state(ckpt['optimizer'], candidates)
+        if state[key] is None:
+            print('[convert] {} optimizer state does not match the network, dropped.'.format(key))
+    checkpoint_writer().save(out_path, state)
+
+
+def materialize(src_path, out_path):
+    ''' rewrites a delta checkpoint with all tensors stored inline. '''
+    ckpt = load_checkpoint(src_path)
+    state = {k: v for k, v in ckpt.items() if k not in ['format', 'version', 'refs']}
+    checkpoint_writer().save(out_path, state)
+
+
+def legacy_pairs(path):
+    # (dis, gen, out) triples for every dis_R*_T*_*.pth.tar with a matching gen_ file.
+    pairs = []
+    for dis_path in sorted(glob.glob(os.path.join(path, 'dis_R*_T*.pth.tar'))):
+        dirname, fname = os.path.split(dis_path)
+        gen_path = os.path.join(dirname, 'gen_' + fname[len('dis_'):])
+        match = re.match(r'dis_R(\d+)_T(\d+)', fname)
+        if match and os.path.exists(gen_path):
+            out_path = os.path.join(dirname, 'ckpt_R{}_T{}.pth'.format(match.group(1), match.group(2)))
+            pairs.append((dis_path, gen_path, out_path))
+    return pairs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('PGGAN checkpoint tool')
+    parser.add_argument('command', choices=['convert', 'materialize'])
+    parser.add_argument('--dis', type=str, default='')      # legacy discriminator checkpoint.
+    parser.add_argument('--gen', type=str, default='')      # legacy generator checkpoint.
+    parser.add_argument('--dir', type=str, default='')      # convert every legacy pair in this directory.
+    parser.add_argument('--src', type=str, default='')
+    parser.add_argument('--out', type=str, default='')
+    args, _ = parser.parse_known_args()
+
+    if args.command == 'convert':
+        pairs = legacy_pairs(args.dir) if args.dir else [(args.dis, args.gen, args.out)]
+        for dis_path, gen_path, out_path in pairs:
+            if os.path.exists(out_path):
+                print('[skip] {} exists.'.format(out_path))
+                continue
+            convert_legacy(dis_path, gen_path, out_path)
+            print('[convert] {} + {} --> {}'.format(dis_path, gen_path, out_path))
+    else:
+        materialize(args.src, args.out)
+        print('[materialize] {} --> {}'.format(args.src, args.out))
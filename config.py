@@ -9,7 +9,12 @@ parser = argparse.ArgumentParser('PGGAN')
 parser.add_argument('--train_data_root', type=str, default='/home/sbanks/retina/rgen-pggan-pytorch')
 parser.add_argument('--random_seed', type=int, default=int(time.time()))
 parser.add_argument('--n_gpu', type=int, default=1)             # for Multi-GPU training.
-parser.add_argument('--resume_training', type=str, default='')
+parser.add_argument('--resume_training', type=str, default='')   # single-file checkpoint to resume from (see checkpoint.py).
+parser.add_argument('--ckpt_delta', type=bool, default=False)       # store only tensors that changed since the previous checkpoint.
+parser.add_argument('--flag_draft_decode', type=bool, default=True)  # decode JPEGs at reduced DCT scale for low resolutions.
+parser.add_argument('--out_dir', type=str, default='repo')          # root of model/, eval/, save/ and tensorboard/ outputs.
+parser.add_argument('--num_threads', type=int, default=0)         # torch intra-op threads. (0: default)
+parser.add_argument('--num_workers', type=int, default=4)         # dataloader worker processes.
 
 ## training parameters.
 parser.add_argument('--lr', type=float, default=0.001)          # learning rate.
@@ -24,6 +29,7 @@ parser.add_argument('--TICK', type=int, default=1000)           # 1 tick = 1000
 parser.add_argument('--max_resl', type=int, default=8)          # 10-->1024, 9-->512, 8-->256
 parser.add_argument('--trns_tick', type=int, default=200)       # transition tick
 parser.add_argument('--stab_tick', type=int, default=100)       # stabilization tick
+parser.add_argument('--batch_table', type=str, default='')      # batch size overrides per image size, e.g. '256:8,512:4'. (see schedule.py)
 
 
 ## network structure.
@@ -36,7 +42,27 @@ parser.add_argument('--flag_tanh', type=bool, default=False)        # use of tan
 parser.add_argument('--flag_sigmoid', type=bool, default=False)     # use of sigmoid at the end of the discriminator.
 parser.add_argument('--flag_add_noise', type=bool, default=True)    # add noise to the real image(x)
 parser.add_argument('--flag_norm_latent', type=bool, default=False) # pixelwise normalization of latent vector (z)
+parser.add_argument('--flag_fused', type=bool, default=False)       # fused conv + leaky relu + pixelwise norm in the generator (less memory).
 parser.add_argument('--flag_add_drift', type=bool, default=True)   # add drift loss
+parser.add_argument('--minibatch_std', type=str, default='all')    # minibatch std averaging: all, flat, spatial, none, gpool, group4 ...
+
+
+## augmentation (see augment.py).
+parser.add_argument('--augment', type=str, default='')              # '+' separated: xflip, rotate, color. ('': off)
+parser.add_argument('--augment_table', type=str, default='')        # per image size overrides, e.g. '4:none,64:xflip+color'.
+parser.add_argument('--augment_p', type=float, default=0.0)         # probability of each op per image (initial value with ada).
+parser.add_argument('--augment_rotate', type=float, default=10.0)   # max rotation in degrees.
+parser.add_argument('--augment_color', type=float, default=0.2)     # std of brightness / log-contrast / log-saturation changes.
+parser.add_argument('--ada_target', type=float, default=0.0)        # adaptive p: target of mean(sign(D(real) - 0.5)). (0: fixed p)
+parser.add_argument('--ada_interval', type=int, default=4)          # iterations between adjustments of p.
+parser.add_argument('--ada_kimg', type=int, default=100)            # kimg for p to go from 0 to 1.
+
+
+## discriminator updates (see replay.py).
+parser.add_argument('--n_critic', type=int, default=1)              # D updates per G update.
+parser.add_argument('--replay_size', type=int, default=0)           # stored fakes (float16 ring). (0: off; extra D updates then run G again)
+parser.add_argument('--replay_mix', type=float, default=0.0)        # fraction of the fakes in the main D update drawn from the pool.
+parser.add_argument('--replay_max_age', type=int, default=0)        # oldest stored fakes drawn, in iterations. (0: no limit)
 
 
 
@@ -51,7 +77,31 @@ parser.add_argument('--beta2', type=float, default=0.99)            # beta2 for
 parser.add_argument('--use_tb', type=bool, default=True)            # enable tensorboard visualization
 parser.add_argument('--save_img_every', type=int, default=20)       # save images every specified iteration.
 parser.add_argument('--display_tb_every', type=int, default=5)      # display progress every specified iteration.
+parser.add_argument('--mem_track_every', type=int, default=0)       # measure memory every specified iteration, see memory.py. (0: off)
+parser.add_argument('--mem_growth_window', type=int, default=4)     # consecutive measurements a tensor group must grow in to be flagged.
+parser.add_argument('--profile_iters', type=int, default=0)         # profile module latency for specified iterations per (resolution, phase) stage, see profiler.py. (0: off)
+parser.add_argument('--profile_warmup', type=int, default=10)       # iterations of a stage skipped before profiling it.
+
+
+## evaluation setting (see metrics.py).
+parser.add_argument('--eval_every_tick', type=int, default=0)       # evaluate G every specified tick. (0: off)
+parser.add_argument('--eval_metrics', type=str, default='swd')      # comma separated: swd, fid.
+parser.add_argument('--eval_num_images', type=int, default=2048)    # number of real / fake images per evaluation.
+parser.add_argument('--eval_batch_size', type=int, default=64)      # generator batch size during evaluation.
+parser.add_argument('--fid_model', type=str, default='')            # local feature extractor for fid (TorchScript or inception_v3 state_dict).
+parser.add_argument('--eval_cache', type=str, default='repo/eval_cache')    # cache of real-image statistics.
 
 
 ## parse and save config.
-config, _ = parser.parse_known_args()
+def get_config(argv=None):
+    # parses argv (default: sys.argv). unknown arguments are ignored so tools can add their own.
+    config, _ = parser.parse_known_args(argv)
+    return config
+
+
+# `from .config import config` parses sys.argv on first use instead of at import time.
+def __getattr__(name):
+    if name == 'config':
+        globals()['config'] = get_config()
+        return globals()['config']
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -3,24 +3,29 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 from torch.autograd import Variable
-import torch 
-import torch.nn as nn
-import torchvision.datasets as dsets
-import torchvision.transforms as transforms
-from torch.autograd import Variable
-from PIL import Image
-import copy
-from torch.nn.init import kaiming_normal, calculate_gain
+from torch.nn.init import kaiming_normal, xavier_normal, calculate_gain
+from torch.nn.utils import skip_init
 
 # same function as ConcatTable container in Torch7.
+# bound to the fadein_layer that mixes its outputs, a branch with zero weight (alpha 0: layer2,
+# alpha 1: layer1) is neither evaluated nor differentiated and its output is None.
 class ConcatTable(nn.Module):
     def __init__(self, layer1, layer2):
         super(ConcatTable, self).__init__()
         self.layer1 = layer1
         self.layer2 = layer2
-        
+        self.fadein = None
+
+    def bind(self, fadein):
+        # plain attribute, not a child module: fadein_layer is a sibling in the Sequential (state_dict keys stay the same).
+        object.__setattr__(self, 'fadein', fadein)
+
     def forward(self,x):
-        y = [self.layer1(x), self.layer2(x)]
+        if self.fadein is None or torch.jit.is_tracing():
+            # tracers record both branches, so an exported graph covers every alpha.
+            return [self.layer1(x), self.layer2(x)]
+        alpha = self.fadein.alpha
+        y = [self.layer1(x) if alpha < 1.0 else None, self.layer2(x) if alpha > 0.0 else None]
         return y
 
 class Flatten(nn.Module):
@@ -41,47 +46,84 @@ class fadein_layer(nn.Module):
         self.alpha = self.alpha + delta
         self.alpha = max(0, min(self.alpha, 1.0))
 
-    # input : [x_low, x_high] from ConcatTable()
+    # input : [x_low, x_high] from ConcatTable() (None: skipped branch)
     def forward(self, x):
+        if x[0] is None:
+            return x[1]
+        if x[1] is None:
+            return x[0]
         return torch.add(x[0].mul(1.0-self.alpha), x[1].mul(self.alpha))
 
 
 
 # https://github.com/github-pengge/PyTorch-progressive_growing_of_gans/blob/master/models/base_model.py
+# averaging modes (the statistic is concatenated to x as new feature maps):
+#   all      std over the batch, averaged over channels                  --> 1 map (per pixel)
+#   flat     std over the whole batch tensor                             --> 1 map
+#   spatial  std over the batch, averaged over pixels                    --> C maps
+#   none     std over the batch                                          --> C maps
+#   gpool    mean over the batch and pixels                              --> C maps
+#   groupN   StyleGAN: std within groups of N samples, averaged over channels
+#            (in num_new_features slices) and pixels                     --> num_new_features maps
+# all modes are plain tensor expressions (no host sync); groupN is cheap for any batch size.
 class minibatch_std_concat_layer(nn.Module):
-    def __init__(self, averaging='all'):
+    def __init__(self, averaging='all', num_new_features=1, channels=None):
         super(minibatch_std_concat_layer, self).__init__()
         self.averaging = averaging.lower()
+        self.num_new_features = num_new_features
         if 'group' in self.averaging:
             self.n = int(self.averaging[5:])
+            assert self.n >= 1 and num_new_features >= 1, 'Invalid group size or num_new_features in %s'%self.averaging
         else:
-            assert self.averaging in ['all', 'flat', 'spatial', 'none', 'gpool'], 'Invalid averaging mode'%self.averaging
-        self.adjusted_std = lambda x, **kwargs: torch.sqrt(torch.mean((x - torch.mean(x, **kwargs)) ** 2, **kwargs) + 1e-8)
+            assert self.averaging in ['all', 'flat', 'spatial', 'none', 'gpool'], 'Invalid averaging mode %s'%self.averaging
+        if channels is not None:
+            self.check_channels(channels)
+        self.frozen = None          # fixed statistic [1, *, *, *] used instead of the batch's (inference, see score.py).
 
-    def forward(self, x):
-        shape = list(x.size())
-        target_shape = copy.deepcopy(shape)
-        vals = self.adjusted_std(x, dim=0, keepdim=True)
+    def adjusted_std(self, x, **kwargs):
+        return torch.sqrt(torch.mean((x - torch.mean(x, **kwargs)) ** 2, **kwargs) + 1e-8)
+
+    def check_channels(self, c_in):
+        # groupN splits the channels into num_new_features slices.
+        assert 'group' not in self.averaging or c_in % self.num_new_features == 0, \
+            '%d channels cannot be split into num_new_features = %d slices'%(c_in, self.num_new_features)
+
+    def out_channels(self, c_in):
+        # number of channels after the concat.
+        self.check_channels(c_in)
+        if self.averaging in ['all', 'flat']:   return c_in + 1
+        elif 'group' in self.averaging:         return c_in + self.num_new_features
+        else:                                   return c_in * 2
+
+    def group_size(self, batch):
+        # largest divisor of the batch size that is <= n, so every sample falls in a full group.
+        return max(g for g in range(1, min(self.n, batch) + 1) if batch % g == 0)
+
+    def statistic(self, x):
+        # [1 or N, maps, 1 or H, 1 or W], concatenated to x by forward().
+        N, C, H, W = x.size()
         if self.averaging == 'all':
-            target_shape[1] = 1
-            vals = torch.mean(vals, dim=1, keepdim=True)
+            vals = torch.mean(self.adjusted_std(x, dim=0, keepdim=True), dim=1, keepdim=True)
+        elif self.averaging == 'flat':
+            vals = self.adjusted_std(x.reshape(1, -1), dim=1).view(1, 1, 1, 1)
         elif self.averaging == 'spatial':
-            if len(shape) == 4:
-                vals = mean(vals, axis=[2,3], keepdim=True)             # torch.mean(torch.mean(vals, 2, keepdim=True), 3, keepdim=True)
+            vals = torch.mean(self.adjusted_std(x, dim=0, keepdim=True), dim=(2, 3), keepdim=True)
         elif self.averaging == 'none':
-            target_shape = [target_shape[0]] + [s for s in target_shape[1:]]
+            vals = self.adjusted_std(x, dim=0, keepdim=True)
         elif self.averaging == 'gpool':
-            if len(shape) == 4:
-                vals = mean(x, [0,2,3], keepdim=True)                   # torch.mean(torch.mean(torch.mean(x, 2, keepdim=True), 3, keepdim=True), 0, keepdim=True)
-        elif self.averaging == 'flat':
-            target_shape[1] = 1
-            vals = torch.FloatTensor([self.adjusted_std(x)])
-        else:                                                           # self.averaging == 'group'
-            target_shape[1] = self.n
-            vals = vals.view(self.n, self.shape[1]/self.n, self.shape[2], self.shape[3])
-            vals = mean(vals, axis=0, keepdim=True).view(1, self.n, 1, 1)
-        vals = vals.expand(*target_shape)
-        return torch.cat([x, vals], 1)
+            vals = torch.mean(x, dim=(0, 2, 3), keepdim=True)
+        else:
+            self.check_channels(C)
+            G, F = self.group_size(N), self.num_new_features
+            y = x.reshape(G, -1, F, C // F, H, W)                       # sample i is in group i % (N/G).
+            y = self.adjusted_std(y, dim=0)                             # [N/G, F, C/F, H, W]
+            vals = torch.mean(y, dim=(2, 3, 4)).view(-1, F, 1, 1).repeat(G, 1, 1, 1)
+        return vals
+
+    def forward(self, x):
+        N, C, H, W = x.size()
+        vals = self.statistic(x) if self.frozen is None else self.frozen
+        return torch.cat([x, vals.expand(N, -1, H, W)], 1)
 
     def __repr__(self):
         return self.__class__.__name__ + '(averaging = %s)' % (self.averaging)
@@ -97,53 +139,102 @@ class pixelwise_norm_layer(nn.Module):
 
 
 # for equaliaeed-learning rate.
+# initializer=None skips initialization (weights come from a state_dict right after); the
+# scale is then the std kaiming_normal would have produced instead of the measured one.
+def init_equalized(weight, initializer, gain):
+    if initializer is None:
+        return torch.tensor(1.0 / weight[0].numel() ** 0.5)
+    if initializer == 'kaiming':    kaiming_normal(weight, a=calculate_gain(gain))
+    elif initializer == 'xavier':   xavier_normal(weight)
+    scale = (torch.mean(weight.data ** 2)) ** 0.5
+    weight.data.copy_(weight.data/scale)
+    return scale
+
+
 class equalized_conv2d(nn.Module):
     def __init__(self, c_in, c_out, k_size, stride, pad, initializer='kaiming', bias=False):
         super(equalized_conv2d, self).__init__()
-        self.conv = nn.Conv2d(c_in, c_out, k_size, stride, pad, bias=False)
-        if initializer == 'kaiming':    kaiming_normal(self.conv.weight, a=calculate_gain('conv2d'))
-        elif initializer == 'xavier':   xavier_normal(self.conv.weight)
-        
-        conv_w = self.conv.weight.data.clone()
+        if initializer is None:
+            self.conv = skip_init(nn.Conv2d, c_in, c_out, k_size, stride, pad, bias=False)
+        else:
+            self.conv = nn.Conv2d(c_in, c_out, k_size, stride, pad, bias=False)
         self.bias = torch.nn.Parameter(torch.FloatTensor(c_out).fill_(0))
-        self.scale = (torch.mean(self.conv.weight.data ** 2)) ** 0.5
-        self.conv.weight.data.copy_(self.conv.weight.data/self.scale)
+        self.scale = init_equalized(self.conv.weight, initializer, 'conv2d')
 
     def forward(self, x):
-        x = self.conv(x.mul(self.scale.to('cuda')))
+        x = self.conv(x.mul(self.scale.to(x.device)))
         return x + self.bias.view(1,-1,1,1).expand_as(x)
         
  
+# leaky_relu --> pixelwise norm without the intermediate tensors of the separate layers.
+# saves only the output y (shared with the next layer's input) and the per-pixel 1/rms r.
+# backward: with a = y / r, dy/da gives  ga = r * (gy - y * mean_c(gy * y)), then the leaky slope where y <= 0.
+class leaky_pixelnorm_function(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, h, bias, negative_slope, eps):
+        y = h + bias.view(1, -1, 1, 1)
+        F.leaky_relu_(y, negative_slope)
+        r = torch.rsqrt(torch.linalg.vector_norm(y, dim=1, keepdim=True).pow_(2).div_(y.size(1)).add_(eps))
+        y.mul_(r)
+        ctx.save_for_backward(y, r)
+        ctx.negative_slope = negative_slope
+        return y
+
+    @staticmethod
+    def backward(ctx, gy):
+        y, r = ctx.saved_tensors
+        gh = gy - y * torch.mean(gy * y, dim=1, keepdim=True)
+        gh.mul_(r)
+        gh = torch.where(y > 0, gh, gh * ctx.negative_slope)
+        return gh, gh.sum(dim=(0, 2, 3)), None, None
+
+
+class fused_conv_leaky_pixelnorm(equalized_conv2d):
+    '''
+    equalized_conv2d --> LeakyReLU --> pixelwise_norm_layer as one layer (same parameters as equalized_conv2d).
+    the scale is applied to the weight instead of the input, so no scaled copy of x is kept for backward.
+    '''
+    def __init__(self, c_in, c_out, k_size, stride, pad, initializer='kaiming', negative_slope=0.2):
+        super(fused_conv_leaky_pixelnorm, self).__init__(c_in, c_out, k_size, stride, pad, initializer=initializer)
+        self.negative_slope = negative_slope
+        self.eps = 1e-8
+
+    def forward(self, x):
+        h = F.conv2d(x, self.conv.weight * self.scale.to(x.device), None, self.conv.stride, self.conv.padding)
+        if torch.jit.is_tracing() or not torch.is_grad_enabled():
+            # inference / export: plain ops (nothing is saved, and tracers cannot record the autograd Function).
+            y = F.leaky_relu(h + self.bias.view(1, -1, 1, 1), self.negative_slope)
+            return y * torch.rsqrt(torch.mean(y ** 2, dim=1, keepdim=True) + self.eps)
+        return leaky_pixelnorm_function.apply(h, self.bias, self.negative_slope, self.eps)
+
+
 class equalized_deconv2d(nn.Module):
     def __init__(self, c_in, c_out, k_size, stride, pad, initializer='kaiming'):
         super(equalized_deconv2d, self).__init__()
-        self.deconv = nn.ConvTranspose2d(c_in, c_out, k_size, stride, pad, bias=False)
-        if initializer == 'kaiming':    kaiming_normal(self.deconv.weight, a=calculate_gain('conv2d'))
-        elif initializer == 'xavier':   xavier_normal(self.deconv.weight)
-        
-        deconv_w = self.deconv.weight.data.clone()
+        if initializer is None:
+            self.deconv = skip_init(nn.ConvTranspose2d, c_in, c_out, k_size, stride, pad, bias=False)
+        else:
+            self.deconv = nn.ConvTranspose2d(c_in, c_out, k_size, stride, pad, bias=False)
         self.bias = torch.nn.Parameter(torch.FloatTensor(c_out).fill_(0))
-        self.scale = (torch.mean(self.deconv.weight.data ** 2)) ** 0.5
-        self.deconv.weight.data.copy_(self.deconv.weight.data/self.scale)
+        self.scale = init_equalized(self.deconv.weight, initializer, 'conv2d')
+
     def forward(self, x):
-        x = self.deconv(x.mul(self.scale))
+        x = self.deconv(x.mul(self.scale.to(x.device)))
         return x + self.bias.view(1,-1,1,1).expand_as(x)
 
 
 class equalized_linear(nn.Module):
     def __init__(self, c_in, c_out, initializer='kaiming'):
         super(equalized_linear, self).__init__()
-        self.linear = nn.Linear(c_in, c_out, bias=False)
-        if initializer == 'kaiming':    kaiming_normal(self.linear.weight, a=calculate_gain('linear'))
-        elif initializer == 'xavier':   torch.nn.init.xavier_normal(self.linear.weight)
-        
-        linear_w = self.linear.weight.data.clone()
+        if initializer is None:
+            self.linear = skip_init(nn.Linear, c_in, c_out, bias=False)
+        else:
+            self.linear = nn.Linear(c_in, c_out, bias=False)
         self.bias = torch.nn.Parameter(torch.FloatTensor(c_out).fill_(0))
-        self.scale = (torch.mean(self.linear.weight.data ** 2)) ** 0.5
-        self.linear.weight.data.copy_(self.linear.weight.data/self.scale)
+        self.scale = init_equalized(self.linear.weight, initializer, 'linear')
         
     def forward(self, x):
-        x = self.linear(x.mul(self.scale.to('cuda')))
+        x = self.linear(x.mul(self.scale.to(x.device)))
         return x + self.bias.view(1,-1).expand_as(x)
 
 
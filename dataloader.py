@@ -1,66 +1,285 @@
 import os
 import torch as torch
 import numpy as np
-from io import BytesIO
-import scipy.misc
-#import tensorflow as tf
-import torchvision
-import torchvision.transforms as transforms
-from torch.utils.data import DataLoader
-from torchvision.datasets import ImageFolder
-from torch.autograd import Variable
-from matplotlib import pyplot as plt
+from torch.utils.data import DataLoader, Dataset, Sampler, BatchSampler
 from PIL import Image
+from .schedule import batch_table
+
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif', '.tiff', '.webp')
+
+
+class image_folder(Dataset):
+    '''
+    same layout, sample order and (img, class_index) items as torchvision's ImageFolder.
+    kept here because importing torchvision costs seconds on every launch.
+    '''
+    def __init__(self, root, loader=None, transform=None):
+        self.root = root
+        self.loader = loader if loader is not None else full_loader
+        self.transform = transform
+        self.classes = sorted(d.name for d in os.scandir(root) if d.is_dir())
+        self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+        self.samples = []
+        for c in self.classes:
+            for dirpath, _, fnames in sorted(os.walk(os.path.join(root, c), followlinks=True)):
+                for fname in sorted(fnames):
+                    if fname.lower().endswith(IMG_EXTENSIONS):
+                        self.samples.append((os.path.join(dirpath, fname), self.class_to_idx[c]))
+
+    def __getitem__(self, index):
+        path, target = self.samples[index]
+        img = self.loader(path)
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, target
+
+    def __len__(self):
+        return len(self.samples)
+
+
+class resize_nearest:
+    # transforms.Resize(size=(imsize, imsize), interpolation=NEAREST) for PIL images.
+    def __init__(self, imsize):
+        self.imsize = imsize
+
+    def __call__(self, img):
+        return img.resize((self.imsize, self.imsize), Image.NEAREST)
+
+
+class draft_loader:
+    '''
+    image loader for image_folder that decodes JPEGs at reduced size.
+    libjpeg can scale by 1/2, 1/4 or 1/8 during the DCT, so we ask PIL (draft mode)
+    for the smallest scale that still covers (imsize x imsize) and let resize_nearest
+    do the rest. non-JPEG inputs fall back to a full decode.
+    '''
+    def __init__(self, imsize):
+        self.imsize = imsize
+
+    def __call__(self, path):
+        with open(path, 'rb') as f:
+            img = Image.open(f)
+            if img.format == 'JPEG':
+                img.draft('RGB', (self.imsize, self.imsize))
+            return img.convert('RGB')
+
+
+def full_loader(path):
+    # same as torchvision's default pil_loader.
+    with open(path, 'rb') as f:
+        img = Image.open(f)
+        return img.convert('RGB')
+
+
+class shm_batch_ring:
+    '''
+    fixed pool of pre-allocated shared-memory batch slots (uint8, NCHW).
+    loader workers decode straight into a slot and only send back the slot index,
+    so batches are never pickled or copied between processes.
+    slots are handed out round-robin; with n_slots > (batches in flight + 1) a slot
+    is never rewritten while the trainer still holds it.
+    '''
+    def __init__(self, n_slots, batchsize, imsize, nc=3):
+        self.n_slots = n_slots
+        self.slots = torch.zeros(n_slots, batchsize, nc, imsize, imsize, dtype=torch.uint8, device='cpu').share_memory_()
+
+
+def mix64(x, key):
+    # splitmix64 finalizer of (x + key) on uint64 arrays (wrapping arithmetic).
+    with np.errstate(over='ignore'):
+        z = x + np.uint64(key)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        return z ^ (z >> np.uint64(31))
+
+
+class feistel_permutation:
+    '''
+    pseudo-random bijection of range(n) keyed by an integer, evaluated per index in O(1) (no table).
+    a balanced Feistel network on the smallest even number of bits covering n; outputs >= n are
+    fed through the network again (cycle walking), which stays a bijection of range(n).
+    '''
+    def __init__(self, n, key, rounds=4):
+        self.n = n
+        bits = max(2, (n - 1).bit_length())
+        self.half = (bits + 1) // 2
+        self.mask = np.uint64((1 << self.half) - 1)
+        keys = np.array([key & 0xffffffffffffffff], dtype=np.uint64)
+        self.keys = [int(mix64(keys, 0x9e3779b97f4a7c15 * (r + 1) & 0xffffffffffffffff)[0]) for r in range(rounds)]
+
+    def rounds(self, x):
+        half = np.uint64(self.half)
+        left, right = x >> half, x & self.mask
+        for k in self.keys:
+            left, right = right, left ^ (mix64(right, k) & self.mask)
+        return (left << half) | right
+
+    def __call__(self, index):
+        # index: int array of positions in range(n) --> permuted indices.
+        x = self.rounds(np.asarray(index, dtype=np.uint64))
+        walk = x >= self.n
+        while walk.any():
+            x[walk] = self.rounds(x[walk])
+            walk = x >= self.n
+        return x.astype(np.int64)
+
+
+class seekable_sampler(Sampler):
+    '''
+    endless, deterministic sample stream over n samples: stream position p holds sample
+    perm(seed, p // n)(p % n), i.e. every epoch is a fresh permutation of the whole dataset.
+    iteration starts at position start. any position can be reached in O(1), so a run resumed
+    from (seed, position) sees exactly the samples it would have seen, whatever the batch size.
+    '''
+    def __init__(self, n, seed=0, start=0, chunk=1024):
+        self.n = n
+        self.seed = seed
+        self.start = start
+        self.chunk = chunk
+        self.perm = None
+
+    def permutation(self, epoch):
+        if self.perm is None or self.perm[0] != epoch:
+            self.perm = (epoch, feistel_permutation(self.n, int(mix64(np.array([self.seed & 0xffffffffffffffff], dtype=np.uint64), epoch)[0])))
+        return self.perm[1]
+
+    def indices(self, start, count):
+        # dataset indices of stream positions [start, start + count); may cross an epoch boundary.
+        out = []
+        while count > 0:
+            epoch, offset = divmod(start, self.n)
+            k = min(count, self.n - offset)
+            out.extend(self.permutation(epoch)(np.arange(offset, offset + k)).tolist())
+            start, count = start + k, count - k
+        return out
+
+    def __iter__(self):
+        position = self.start
+        while True:
+            yield from self.indices(position, self.chunk)
+            position = position + self.chunk
+
+    def __len__(self):
+        return self.n
+
+
+class ring_batch_sampler(Sampler):
+    # yields (slot, indices). the batch counter lives in the main process and keeps
+    # running across epochs so the round-robin order is never reset.
+    def __init__(self, sampler, batchsize, n_slots):
+        # keep the batch size fixed unless the dataset is smaller than one batch.
+        self.batch_sampler = BatchSampler(sampler, batchsize, drop_last=len(sampler) >= batchsize)
+        self.n_slots = n_slots
+        self.count = 0
+
+    def __iter__(self):
+        for indices in self.batch_sampler:
+            slot = self.count % self.n_slots
+            self.count = self.count + 1
+            yield slot, indices
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
+class ring_batch_dataset(Dataset):
+    # decodes a whole batch of image_folder samples into one ring slot.
+    def __init__(self, dataset, ring):
+        self.dataset = dataset
+        self.ring = ring
+
+    def __getitem__(self, item):
+        slot, indices = item
+        for i, index in enumerate(indices):
+            img, _ = self.dataset[index]
+            np.copyto(self.ring.slots[slot, i].numpy().transpose(1, 2, 0), np.asarray(img))
+        return slot, len(indices)
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def to_device_batch(x, device):
+    '''
+    first device op for a uint8 batch from get_batch(): ship the (4x smaller) uint8
+    data, then cast and scale to [-1, 1] in place on the device.
+    '''
+    x = x.to(device=device, non_blocking=True).to(dtype=torch.float32)
+    return x.mul_(2.0/255.0).sub_(1.0)
 
 
 class dataloader:
     def __init__(self, config):
         self.root = config.train_data_root
-        self.batch_table = {4:32, 8:32, 16:32, 32:16, 64:16, 128:16, 256:12, 512:3, 1024:1} # change this according to available gpu memory.
+        self.batch_table = batch_table(config.batch_table)      # see schedule.BATCH_TABLE.
         self.batchsize = int(self.batch_table[pow(2,2)])        # we start from 2^2=4
         self.imsize = int(pow(2,2))
-        self.num_workers = 4
+        self.num_workers = config.num_workers
+        self.prefetch_factor = 2
+        self.flag_draft_decode = config.flag_draft_decode
+        self.seed = config.random_seed
+        self.position = 0           # samples handed out by get_batch() so far (see seekable_sampler).
         
     def renew(self, resl):
         print('[*] Renew dataloader configuration, load data from {}.'.format(self.root))
         
         self.batchsize = int(self.batch_table[pow(2,resl)])
         self.imsize = int(pow(2,resl))
-        self.dataset = ImageFolder(
+        self.dataset = image_folder(
                     root=self.root,
-                    transform=transforms.Compose(   [
-                                                    transforms.Resize(size=(self.imsize,self.imsize), interpolation=Image.NEAREST),
-                                                    transforms.ToTensor(),
-                                                    ]))
+                    loader=draft_loader(self.imsize) if self.flag_draft_decode else full_loader,
+                    transform=resize_nearest(self.imsize))
 
+        # one slot held by the trainer, one being refilled, the rest in flight.
+        n_slots = self.num_workers * self.prefetch_factor + 2
+        self.ring = shm_batch_ring(n_slots, self.batchsize, self.imsize)
+        self.sampler = seekable_sampler(len(self.dataset), self.seed, self.position)
         self.dataloader = DataLoader(
-            dataset=self.dataset,
-            batch_size=self.batchsize,
-            shuffle=True,
-            num_workers=self.num_workers
+            dataset=ring_batch_dataset(self.dataset, self.ring),
+            batch_size=None,
+            sampler=ring_batch_sampler(self.sampler, self.batchsize, n_slots),
+            num_workers=self.num_workers,
+            prefetch_factor=self.prefetch_factor if self.num_workers > 0 else None,
+            persistent_workers=self.num_workers > 0
         )
+        self.data_iter = None
 
     def __iter__(self):
-        return iter(self.dataloader)
+        for slot, n in self.dataloader:
+            yield self.ring.slots[slot, :n]
     
     def __next__(self):
-        return next(self.dataloader)
+        return self.get_batch()
 
     def __len__(self):
         return len(self.dataloader.dataset)
 
        
     def get_batch(self):
-        dataIter = iter(self.dataloader)
-        return next(dataIter)[0].mul(2).add(-1)         # pixel range [-1, 1]
-
-
-        
-
-
-
-
-
+        '''
+        returns a zero-copy uint8 view [N, C, H, W] into the shared ring.
+        the view is only valid until the next call; use to_device_batch() to get [-1, 1] floats.
+        '''
+        if self.data_iter is None:
+            self.data_iter = iter(self.dataloader)      # the sample stream is endless; epochs run into each other.
+        slot, n = next(self.data_iter)
+        self.position = self.position + n
+        return self.ring.slots[slot, :n]
 
+    def seek(self, position):
+        # the next batch starts at stream position; batches already prefetched are dropped.
+        self.position = position
+        if hasattr(self, 'sampler'):
+            self.sampler.start = position
+            self.data_iter = None
 
+    def state_dict(self):
+        return {'seed': self.seed, 'position': self.position}
 
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        if hasattr(self, 'sampler'):
+            self.sampler.seed = self.seed
+            self.sampler.perm = None
+        self.seek(state['position'])
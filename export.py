@@ -0,0 +1,159 @@
+""" export.py
+exports the Generator of a checkpoint as TorchScript (.pt) and ONNX (.onnx) for deployment.
+
+a flushed generator takes one input, z [N, nz], and returns image [N, nc, H, W].
+a generator in a fade-in state also takes alpha (a scalar float tensor), which replaces the
+python attribute fadein_layer.alpha, so one exported graph covers the whole transition.
+both exports are checked against eager outputs; the ONNX file is also checked and timed with
+onnxruntime when it is installed.
+
+usage: python -m rgen.export --checkpoint repo/model/ckpt_R6_T2400.pth --out_dir repo/export
+"""
+import os
+import time
+import argparse
+import torch
+import torch.nn as nn
+from .custom_layers import ConcatTable, fadein_layer
+
+
+class export_generator(nn.Module):
+    ''' runs G.model step by step, taking the fade-in alpha as an input instead of an attribute. '''
+    def __init__(self, G):
+        super(export_generator, self).__init__()
+        self.model = G.model
+        self.fadein = any(isinstance(m, fadein_layer) for m in G.model.children())
+
+    def forward(self, z, alpha=None):
+        x = z.view(z.size(0), -1, 1, 1)
+        for m in self.model.children():
+            if isinstance(m, ConcatTable):
+                x = [m.layer1(x), m.layer2(x)]          # both branches: alpha is only known at run time.
+            elif isinstance(m, fadein_layer):
+                x = torch.add(x[0].mul(1.0 - alpha), x[1].mul(alpha))
+            else:
+                x = m(x)
+        return x
+
+
+def example_inputs(model, nz, batch_size=2):
+    z = torch.randn(batch_size, nz)
+    return (z, torch.tensor(0.5)) if model.fadein else (z,)
+
+
+def export_torchscript(model, inputs, path):
+    with torch.no_grad():
+        traced = torch.jit.trace(model, inputs)
+    traced.save(path)
+    return torch.jit.load(path)
+
+
+def export_onnx(model, inputs, path, opset=17):
+    names = ['z', 'alpha'][:len(inputs)]
+    kwargs = dict(input_names=names, output_names=['image'], opset_version=opset,
+                  dynamic_axes={'z': {0: 'batch'}, 'image': {0: 'batch'}})
+    with torch.no_grad():
+        try:
+            torch.onnx.export(model, inputs, path, dynamo=False, **kwargs)
+        except TypeError:
+            torch.onnx.export(model, inputs, path, **kwargs)        # torch < 2.5 has no dynamo exporter.
+
+
+def onnx_session(path, num_threads=0):
+    # None if onnxruntime is not installed.
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        return None
+    options = ort.SessionOptions()
+    if num_threads > 0:
+        options.intra_op_num_threads = num_threads
+    return ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+
+def run_onnx(session, inputs):
+    feed = {i.name: x.numpy() for i, x in zip(session.get_inputs(), inputs)}
+    return torch.from_numpy(session.run(None, feed)[0])
+
+
+def verify(G, model, scripted, session, nz, alphas, batch_size=4):
+    ''' max abs difference to eager G (with fadein_block.alpha set) per backend and alpha. '''
+    rows = []
+    for alpha in (alphas if model.fadein else [None]):
+        z = torch.randn(batch_size, nz)
+        inputs = (z,) if alpha is None else (z, torch.tensor(alpha))
+        if alpha is not None:
+            G.model.fadein_block.alpha = alpha
+        with torch.no_grad():
+            ref = G(z)
+            diffs = {'torchscript': (scripted(*inputs) - ref).abs().max().item()}
+        if session is not None:
+            diffs['onnx'] = (run_onnx(session, inputs) - ref).abs().max().item()
+        rows.append((alpha, diffs))
+    return rows
+
+
+def benchmark(model, scripted, session, nz, batch_sizes, n_iter=10):
+    ''' images/s per backend and batch size. '''
+    rows = []
+    for batch_size in batch_sizes:
+        inputs = example_inputs(model, nz, batch_size)
+        backends = [('eager', model), ('torchscript', scripted)]
+        if session is not None:
+            backends.append(('onnxruntime', lambda *x: run_onnx(session, x)))
+        row = [batch_size]
+        for _, fn in backends:
+            with torch.no_grad():
+                fn(*inputs)                 # warm-up.
+                start = time.time()
+                for _ in range(n_iter):
+                    fn(*inputs)
+            row.append('{:.1f}'.format(batch_size * n_iter / (time.time() - start)))
+        rows.append(row)
+    return [name for name, _ in backends], rows
+
+
+if __name__ == '__main__':
+    from math import floor
+    from .config import config
+    from . import checkpoint as CK
+    from .benchmark import print_table
+
+    parser = argparse.ArgumentParser('PGGAN export')
+    parser.add_argument('--checkpoint', type=str, required=True)        # gen_*.pth.tar or ckpt_*.pth
+    parser.add_argument('--out_dir', type=str, default='repo/export')
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--atol', type=float, default=1e-4)             # max abs difference to eager outputs.
+    parser.add_argument('--batch_sizes', type=str, default='1,16')      # benchmark batch sizes.
+    parser.add_argument('--num_threads', type=int, default=0)           # intra-op threads for every backend. (0: default)
+    args, _ = parser.parse_known_args()
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    G, info = CK.load_model(args.checkpoint, 'gen', config)
+    G.eval()
+    model = export_generator(G).eval()
+    name = 'gen_R{}_T{}{}'.format(int(floor(info['resl'])), info.get('globalTick', 0), '_fadein' if model.fadein else '')
+    os.makedirs(args.out_dir, exist_ok=True)
+    inputs = example_inputs(model, config.nz)
+
+    ts_path = os.path.join(args.out_dir, name + '.pt')
+    scripted = export_torchscript(model, inputs, ts_path)
+    print('[export] torchscript --> {}'.format(ts_path))
+    onnx_path = os.path.join(args.out_dir, name + '.onnx')
+    export_onnx(model, inputs, onnx_path, args.opset)
+    print('[export] onnx --> {} (inputs: {})'.format(onnx_path, ', '.join(['z', 'alpha'][:len(inputs)])))
+    session = onnx_session(onnx_path, args.num_threads)
+    if session is None:
+        print('[export] onnxruntime is not installed; the onnx export is not verified.')
+
+    failed = False
+    for alpha, diffs in verify(G, model, scripted, session, config.nz, [0.0, 0.37, 1.0]):
+        ok = all(d <= args.atol for d in diffs.values())
+        failed = failed or not ok
+        print('[verify] alpha: {}  '.format('-' if alpha is None else alpha) +
+              '  '.join('{}: {:.2e}'.format(k, v) for k, v in diffs.items()) + ('' if ok else '  FAILED'))
+    header, rows = benchmark(model, scripted, session, config.nz, [int(b) for b in args.batch_sizes.split(',')])
+    print_table(['batch'] + ['{} img/s'.format(h) for h in header], rows)
+    if failed:
+        raise SystemExit(1)
@@ -3,33 +3,29 @@
 
 import os,sys
 import torch
+from math import floor
 from .config import config
 from torch.autograd import Variable
-import utils as utils
+from . import utils as utils
+from . import checkpoint as CK
 
 
 use_cuda = True
-checkpoint_path = 'repo/model/gen_R8_T55.pth.tar'
+checkpoint_path = 'repo/model/gen_R8_T55.pth.tar'       # gen_*.pth.tar or single-file ckpt_*.pth
 n_intp = 20
 
-# load trained model.
-import network as net
-test_model = net.Generator(config)
+# load trained model. the generator is built directly at the checkpoint's resolution.
+print('load checkpoint form ... {}'.format(checkpoint_path))
+test_model, info = CK.load_model(checkpoint_path, 'gen', config)
+resl = int(floor(info['resl']))
 if use_cuda:
     torch.set_default_tensor_type('torch.cuda.FloatTensor')
     test_model = torch.nn.DataParallel(test_model).cuda(device=0)
 else:
     torch.set_default_tensor_type('torch.FloatTensor')
-
-for resl in range(3, config.max_resl+1):
-    test_model.module.grow_network(resl)
-    test_model.module.flush_network()
+    test_model = torch.nn.DataParallel(test_model)
 print(test_model)
 
-print('load checkpoint form ... {}'.format(checkpoint_path))
-checkpoint = torch.load(checkpoint_path)
-test_model.module.load_state_dict(checkpoint['state_dict'])
-
 # create folder.
 for i in range(1000):
     name = 'repo/interpolation/try_{}'.format(i)
@@ -54,7 +50,7 @@ for i in range(1, n_intp+1):
     z_intp.data = z1.mul_(alpha) + z2.mul_(1.0-alpha)
     fake_im = test_model.module(z_intp)
     fname = os.path.join(name, '_intp{}.jpg'.format(i))
-    utils.save_image_single(fake_im.data, fname, imsize=pow(2,config.max_resl))
+    utils.save_image_single(fake_im.data, fname, imsize=pow(2,resl))
     print('saved {}-th interpolated image ...'.format(i))
 
 
@@ -0,0 +1,282 @@
+""" memory.py
+memory instrumentation for the trainer (--mem_track_every N, 0: off).
+
+the run is split into stages, one per (resolution, phase). for every stage the report holds:
+  + peak resident memory (sampled every N iterations, plus the process high-water mark) and, on
+    GPUs, the allocator's peak allocated / reserved bytes (exact; reset at every stage change).
+  + activation memory per top-level block of G and D: bytes autograd saves for backward inside the
+    block during one iteration (all calls of the network, storages counted once, parameters excluded).
+  + static memory: parameters, gradients and optimizer state of G and D.
+  + growth: tensor groups (device, dtype, shape) whose live count went up at each of the last
+    --mem_growth_window samples of the stage (e.g. losses kept in a list with their graphs).
+only every N-th iteration is measured; hooks are idle in between. under DataParallel with several
+GPUs the per-block activations are not metered (the replicas run on their own threads).
+
+the report (<out_dir>/memory.json) is rewritten at every stage change and at the end of training.
+peak ~= static_bytes + batchsize * activation_bytes_per_sample is what a batch-size planner needs:
+    python -m rgen.memory --report repo/memory.json --budget 8G
+"""
+import os
+import gc
+import json
+import time
+import argparse
+import warnings
+import threading
+from math import floor
+import torch
+
+
+def rss_bytes():
+    # current resident set size (None where /proc is not available).
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def max_rss_bytes():
+    # high-water mark of the process.
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return None
+
+
+def tensor_census():
+    # {(device, dtype, shape): [count, bytes]} of all live tensors.
+    groups = {}
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')         # isinstance() on some deprecated torch objects warns.
+        for obj in gc.get_objects():
+            try:
+                if not torch.is_tensor(obj):
+                    continue
+                key = (str(obj.device), str(obj.dtype).replace('torch.', ''), tuple(obj.shape))
+                nbytes = obj.numel() * obj.element_size()
+            except Exception:
+                continue
+            g = groups.setdefault(key, [0, 0])
+            g[0] = g[0] + 1
+            g[1] = g[1] + nbytes
+    return groups
+
+
+def state_bytes(model, optimizer):
+    # parameters + gradients + optimizer state.
+    n = 0
+    for p in model.parameters():
+        n = n + p.numel() * p.element_size()
+        if p.grad is not None:
+            n = n + p.grad.numel() * p.grad.element_size()
+    for state in optimizer.state.values():
+        for v in state.values():
+            if torch.is_tensor(v):
+                n = n + v.numel() * v.element_size()
+    return n
+
+
+class block_meter:
+    '''
+    counts the bytes autograd saves for backward inside each top-level block of net.model.
+    attach() (re)hooks the blocks; call it whenever the network may have grown or been flushed.
+    '''
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.active = False
+        self.enabled = True         # False: hooks stay idle even in measured iterations.
+        self.handles = {}           # id(block) --> (block, [hook handles])
+        self.local = threading.local()          # .contexts: the saved_tensors_hooks this thread has entered.
+        self.params = set()
+        self.reset()
+
+    def contexts(self):
+        if not hasattr(self.local, 'contexts'):
+            self.local.contexts = []
+        return self.local.contexts
+
+    def release(self):
+        # exits the contexts a forward that raised left open on this thread (innermost first).
+        contexts = self.contexts()
+        while len(contexts) > 0:
+            contexts.pop().__exit__(None, None, None)
+
+    def reset(self):
+        self.release()
+        self.bytes = {}
+        self.calls = {}
+        self.seen = set()
+
+    def attach(self, net):
+        blocks = dict(net.model.named_children())
+        ids = set(id(m) for m in blocks.values())
+        for key in [k for k in self.handles if k not in ids]:
+            for h in self.handles.pop(key)[1]:
+                h.remove()
+        for name, m in blocks.items():
+            if id(m) not in self.handles:
+                name = '{}/{}'.format(self.prefix, name)
+                self.handles[id(m)] = (m, [m.register_forward_pre_hook(self.enter_hook(name)), m.register_forward_hook(self.exit_hook())])
+        self.params = set(p.untyped_storage().data_ptr() for p in net.parameters())
+
+    def enter_hook(self, name):
+        def hook(module, inputs):
+            if not self.active or not self.enabled or not torch.is_grad_enabled():
+                return
+            self.release()          # blocks are siblings: nothing of ours is open when one starts.
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+            def pack(t):
+                storage = t.untyped_storage()
+                ptr = storage.data_ptr()
+                if ptr not in self.params and ptr not in self.seen:
+                    self.seen.add(ptr)
+                    self.bytes[name] = self.bytes.get(name, 0) + storage.nbytes()
+                return t
+            ctx = torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t)
+            ctx.__enter__()
+            self.contexts().append(ctx)
+        return hook
+
+    def exit_hook(self):
+        def hook(module, inputs, output):
+            self.release()
+        return hook
+
+
+class memory_tracker:
+    def __init__(self, path, every=50, growth_window=4):
+        self.path = path
+        self.every = every
+        self.growth_window = growth_window
+        self.cuda = torch.cuda.is_available()
+        self.meters = [block_meter('G'), block_meter('D')]
+        self.stages = []
+        self.stage = None
+        self.census = []
+
+    def new_stage(self, trainer, resl):
+        self.stage = {'resl': resl, 'imsize': int(pow(2, resl)), 'phase': trainer.phase, 'batchsize': trainer.loader.batchsize,
+                      'first_iter': trainer.globalIter, 'iters': 0, 'samples': 0, 'seconds': 0.0, 'start': time.time(),
+                      'peak_rss': None, 'max_rss_process': None, 'peak_allocated': None, 'peak_reserved': None,
+                      'static_bytes': 0, 'activations': {}, 'activation_bytes': 0, 'activation_bytes_per_sample': 0.0,
+                      'growing': []}
+        self.stages.append(self.stage)
+        self.census = []
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def step(self, trainer):
+        ''' call at the end of every training iteration. '''
+        resl = min(floor(trainer.resl), trainer.max_resl)
+        if self.stage is None or (self.stage['resl'], self.stage['phase']) != (resl, trainer.phase):
+            if self.stage is not None:
+                self.save()
+            self.new_stage(trainer, resl)
+        stage = self.stage
+        stage['iters'] = stage['iters'] + 1
+        stage['samples'] = stage['samples'] + trainer.loader.batchsize
+        stage['seconds'] = time.time() - stage['start']
+
+        if self.meters[0].active:
+            # this iteration was measured.
+            self.collect(trainer)
+        for meter, net in zip(self.meters, [trainer.G, trainer.D]):
+            meter.attach(net.module)
+            meter.reset()
+            meter.active = (trainer.globalIter + 1) % self.every == 0
+            meter.enabled = len(getattr(net, 'device_ids', None) or []) <= 1
+        self.meters[1].seen = self.meters[0].seen       # a tensor saved by both G and D (x_tilde) counts once.
+
+    def collect(self, trainer):
+        stage = self.stage
+        acts = {}
+        for meter in self.meters:
+            for name, nbytes in meter.bytes.items():
+                acts[name] = {'bytes': nbytes, 'calls': meter.calls.get(name, 0)}
+        total = sum(a['bytes'] for a in acts.values())
+        if total >= stage['activation_bytes']:
+            stage['activations'] = acts
+            stage['activation_bytes'] = total
+            stage['activation_bytes_per_sample'] = total / float(trainer.loader.batchsize)
+        stage['static_bytes'] = state_bytes(trainer.G.module, trainer.opt_g) + state_bytes(trainer.D.module, trainer.opt_d)
+        rss = rss_bytes()
+        if rss is not None:
+            stage['peak_rss'] = max(stage['peak_rss'] or 0, rss)
+        stage['max_rss_process'] = max_rss_bytes()
+        if self.cuda:
+            stage['peak_allocated'] = torch.cuda.max_memory_allocated()
+            stage['peak_reserved'] = torch.cuda.max_memory_reserved()
+
+        self.census.append(tensor_census())
+        self.census = self.census[-(self.growth_window + 1):]
+        stage['growing'] = self.growing()
+
+    def growing(self):
+        # groups whose count increased between every pair of consecutive samples in the window.
+        if len(self.census) <= self.growth_window:
+            return []
+        out = []
+        for key, (count, nbytes) in self.census[-1].items():
+            counts = [c.get(key, [0, 0])[0] for c in self.census]
+            if all(b > a for a, b in zip(counts[:-1], counts[1:])):
+                out.append({'device': key[0], 'dtype': key[1], 'shape': list(key[2]), 'counts': counts, 'bytes': nbytes})
+        return sorted(out, key=lambda g: -g['bytes'])
+
+    def report(self):
+        stages = [{k: v for k, v in s.items() if k != 'start'} for s in self.stages]
+        return {'device': 'cuda' if self.cuda else 'cpu', 'every': self.every, 'stages': stages}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+
+    def close(self):
+        for meter in self.meters:
+            meter.active = False
+        self.save()
+
+
+def parse_bytes(s):
+    units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+    s = s.strip().upper().rstrip('B')
+    return int(float(s[:-1]) * units[s[-1]]) if s and s[-1] in units else int(s)
+
+
+if __name__ == '__main__':
+    from .benchmark import print_table
+
+    parser = argparse.ArgumentParser('PGGAN memory report')
+    parser.add_argument('--report', type=str, default='repo/memory.json')
+    parser.add_argument('--budget', type=str, default='')       # e.g. 8G: largest batch size per stage that fits (peak ~= static + batch * per-sample).
+    parser.add_argument('--blocks', type=bool, default=False)   # also list activation bytes per block.
+    args, _ = parser.parse_known_args()
+
+    with open(args.report) as f:
+        report = json.load(f)
+    mb = lambda b: '-' if b is None else '{:.1f}'.format(b / 2 ** 20)
+    budget = parse_bytes(args.budget) if args.budget else None
+    rows = []
+    for s in report['stages']:
+        peak = s['peak_allocated'] if s['peak_allocated'] is not None else s['peak_rss']
+        row = [s['imsize'], s['phase'], s['batchsize'], s['iters'], mb(s['peak_rss']), mb(s['peak_allocated']), mb(s['peak_reserved']),
+               mb(s['static_bytes']), mb(s['activation_bytes']), '{:.2f}'.format(s['activation_bytes_per_sample'] / 2 ** 20), len(s['growing'])]
+        if budget is not None:
+            per = s['activation_bytes_per_sample']
+            # everything but activations and static state (runtime, data ring, ...) is assumed not to scale with the batch.
+            other = max(0, peak - s['static_bytes'] - s['activation_bytes'])
+            row.append(int((budget - s['static_bytes'] - other) // per) if per > 0 else '-')
+        rows.append(row)
+    header = ['imsize', 'phase', 'batch', 'iters', 'rss MB', 'alloc MB', 'reserved MB', 'static MB', 'act MB', 'act MB/sample', 'growing']
+    print_table(header + (['max batch'] if budget is not None else []), rows)
+    if args.blocks:
+        for s in report['stages']:
+            print('[{}px {}]  '.format(s['imsize'], s['phase']) + '  '.join(
+                '{}: {}MB'.format(k, mb(v['bytes'])) for k, v in sorted(s['activations'].items(), key=lambda kv: -kv[1]['bytes'])))
+    for s in report['stages']:
+        for g in s['growing'][:5]:
+            print('[growing] {}px {}: {} {} {} counts {}'.format(s['imsize'], s['phase'], g['device'], g['dtype'], g['shape'], g['counts']))
@@ -0,0 +1,321 @@
+""" metrics.py
+sample-quality metrics for picking checkpoints without looking at image grids.
+  + swd: sliced Wasserstein distance between 7x7 neighborhoods of Laplacian pyramid levels
+         (as in the PGGAN paper), reported x1e3 per level and averaged.
+  + fid: Frechet distance between feature statistics of a local feature extractor
+         (a TorchScript module, or a torchvision inception_v3 state_dict saved on disk).
+generator samples are streamed batch by batch: swd keeps a fixed-size reservoir of descriptors
+per level and fid keeps running sums, so memory does not grow with the number of images.
+real-image statistics are computed once per (dataset index, resolution, settings) and cached.
+
+usage: python -m rgen.metrics --checkpoint repo/model/ckpt_R6_T2400.pth --eval_metrics swd,fid --fid_model inception.pt
+"""
+import os
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Subset
+from . import dataloader as DL
+
+
+GAUSS = [1.0, 4.0, 6.0, 4.0, 1.0]
+
+
+def gaussian_kernel(x):
+    k = torch.tensor(GAUSS, dtype=x.dtype, device=x.device) / 16.0
+    return (k[:, None] * k[None, :]).expand(x.size(1), 1, 5, 5)
+
+
+def pyr_down(x):
+    x = F.pad(x, (2, 2, 2, 2), mode='reflect')
+    return F.conv2d(x, gaussian_kernel(x), groups=x.size(1))[:, :, ::2, ::2]
+
+
+def pyr_up(x):
+    y = x.new_zeros(x.size(0), x.size(1), x.size(2) * 2, x.size(3) * 2)
+    y[:, :, ::2, ::2] = x * 4.0
+    y = F.pad(y, (2, 2, 2, 2), mode='reflect')
+    return F.conv2d(y, gaussian_kernel(y), groups=y.size(1))
+
+
+def laplacian_pyramid(x, min_size=16):
+    levels = []
+    while x.size(-1) > min_size:
+        down = pyr_down(x)
+        levels.append(x - pyr_up(down))
+        x = down
+    levels.append(x)
+    return levels
+
+
+class descriptor_reservoir:
+    # uniform sample of at most `capacity` descriptors out of everything added (reservoir sampling).
+    def __init__(self, capacity, generator):
+        self.capacity = capacity
+        self.generator = generator
+        self.data = None
+        self.seen = 0
+
+    def add(self, desc):
+        if self.data is None:
+            self.data = desc.new_empty(self.capacity, desc.size(1))
+        n_fill = max(0, min(desc.size(0), self.capacity - self.seen))
+        self.data[self.seen:self.seen + n_fill] = desc[:n_fill]
+        rest = desc[n_fill:]
+        if rest.size(0) > 0:
+            seen = torch.arange(self.seen + n_fill, self.seen + desc.size(0), dtype=torch.float64, device='cpu')
+            slot = (torch.rand(rest.size(0), generator=self.generator, dtype=torch.float64, device='cpu') * (seen + 1)).long()
+            keep = slot < self.capacity
+            self.data[slot[keep]] = rest[keep]
+        self.seen = self.seen + desc.size(0)
+
+    def get(self):
+        return self.data[:min(self.seen, self.capacity)]
+
+
+def get_descriptors(level, nhood_size, nhoods_per_image, generator):
+    # random nhood_size x nhood_size neighborhoods --> [N * nhoods_per_image, C * nhood_size**2]
+    k = min(nhood_size, level.size(2), level.size(3))
+    patches = level.unfold(2, k, 1).unfold(3, k, 1).permute(0, 2, 3, 1, 4, 5)     # N, H', W', C, k, k (view)
+    n = level.size(0) * nhoods_per_image
+    idx_n = torch.arange(level.size(0), device='cpu').repeat_interleave(nhoods_per_image)
+    idx_y = torch.randint(0, patches.size(1), (n,), generator=generator, device='cpu')
+    idx_x = torch.randint(0, patches.size(2), (n,), generator=generator, device='cpu')
+    return patches[idx_n, idx_y, idx_x].reshape(n, -1)
+
+
+def normalize_descriptors(desc, nc):
+    # zero mean, unit std per color channel over the whole set.
+    d = desc.view(desc.size(0), nc, -1)
+    mean = d.mean(dim=(0, 2), keepdim=True)
+    std = d.std(dim=(0, 2), keepdim=True)
+    return ((d - mean) / std).view(desc.size(0), -1)
+
+
+def sliced_wasserstein(A, B, dir_repeats, dirs_per_repeat, generator):
+    n = min(A.size(0), B.size(0))
+    A, B = A[:n], B[:n]
+    dists = []
+    for _ in range(dir_repeats):
+        dirs = torch.randn(A.size(1), dirs_per_repeat, generator=generator, dtype=A.dtype, device='cpu')
+        dirs = dirs / dirs.norm(dim=0, keepdim=True)
+        projA = torch.sort(A @ dirs, dim=0)[0]
+        projB = torch.sort(B @ dirs, dim=0)[0]
+        dists.append(torch.mean(torch.abs(projA - projB)))
+    return torch.stack(dists).mean().item()
+
+
+class feature_stats:
+    # running mean / covariance of feature vectors, accumulated in float64.
+    def __init__(self):
+        self.n = 0
+        self.sum = None
+        self.sum_sq = None
+
+    def add(self, f):
+        f = f.detach().to(device='cpu', dtype=torch.float64)
+        if self.sum is None:
+            self.sum = torch.zeros(f.size(1), dtype=torch.float64, device='cpu')
+            self.sum_sq = torch.zeros(f.size(1), f.size(1), dtype=torch.float64, device='cpu')
+        self.n = self.n + f.size(0)
+        self.sum += f.sum(dim=0)
+        self.sum_sq += f.t() @ f
+
+    def mean_cov(self):
+        mu = self.sum / self.n
+        cov = (self.sum_sq - self.n * torch.outer(mu, mu)) / (self.n - 1)
+        return mu, cov
+
+
+def sqrtm_psd(m):
+    vals, vecs = torch.linalg.eigh(m)
+    return (vecs * vals.clamp(min=0).sqrt()) @ vecs.t()
+
+
+def frechet_distance(mu1, cov1, mu2, cov2):
+    # tr(sqrt(cov1 cov2)) == tr(sqrt(s1 cov2 s1)) with s1 = sqrt(cov1), which stays symmetric.
+    s1 = sqrtm_psd(cov1)
+    tr_covmean = torch.linalg.eigvalsh(s1 @ cov2 @ s1).clamp(min=0).sqrt().sum()
+    return (torch.sum((mu1 - mu2) ** 2) + torch.trace(cov1) + torch.trace(cov2) - 2 * tr_covmean).item()
+
+
+def load_feature_extractor(path, device='cpu'):
+    '''
+    loads a feature extractor from a local file: a TorchScript module, or a torchvision
+    inception_v3 state_dict (its classifier is dropped). it is fed [-1, 1] images at fid_size.
+    '''
+    try:
+        model = torch.jit.load(path, map_location=device)
+    except RuntimeError:
+        from torchvision.models import inception_v3
+        model = inception_v3(weights=None, aux_logits=True, init_weights=False)
+        model.load_state_dict(torch.load(path, map_location='cpu'))
+        model.fc = torch.nn.Identity()
+    return model.eval().to(device)
+
+
+def dataset_key(samples):
+    # identifies the dataset index: path, size and mtime of every sample.
+    h = hashlib.sha1()
+    for path, _ in samples:
+        st = os.stat(path)
+        h.update('{}|{}|{}\n'.format(path, st.st_size, int(st.st_mtime)).encode())
+    return h.hexdigest()
+
+
+class to_uint8_tensor:
+    def __call__(self, img):
+        return torch.from_numpy(np.array(img)).permute(2, 0, 1)
+
+
+class uint8_resize:
+    # PIL image --> uint8 [C, imsize, imsize] tensor, resized as the trainer does. a class, not a
+    # lambda, so DataLoader workers can receive it under any start method (spawn, forkserver).
+    def __init__(self, imsize):
+        self.imsize = imsize
+
+    def __call__(self, img):
+        return to_uint8_tensor()(DL.resize_nearest(self.imsize)(img))
+
+
+class evaluator:
+    '''
+    computes swd / fid of a Generator at one resolution against a fixed set of real images.
+    real statistics are loaded from (or written to) cache_dir; the cache key covers the
+    dataset index and every setting that changes the statistics.
+    '''
+    def __init__(self, root, resl, metrics=('swd',), num_images=2048, batch_size=64, fid_model='', fid_size=299,
+                 cache_dir='repo/eval_cache', num_workers=4, device='cpu', seed=123):
+        self.root = root
+        self.resl = int(resl)
+        self.imsize = int(pow(2, self.resl))
+        self.metrics = list(metrics)
+        self.num_images = num_images
+        self.batch_size = batch_size
+        self.fid_model = fid_model
+        self.fid_size = fid_size
+        self.cache_dir = cache_dir
+        self.num_workers = num_workers
+        self.device = device
+        self.seed = seed
+        self.nhood_size = 7
+        self.nhoods_per_image = 128
+        self.dir_repeats = 4
+        self.dirs_per_repeat = 128
+        self.max_descriptors = 1 << 15          # per pyramid level.
+        self.extractor = None
+        if 'fid' in self.metrics:
+            if not fid_model:
+                raise ValueError('fid needs a local feature extractor (fid_model).')
+            self.extractor = load_feature_extractor(fid_model, device)
+        self.real = None
+
+    def settings(self):
+        return {'resl': self.resl, 'metrics': sorted(self.metrics), 'num_images': self.num_images, 'seed': self.seed,
+                'nhood_size': self.nhood_size, 'nhoods_per_image': self.nhoods_per_image,
+                'max_descriptors': self.max_descriptors, 'fid_size': self.fid_size,
+                'fid_model': os.path.abspath(self.fid_model) if self.fid_model else ''}
+
+    def accumulate(self, batches, generator):
+        # batches: iterable of [N, C, H, W] floats in [-1, 1].
+        reservoirs = None
+        fstats = feature_stats()
+        for x in batches:
+            x = x.to(self.device)
+            if 'swd' in self.metrics:
+                levels = laplacian_pyramid(x.cpu().float())
+                if reservoirs is None:
+                    reservoirs = [descriptor_reservoir(self.max_descriptors, generator) for _ in levels]
+                for res, level in zip(reservoirs, levels):
+                    res.add(get_descriptors(level, self.nhood_size, self.nhoods_per_image, generator))
+            if 'fid' in self.metrics:
+                xf = F.interpolate(x, size=(self.fid_size, self.fid_size), mode='bilinear', align_corners=False)
+                fstats.add(self.extractor(xf))
+        stats = {}
+        if reservoirs is not None:
+            stats['swd'] = [normalize_descriptors(res.get(), x.size(1)) for res in reservoirs]
+        if fstats.n > 0:
+            stats['fid'] = fstats.mean_cov()
+        return stats
+
+    def real_batches(self):
+        dataset = DL.image_folder(self.root, loader=DL.draft_loader(self.imsize),
+                                  transform=uint8_resize(self.imsize))
+        perm = torch.randperm(len(dataset), generator=torch.Generator().manual_seed(self.seed), device='cpu')
+        subset = Subset(dataset, perm[:self.num_images].tolist())
+        for x, _ in DataLoader(subset, batch_size=self.batch_size, num_workers=self.num_workers):
+            yield x.float().mul_(2.0 / 255.0).sub_(1.0)
+
+    def cache_path(self):
+        samples = DL.image_folder(self.root).samples
+        key = hashlib.sha1((dataset_key(samples) + json.dumps(self.settings(), sort_keys=True)).encode()).hexdigest()
+        return os.path.join(self.cache_dir, 'real_R{}_{}.pt'.format(self.resl, key[:16]))
+
+    def real_stats(self):
+        if self.real is None:
+            path = self.cache_path()
+            if os.path.exists(path):
+                self.real = torch.load(path)
+            else:
+                with torch.no_grad():
+                    self.real = self.accumulate(self.real_batches(), torch.Generator().manual_seed(self.seed))
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp_path = path + '.{}.tmp'.format(os.getpid())      # concurrent trainers may share the cache.
+                torch.save(self.real, tmp_path)
+                os.replace(tmp_path, path)
+        return self.real
+
+    def fake_batches(self, G, nz):
+        device = next(G.parameters()).device
+        generator = torch.Generator().manual_seed(self.seed + 1)
+        for start in range(0, self.num_images, self.batch_size):
+            z = torch.randn(min(self.batch_size, self.num_images - start), nz, generator=generator, device='cpu')
+            yield G(z.to(device)).clamp(-1, 1)
+
+    def evaluate(self, G):
+        ''' returns {'swd{size}': ..., 'swd': mean, 'fid': ...} for Generator G at this resolution. '''
+        real = self.real_stats()
+        with torch.no_grad():
+            fake = self.accumulate(self.fake_batches(G, G.nz), torch.Generator().manual_seed(self.seed + 2))
+        results = {}
+        if 'swd' in self.metrics:
+            generator = torch.Generator().manual_seed(self.seed + 3)
+            dists = []
+            for i, (A, B) in enumerate(zip(real['swd'], fake['swd'])):
+                d = sliced_wasserstein(A, B, self.dir_repeats, self.dirs_per_repeat, generator) * 1e3
+                results['swd{}'.format(self.imsize >> i)] = d
+                dists.append(d)
+            results['swd'] = sum(dists) / len(dists)
+        if 'fid' in self.metrics:
+            results['fid'] = frechet_distance(*real['fid'], *fake['fid'])
+        return results
+
+
+def get_evaluator(config, resl, device='cpu'):
+    # evaluator configured from the eval_* options in config.py.
+    return evaluator(config.train_data_root, resl, metrics=config.eval_metrics.split(','),
+                     num_images=config.eval_num_images, batch_size=config.eval_batch_size,
+                     fid_model=config.fid_model, cache_dir=config.eval_cache, device=device)
+
+
+if __name__ == '__main__':
+    from math import floor
+    from .config import config
+    from . import checkpoint as CK
+
+    parser = argparse.ArgumentParser('PGGAN metrics')
+    parser.add_argument('--checkpoint', type=str, required=True)        # gen_*.pth.tar or ckpt_*.pth
+    parser.add_argument('--num_threads', type=int, default=0)           # torch intra-op threads (0: default).
+    args, _ = parser.parse_known_args()
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    G, info = CK.load_model(args.checkpoint, 'gen', config)
+    start = time.time()
+    results = get_evaluator(config, int(floor(info['resl']))).evaluate(G)
+    print('[{}] resl: {} tick: {}  '.format(args.checkpoint, int(floor(info['resl'])), info.get('globalTick')) +
+          '  '.join('{}: {:.3f}'.format(k, v) for k, v in results.items()) + '  ({:.1f}s)'.format(time.time() - start))
@@ -0,0 +1,308 @@
+""" nearest.py
+memorization check: nearest training images of generated samples.
+
+the training set is embedded once, at --resl, into a compact index on disk:
+  + pixel:   images area-downsampled to --embed_size x --embed_size, flattened (values in [-1, 1]).
+  + feature: features of a local extractor (--feature_model, as for fid) at --feature_size.
+with --pca_dims > 0 the embeddings are projected onto their top principal components (fitted on
+the training set in a first pass). codes are stored as float16 ([N, D] codes.npy) next to the
+projection (mean.npy, components.npy) and meta.json; an index is reused for the same dataset
+(paths, sizes, mtimes) and settings.
+generator samples (latent_sampler indices [--start, --stop), so any sample can be regenerated)
+are quantized and nearest-downsampled to --resl exactly like the training images, then streamed through a batched top-k search: squared distances |q|^2 + |c|^2 - 2 q.c against
+--chunk codes at a time, merged into a running top-k. nothing grows with the number of samples.
+
+--calibrate N also searches N training images against the rest of the index (leave-one-out):
+their nearest distances are what "close" means for this dataset, and every sample's nearest
+distance is reported relative to their median.
+
+output (--out_dir):
+  + nearest.tsv   sample, nearest distance, ratio to the training median, then index / distance / path of the top-k.
+  + closest.png   the --n_grid samples closest to the training set, one row each: sample, then its top-k.
+  + summary.json  settings, distance percentiles and the number of samples below --ratio.
+
+usage: python -m rgen.nearest --checkpoint repo/model/ckpt_R8_T6000.pth --train_data_root /data/retina --stop 100000 --resl 6 --pca_dims 256
+"""
+import os
+import json
+import heapq
+import hashlib
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Subset
+from . import dataloader as DL
+from .metrics import dataset_key, uint8_resize, feature_stats, load_feature_extractor
+
+
+class embedder:
+    '''
+    maps [N, C, H, W] images in [-1, 1] (at the index resolution) to [N, D] float32 embeddings.
+    mean / components (set by the index) turn the raw embedding into PCA codes.
+    '''
+    def __init__(self, kind='pixel', embed_size=32, feature_net=None, feature_size=299):
+        if kind == 'feature' and feature_net is None:
+            raise ValueError('feature embeddings need a local feature extractor (feature_model).')
+        self.kind = kind
+        self.embed_size = embed_size
+        self.feature_net = feature_net
+        self.feature_size = feature_size
+        self.mean = None
+        self.components = None          # [D_raw, D]
+
+    def raw(self, x):
+        if self.kind == 'feature':
+            x = F.interpolate(x, size=(self.feature_size, self.feature_size), mode='bilinear', align_corners=False)
+            return self.feature_net(x).flatten(1).float()
+        if x.size(-1) > self.embed_size:
+            x = F.adaptive_avg_pool2d(x, self.embed_size)
+        return x.flatten(1).float()
+
+    def __call__(self, x):
+        e = self.raw(x)
+        if self.components is not None:
+            e = (e - self.mean) @ self.components
+        return e
+
+
+class nn_index:
+    ''' float16 codes of the training set, searched in chunks of float32. '''
+    def __init__(self, path, device='cpu'):
+        self.path = path
+        self.device = device
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.paths = self.meta['paths']
+        self.codes = torch.from_numpy(np.load(os.path.join(path, 'codes.npy'))).to(device)
+        self.norms = self.codes.float().pow(2).sum(dim=1)
+        self.mean = self.components = None
+        if os.path.exists(os.path.join(path, 'components.npy')):
+            self.mean = torch.from_numpy(np.load(os.path.join(path, 'mean.npy'))).to(device)
+            self.components = torch.from_numpy(np.load(os.path.join(path, 'components.npy'))).to(device)
+
+    def __len__(self):
+        return self.codes.size(0)
+
+    def search(self, q, k=5, chunk=65536, exclude=None):
+        '''
+        q: [N, D] codes. exclude: None or [N] index rows to leave out (leave-one-out).
+        returns (distances [N, k], rows [N, k]), nearest first; k is capped at the rows that can match.
+        '''
+        k = min(k, len(self) - (1 if exclude is not None else 0))
+        q = q.to(self.device, torch.float32)
+        qn = q.pow(2).sum(dim=1, keepdim=True)
+        best_d = torch.full((q.size(0), k), float('inf'), device=self.device)
+        best_i = torch.zeros(q.size(0), k, dtype=torch.int64, device=self.device)
+        for a in range(0, len(self), chunk):
+            c = self.codes[a:a + chunk].float()
+            d2 = torch.addmm(qn + self.norms[a:a + chunk], q, c.t(), alpha=-2)
+            if exclude is not None:
+                rows = exclude.to(self.device) - a
+                inside = (rows >= 0) & (rows < c.size(0))
+                d2[inside.nonzero().squeeze(1), rows[inside]] = float('inf')
+            d, i = d2.topk(min(k, c.size(0)), dim=1, largest=False)
+            best_d, order = torch.cat([best_d, d], dim=1).topk(k, dim=1, largest=False)
+            best_i = torch.cat([best_i, i + a], dim=1).gather(1, order)
+        return best_d.clamp(min=0).sqrt(), best_i
+
+
+def index_settings(resl, emb, pca_dims, feature_model):
+    return {'resl': resl, 'embed': emb.kind, 'embed_size': emb.embed_size if emb.kind == 'pixel' else 0,
+            'feature_size': emb.feature_size if emb.kind == 'feature' else 0, 'pca_dims': pca_dims,
+            'feature_model': os.path.abspath(feature_model) if feature_model else ''}
+
+
+def real_dataset(root, imsize):
+    # training images as uint8 tensors at the index resolution (as the trainer loads them).
+    return DL.image_folder(root, loader=DL.draft_loader(imsize),
+                           transform=uint8_resize(imsize))
+
+
+def real_batches(dataset, indices, batch_size, num_workers):
+    for x, _ in DataLoader(Subset(dataset, indices), batch_size=batch_size, num_workers=num_workers):
+        yield x.float().mul_(2.0 / 255.0).sub_(1.0)
+
+
+def build_index(root, resl, emb, pca_dims=0, feature_model='', index_dir='repo/nn_index', batch_size=64,
+                num_workers=4, device='cpu', log=print):
+    '''
+    returns the path of the index of the training set under root (built if missing).
+    emb is fitted in place (PCA projection).
+    '''
+    imsize = int(pow(2, resl))
+    dataset = real_dataset(root, imsize)
+    settings = index_settings(resl, emb, pca_dims, feature_model)
+    key = hashlib.sha1((dataset_key(dataset.samples) + json.dumps(settings, sort_keys=True)).encode()).hexdigest()
+    path = os.path.join(index_dir, 'R{}_{}'.format(resl, key[:16]))
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        return path
+    n = len(dataset)
+    tmp_path = path + '.{}.tmp'.format(os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    with torch.no_grad():
+        if pca_dims > 0:
+            # first pass: covariance of the raw embeddings.
+            stats = feature_stats()
+            for x in real_batches(dataset, list(range(n)), batch_size, num_workers):
+                stats.add(emb.raw(x.to(device)))
+            mean, cov = stats.mean_cov()
+            vals, vecs = torch.linalg.eigh(cov)
+            dims = min(pca_dims, vecs.size(1))
+            emb.mean = mean.float().to(device)
+            emb.components = vecs[:, -dims:].flip(1).float().contiguous().to(device)
+            explained = vals[-dims:].sum().item() / max(vals.clamp(min=0).sum().item(), 1e-12)
+            log('[nearest] pca: {} --> {} dims ({:.1%} of the variance).'.format(vecs.size(1), dims, explained))
+            np.save(os.path.join(tmp_path, 'mean.npy'), emb.mean.cpu().numpy())
+            np.save(os.path.join(tmp_path, 'components.npy'), emb.components.cpu().numpy())
+        codes = None
+        row = 0
+        for x in real_batches(dataset, list(range(n)), batch_size, num_workers):
+            e = emb(x.to(device)).cpu().numpy()
+            if codes is None:
+                codes = np.lib.format.open_memmap(os.path.join(tmp_path, 'codes.npy'), mode='w+', dtype=np.float16, shape=(n, e.shape[1]))
+            codes[row:row + len(e)] = e
+            row = row + len(e)
+        codes.flush()
+        del codes
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(dict(settings, root=os.path.abspath(root), n=n, paths=[p for p, _ in dataset.samples]), f)
+    os.replace(tmp_path, path)
+    return path
+
+
+def like_real(x, imsize):
+    '''
+    generator output [N, C, S, S] in [-1, 1] as the index sees training images: quantized to uint8
+    and downsampled to imsize with PIL's NEAREST (which keeps pixel s // 2 of every s x s block).
+    '''
+    s = x.size(-1) // imsize
+    x = x[:, :, s // 2::s, s // 2::s] if s > 1 else x
+    return x.add(1.0).mul(127.5).round().clamp(0, 255).mul(2.0 / 255.0).sub(1.0)
+
+
+def load_images(paths, imsize):
+    # [N, C, imsize, imsize] in [-1, 1].
+    return torch.stack([uint8_resize(imsize)(DL.full_loader(p)) for p in paths]).float().mul_(2.0 / 255.0).sub_(1.0)
+
+
+if __name__ == '__main__':
+    import time
+    from .config import config
+    from . import checkpoint as CK
+    from .sampling import latent_sampler, write_meta
+    from .utils import save_image
+
+    parser = argparse.ArgumentParser('PGGAN nearest training images')
+    parser.add_argument('--checkpoint', type=str, required=True)        # gen_*.pth.tar or ckpt_*.pth
+    parser.add_argument('--out_dir', type=str, default='repo/nearest')
+    parser.add_argument('--index_dir', type=str, default='repo/nn_index')
+    parser.add_argument('--resl', type=int, default=0)                  # index resolution, log2. (0: the generator's output)
+    parser.add_argument('--embed', type=str, default='pixel')           # pixel | feature
+    parser.add_argument('--embed_size', type=int, default=32)           # pixel embeddings: downsampled size.
+    parser.add_argument('--feature_model', type=str, default='')        # feature embeddings: local extractor.
+    parser.add_argument('--feature_size', type=int, default=299)
+    parser.add_argument('--pca_dims', type=int, default=0)              # (0: store the raw embedding)
+    parser.add_argument('--start', type=int, default=0)                 # first sample index.
+    parser.add_argument('--stop', type=int, default=10000)              # last sample index (exclusive).
+    parser.add_argument('--seed', type=int, default=0)                  # latent_sampler seed, as for rgen.sampling.
+    parser.add_argument('--truncation', type=float, default=0.0)
+    parser.add_argument('--k', type=int, default=5)                     # neighbors per sample.
+    parser.add_argument('--chunk', type=int, default=65536)             # index rows per distance block.
+    parser.add_argument('--calibrate', type=int, default=1000)          # training images searched leave-one-out. (0: off)
+    parser.add_argument('--ratio', type=float, default=0.5)             # count samples closer than ratio x the training median.
+    parser.add_argument('--n_grid', type=int, default=16)               # closest samples shown in closest.png.
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--index_only', type=bool, default=False)       # build the index and stop.
+    args, _ = parser.parse_known_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    G, info = CK.load_model(args.checkpoint, 'gen', config)
+    G = G.eval().to(device)
+    with torch.no_grad():
+        out_size = G(torch.zeros(1, config.nz, device=device)).size(-1)
+    resl = args.resl if args.resl > 0 else int(np.log2(out_size))
+    imsize = int(pow(2, resl))
+    if imsize > out_size:
+        raise SystemExit('[nearest] --resl {} is above the generator output ({}px).'.format(resl, out_size))
+    feature_net = load_feature_extractor(args.feature_model, device) if args.embed == 'feature' and args.feature_model else None
+    emb = embedder(args.embed, args.embed_size, feature_net, args.feature_size)
+
+    start = time.time()
+    path = build_index(config.train_data_root, resl, emb, args.pca_dims, args.feature_model, args.index_dir,
+                       args.batch_size, args.num_workers, device)
+    index = nn_index(path, device)
+    emb.mean, emb.components = index.mean, index.components
+    print('[nearest] index {}: {} images at {}px, {} dims ({:.1f}MB) [{:.1f}s]'.format(
+        path, len(index), imsize, index.codes.size(1), index.codes.numel() * 2 / 2 ** 20, time.time() - start))
+    if args.index_only:
+        raise SystemExit(0)
+
+    # what "close" means for this dataset: training images against the rest of the training set.
+    median = None
+    if args.calibrate > 0 and len(index) > 1:
+        rows = torch.randperm(len(index), generator=torch.Generator().manual_seed(args.seed), device='cpu')[:args.calibrate]
+        train_d = []
+        dataset = real_dataset(config.train_data_root, imsize)
+        with torch.no_grad():
+            for i, x in enumerate(real_batches(dataset, rows.tolist(), args.batch_size, args.num_workers)):
+                q = emb(x.to(device))
+                d, _ = index.search(q, 1, args.chunk, exclude=rows[i * args.batch_size:i * args.batch_size + len(q)])
+                train_d.append(d[:, 0].cpu())
+        train_d = torch.cat(train_d).numpy()
+        median = float(np.median(train_d))
+        print('[nearest] training images to their nearest other training image: median {:.4f}, 5% {:.4f} ({} images)'.format(
+            median, np.percentile(train_d, 5), len(train_d)))
+
+    k = min(args.k, len(index))            # a tiny index has fewer than --k neighbours.
+    os.makedirs(args.out_dir, exist_ok=True)
+    write_meta(args.out_dir, {'checkpoint': os.path.abspath(args.checkpoint), 'index': os.path.abspath(path),
+                              'start': args.start, 'stop': args.stop, 'seed': args.seed, 'truncation': args.truncation,
+                              'nz': config.nz, 'k': k})
+    sampler = latent_sampler(config.nz, args.seed, args.truncation)
+    closest = []            # heap of (-distance, sample, rows): the n_grid closest samples so far.
+    dists = []
+    start = time.time()
+    with open(os.path.join(args.out_dir, 'nearest.tsv'), 'w') as f:
+        f.write('\t'.join(['sample', 'distance', 'ratio'] + ['{}{}'.format(c, j) for j in range(k) for c in ('index', 'distance', 'path')]) + '\n')
+        for a in range(args.start, args.stop, args.batch_size):
+            batch = list(range(a, min(a + args.batch_size, args.stop)))
+            with torch.no_grad():
+                x = like_real(G(sampler(batch).to(device)), imsize)
+                d, rows = index.search(emb(x), k, args.chunk)
+            d, rows = d.cpu().tolist(), rows.cpu().tolist()
+            for s, ds, rs in zip(batch, d, rows):
+                ratio = ds[0] / median if median else float('nan')
+                f.write('\t'.join(['{}'.format(s), '{:.5f}'.format(ds[0]), '{:.4f}'.format(ratio)] +
+                                  ['{}\t{:.5f}\t{}'.format(r, dj, index.paths[r]) for r, dj in zip(rs, ds)]) + '\n')
+                dists.append(ds[0])
+                item = (-ds[0], s, rs)
+                if len(closest) < args.n_grid:
+                    heapq.heappush(closest, item)
+                elif item > closest[0]:
+                    heapq.heapreplace(closest, item)
+    elapsed = time.time() - start
+    dists = np.array(dists)
+    print('[nearest] {} samples in {:.1f}s ({:.0f} samples/s): nearest distance median {:.4f}, min {:.4f}'.format(
+        len(dists), elapsed, len(dists) / elapsed, np.median(dists), dists.min()))
+
+    summary = {'samples': len(dists), 'index_images': len(index), 'dims': index.codes.size(1), 'train_median': median,
+               'percentiles': {str(p): float(np.percentile(dists, p)) for p in (0, 1, 5, 25, 50)}}
+    if median:
+        summary['ratio'] = args.ratio
+        summary['below_ratio'] = int((dists < args.ratio * median).sum())
+        print('[nearest] {} samples closer than {} x the training median ({:.4f}).'.format(summary['below_ratio'], args.ratio, median))
+    with open(os.path.join(args.out_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    # side-by-side grid at the index resolution: regenerate the closest samples, load their matches.
+    if args.n_grid > 0:
+        closest = sorted(closest, reverse=True)
+        with torch.no_grad():
+            x = like_real(G(sampler([s for _, s, _ in closest]).to(device)), imsize).cpu()
+        tiles = []
+        for i, (_, _, rows) in enumerate(closest):
+            tiles += [x[i:i + 1], load_images([index.paths[r] for r in rows], imsize)]
+        save_image(torch.cat(tiles).add(1).div(2), os.path.join(args.out_dir, 'closest.png'), nrow=k + 1, padding=2, pad_value=1)
+    print('[nearest] --> {}'.format(args.out_dir))
@@ -8,8 +8,12 @@ import copy
 
 
 # defined for code simplicity.
-def deconv(layers, c_in, c_out, k_size, stride=1, pad=0, leaky=True, bn=False, wn=False, pixel=False, only=False):
-    if wn:  layers.append(equalized_conv2d(c_in, c_out, k_size, stride, pad))
+def deconv(layers, c_in, c_out, k_size, stride=1, pad=0, leaky=True, bn=False, wn=False, pixel=False, only=False, initializer='kaiming', fused=False):
+    if fused and wn and leaky and pixel and not bn and not only:
+        # one layer for conv + leaky + pixelnorm; the Identity placeholders keep the state_dict indices.
+        layers += [fused_conv_leaky_pixelnorm(c_in, c_out, k_size, stride, pad, initializer=initializer), nn.Identity(), nn.Identity()]
+        return layers
+    if wn:  layers.append(equalized_conv2d(c_in, c_out, k_size, stride, pad, initializer=initializer))
     else:   layers.append(nn.Conv2d(c_in, c_out, k_size, stride, pad))
     if not only:
         if leaky:   layers.append(nn.LeakyReLU(0.2))
@@ -18,9 +22,9 @@ def deconv(layers, c_in, c_out, k_size, stride=1, pad=0, leaky=True, bn=False, w
         if pixel:   layers.append(pixelwise_norm_layer())
     return layers
 
-def conv(layers, c_in, c_out, k_size, stride=1, pad=0, leaky=True, bn=False, wn=False, pixel=False, gdrop=True, only=False):
+def conv(layers, c_in, c_out, k_size, stride=1, pad=0, leaky=True, bn=False, wn=False, pixel=False, gdrop=True, only=False, initializer='kaiming'):
     if gdrop:       layers.append(generalized_drop_out(mode='prop', strength=0.0))
-    if wn:          layers.append(equalized_conv2d(c_in, c_out, k_size, stride, pad, initializer='kaiming'))
+    if wn:          layers.append(equalized_conv2d(c_in, c_out, k_size, stride, pad, initializer=initializer))
     else:           layers.append(nn.Conv2d(c_in, c_out, k_size, stride, pad))
     if not only:
         if leaky:   layers.append(nn.LeakyReLU(0.2))
@@ -29,14 +33,20 @@ def conv(layers, c_in, c_out, k_size, stride=1, pad=0, leaky=True, bn=False, wn=
         if pixel:   layers.append(pixelwise_norm_layer())
     return layers
 
-def linear(layers, c_in, c_out, sig=True, wn=False):
+def linear(layers, c_in, c_out, sig=True, wn=False, initializer='kaiming'):
     layers.append(Flatten())
-    if wn:      layers.append(equalized_linear(c_in, c_out))
+    if wn:      layers.append(equalized_linear(c_in, c_out, initializer=initializer))
     else:       layers.append(Linear(c_in, c_out))
     if sig:     layers.append(nn.Sigmoid())
     return layers
 
     
+def named_sequential(name, module):
+    # the wrapper deepcopy_module() leaves around a block, e.g. Sequential(high_resl_block=...).
+    new_module = nn.Sequential()
+    new_module.add_module(name, module)
+    return new_module
+
 def deepcopy_module(module, target):
     new_module = nn.Sequential()
     for name, m in module.named_children():
@@ -52,6 +62,19 @@ def soft_copy_param(target_link, source_link, tau):
         target_params[param_name].data = target_params[param_name].data.mul(1.0-tau)
         target_params[param_name].data = target_params[param_name].data.add(param.data.mul(tau))
 
+def get_equalized_scales(model):
+    # equalized layers keep their scale as a plain attribute, so it is not part of the state_dict.
+    scales = {}
+    for name, m in model.named_modules():
+        if isinstance(m, (equalized_conv2d, equalized_deconv2d, equalized_linear)):
+            scales[name] = m.scale
+    return scales
+
+def set_equalized_scales(model, scales):
+    for name, m in model.named_modules():
+        if name in scales:
+            m.scale = scales[name].clone()
+
 def get_module_names(model):
     names = []
     for key, val in model.state_dict().items():
@@ -62,7 +85,12 @@ def get_module_names(model):
 
 
 class Generator(nn.Module):
-    def __init__(self, config):
+    '''
+    resl/fadein build the structure grow_network()/flush_network() would have reached,
+    in one pass (fadein=True: mid-transition into resl). init=False skips weight
+    initialization when a state_dict is loaded right after.
+    '''
+    def __init__(self, config, resl=2, fadein=False, init=True):
         super(Generator, self).__init__()
         self.config = config
         self.flag_bn = config.flag_bn
@@ -71,20 +99,23 @@ class Generator(nn.Module):
         self.flag_leaky = config.flag_leaky
         self.flag_tanh = config.flag_tanh
         self.flag_norm_latent = config.flag_norm_latent
+        self.flag_fused = config.flag_fused
         self.nc = config.nc
         self.nz = config.nz
         self.ngf = config.ngf
+        self.initializer = 'kaiming' if init else None
         self.layer_name = None
         self.module_names = []
-        self.model = self.get_init_gen()
+        self.model = self.get_gen(int(resl), fadein)
+        self.initializer = 'kaiming'         # blocks added later by grow_network() are always initialized.
 
     def first_block(self):
         layers = []
         ndim = self.ngf
         if self.flag_norm_latent:
             layers.append(pixelwise_norm_layer())
-        layers = deconv(layers, self.nz, ndim, 4, 1, 3, self.flag_leaky, self.flag_bn, self.flag_wn, self.flag_pixelwise)
-        layers = deconv(layers, ndim, ndim, 3, 1, 1, self.flag_leaky, self.flag_bn, self.flag_wn, self.flag_pixelwise)
+        layers = deconv(layers, self.nz, ndim, 4, 1, 3, self.flag_leaky, self.flag_bn, self.flag_wn, self.flag_pixelwise, initializer=self.initializer, fused=self.flag_fused)
+        layers = deconv(layers, ndim, ndim, 3, 1, 1, self.flag_leaky, self.flag_bn, self.flag_wn, self.flag_pixelwise, initializer=self.initializer, fused=self.flag_fused)
         return  nn.Sequential(*layers), ndim
 
     def intermediate_block(self, resl):
@@ -102,24 +133,50 @@ class Generator(nn.Module):
         layers = []
         layers.append(nn.Upsample(scale_factor=2, mode='nearest'))       # scale up by factor of 2.0
         if halving:
-            layers = deconv(layers, ndim*2, ndim, 3, 1, 1, self.flag_leaky, self.flag_bn, self.flag_wn, self.flag_pixelwise)
-            layers = deconv(layers, ndim, ndim, 3, 1, 1, self.flag_leaky, self.flag_bn, self.flag_wn, self.flag_pixelwise)
+            layers = deconv(layers, ndim*2, ndim, 3, 1, 1, self.flag_leaky, self.flag_bn, self.flag_wn, self.flag_pixelwise, initializer=self.initializer, fused=self.flag_fused)
+            layers = deconv(layers, ndim, ndim, 3, 1, 1, self.flag_leaky, self.flag_bn, self.flag_wn, self.flag_pixelwise, initializer=self.initializer, fused=self.flag_fused)
         else:
-            layers = deconv(layers, ndim, ndim, 3, 1, 1, self.flag_leaky, self.flag_bn, self.flag_wn, self.flag_pixelwise)
-            layers = deconv(layers, ndim, ndim, 3, 1, 1, self.flag_leaky, self.flag_bn, self.flag_wn, self.flag_pixelwise)
+            layers = deconv(layers, ndim, ndim, 3, 1, 1, self.flag_leaky, self.flag_bn, self.flag_wn, self.flag_pixelwise, initializer=self.initializer, fused=self.flag_fused)
+            layers = deconv(layers, ndim, ndim, 3, 1, 1, self.flag_leaky, self.flag_bn, self.flag_wn, self.flag_pixelwise, initializer=self.initializer, fused=self.flag_fused)
         return  nn.Sequential(*layers), ndim, layer_name
     
     def to_rgb_block(self, c_in):
         layers = []
-        layers = deconv(layers, c_in, self.nc, 1, 1, 0, self.flag_leaky, self.flag_bn, self.flag_wn, self.flag_pixelwise, only=True)
+        layers = deconv(layers, c_in, self.nc, 1, 1, 0, self.flag_leaky, self.flag_bn, self.flag_wn, self.flag_pixelwise, only=True, initializer=self.initializer)
         if self.flag_tanh:  layers.append(nn.Tanh())
         return nn.Sequential(*layers)
 
     def get_init_gen(self):
+        return self.get_gen(2, False)
+
+    def get_gen(self, resl, fadein):
         model = nn.Sequential()
         first_block, ndim = self.first_block()
         model.add_module('first_block', first_block)
-        model.add_module('to_rgb_block', self.to_rgb_block(ndim))
+        n_flushed = resl-1 if fadein else resl
+        for r in range(3, n_flushed+1):
+            inter_block, ndim, self.layer_name = self.intermediate_block(r)
+            model.add_module(self.layer_name, named_sequential('high_resl_block', inter_block))
+        if n_flushed == 2:
+            to_rgb = self.to_rgb_block(ndim)
+        else:
+            to_rgb = named_sequential('high_resl_to_rgb', self.to_rgb_block(ndim))
+
+        if fadein:
+            prev_block = nn.Sequential()
+            prev_block.add_module('low_resl_upsample', nn.Upsample(scale_factor=2, mode='nearest'))
+            prev_block.add_module('low_resl_to_rgb', named_sequential('to_rgb_block', to_rgb))
+
+            inter_block, ndim, self.layer_name = self.intermediate_block(resl)
+            next_block = nn.Sequential()
+            next_block.add_module('high_resl_block', inter_block)
+            next_block.add_module('high_resl_to_rgb', self.to_rgb_block(ndim))
+
+            model.add_module('concat_block', ConcatTable(prev_block, next_block))
+            model.add_module('fadein_block', fadein_layer(self.config))
+            model.concat_block.bind(model.fadein_block)
+        else:
+            model.add_module('to_rgb_block', to_rgb)
         self.module_names = get_module_names(model)
         return model
     
@@ -146,6 +203,7 @@ class Generator(nn.Module):
 
             new_model.add_module('concat_block', ConcatTable(prev_block, next_block))
             new_model.add_module('fadein_block', fadein_layer(self.config))
+            new_model.concat_block.bind(new_model.fadein_block)
             self.model = None
             self.model = new_model
             self.module_names = get_module_names(self.model)
@@ -183,7 +241,8 @@ class Generator(nn.Module):
 
 
 class Discriminator(nn.Module):
-    def __init__(self, config):
+    # resl, fadein and init work as in Generator.
+    def __init__(self, config, resl=2, fadein=False, init=True):
         super(Discriminator, self).__init__()
         self.config = config
         self.flag_bn = config.flag_bn
@@ -194,18 +253,21 @@ class Discriminator(nn.Module):
         self.nz = config.nz
         self.nc = config.nc
         self.ndf = config.ndf
+        self.initializer = 'kaiming' if init else None
         self.layer_name = None
         self.module_names = []
-        self.model = self.get_init_dis()
+        self.model = self.get_dis(int(resl), fadein)
+        self.initializer = 'kaiming'         # blocks added later by grow_network() are always initialized.
 
     def last_block(self):
         # add minibatch_std_concat_layer later.
         ndim = self.ndf
         layers = []
-        layers.append(minibatch_std_concat_layer())
-        layers = conv(layers, ndim+1, ndim, 3, 1, 1, self.flag_leaky, self.flag_bn, self.flag_wn, pixel=False)
-        layers = conv(layers, ndim, ndim, 4, 1, 0, self.flag_leaky, self.flag_bn, self.flag_wn, pixel=False)
-        layers = linear(layers, ndim, 1, sig=self.flag_sigmoid, wn=self.flag_wn)
+        mbstd = minibatch_std_concat_layer(self.config.minibatch_std, channels=ndim)
+        layers.append(mbstd)
+        layers = conv(layers, mbstd.out_channels(ndim), ndim, 3, 1, 1, self.flag_leaky, self.flag_bn, self.flag_wn, pixel=False, initializer=self.initializer)
+        layers = conv(layers, ndim, ndim, 4, 1, 0, self.flag_leaky, self.flag_bn, self.flag_wn, pixel=False, initializer=self.initializer)
+        layers = linear(layers, ndim, 1, sig=self.flag_sigmoid, wn=self.flag_wn, initializer=self.initializer)
         return  nn.Sequential(*layers), ndim
     
     def intermediate_block(self, resl):
@@ -222,24 +284,53 @@ class Discriminator(nn.Module):
         ndim = int(ndim)
         layers = []
         if halving:
-            layers = conv(layers, ndim, ndim, 3, 1, 1, self.flag_leaky, self.flag_bn, self.flag_wn, pixel=False)
-            layers = conv(layers, ndim, ndim*2, 3, 1, 1, self.flag_leaky, self.flag_bn, self.flag_wn, pixel=False)
+            layers = conv(layers, ndim, ndim, 3, 1, 1, self.flag_leaky, self.flag_bn, self.flag_wn, pixel=False, initializer=self.initializer)
+            layers = conv(layers, ndim, ndim*2, 3, 1, 1, self.flag_leaky, self.flag_bn, self.flag_wn, pixel=False, initializer=self.initializer)
         else:
-            layers = conv(layers, ndim, ndim, 3, 1, 1, self.flag_leaky, self.flag_bn, self.flag_wn, pixel=False)
-            layers = conv(layers, ndim, ndim, 3, 1, 1, self.flag_leaky, self.flag_bn, self.flag_wn, pixel=False)
+            layers = conv(layers, ndim, ndim, 3, 1, 1, self.flag_leaky, self.flag_bn, self.flag_wn, pixel=False, initializer=self.initializer)
+            layers = conv(layers, ndim, ndim, 3, 1, 1, self.flag_leaky, self.flag_bn, self.flag_wn, pixel=False, initializer=self.initializer)
         
         layers.append(nn.AvgPool2d(kernel_size=2))       # scale up by factor of 2.0
         return  nn.Sequential(*layers), ndim, layer_name
     
     def from_rgb_block(self, ndim):
         layers = []
-        layers = conv(layers, self.nc, ndim, 1, 1, 0, self.flag_leaky, self.flag_bn, self.flag_wn, pixel=False)
+        layers = conv(layers, self.nc, ndim, 1, 1, 0, self.flag_leaky, self.flag_bn, self.flag_wn, pixel=False, initializer=self.initializer)
         return  nn.Sequential(*layers)
     
     def get_init_dis(self):
-        model = nn.Sequential()
+        return self.get_dis(2, False)
+
+    def get_dis(self, resl, fadein):
         last_block, ndim = self.last_block()
-        model.add_module('from_rgb_block', self.from_rgb_block(ndim))
+        n_flushed = resl-1 if fadein else resl
+        inter_blocks = []
+        for r in range(3, n_flushed+1):
+            inter_block, ndim, self.layer_name = self.intermediate_block(r)
+            inter_blocks.append((self.layer_name, named_sequential('high_resl_block', inter_block)))
+        if n_flushed == 2:
+            from_rgb = self.from_rgb_block(ndim)
+        else:
+            from_rgb = named_sequential('high_resl_from_rgb', self.from_rgb_block(ndim))
+
+        model = nn.Sequential()
+        if fadein:
+            prev_block = nn.Sequential()
+            prev_block.add_module('low_resl_downsample', nn.AvgPool2d(kernel_size=2))
+            prev_block.add_module('low_resl_from_rgb', named_sequential('from_rgb_block', from_rgb))
+
+            inter_block, ndim, self.layer_name = self.intermediate_block(resl)
+            next_block = nn.Sequential()
+            next_block.add_module('high_resl_from_rgb', self.from_rgb_block(ndim))
+            next_block.add_module('high_resl_block', inter_block)
+
+            model.add_module('concat_block', ConcatTable(prev_block, next_block))
+            model.add_module('fadein_block', fadein_layer(self.config))
+            model.concat_block.bind(model.fadein_block)
+        else:
+            model.add_module('from_rgb_block', from_rgb)
+        for name, block in reversed(inter_blocks):      # highest resolution first.
+            model.add_module(name, block)
         model.add_module('last_block', last_block)
         self.module_names = get_module_names(model)
         return model
@@ -262,6 +353,7 @@ class Discriminator(nn.Module):
             new_model = nn.Sequential()
             new_model.add_module('concat_block', ConcatTable(prev_block, next_block))
             new_model.add_module('fadein_block', fadein_layer(self.config))
+            new_model.concat_block.bind(new_model.fadein_block)
 
             # we make new network since pytorch does not support remove_module()
             names = get_module_names(self.model)
@@ -0,0 +1,341 @@
+""" profiler.py
+module-level latency profile of the Generator and Discriminator.
+
+profiled modules: every top-level block from network.get_module_names() (first_block,
+intermediate_AxA_BxB, to_rgb_block, concat_block, ...), both branches of a fade-in ConcatTable
+(concat_block.layer1: low resolution path, concat_block.layer2: new block) and every
+minibatch_std_concat_layer. times are inclusive, so a branch is also part of its concat_block.
+  + forward: forward pre-hook --> forward hook.
+  + backward: the summed run time of the autograd nodes the module's forward created (between its
+    output and the grad_fn of its input), so parallel fade-in branches are timed separately no
+    matter in which order the engine runs them.
+  + flops: 2 * MACs of the conv / linear layers inside the module (forward); backward ~= 2x forward.
+on GPUs, timestamps are CUDA events and are resolved once at the end of a window.
+
+in training (--profile_iters N, 0: off) a window of N iterations is profiled in every
+(resolution, phase) stage after --profile_warmup iterations of that stage. hooks exist only
+inside a window. every window writes <out_dir>/profile/R{resl}_{phase}.txt (table sorted by total
+time) and .json (Chrome trace: chrome://tracing or ui.perfetto.dev).
+
+standalone (synthetic batches, one training step per iteration):
+    python -m rgen.profiler --resl 6 --fadein True --batch 16 --iters 20 --nz 512 --ngf 512 --ndf 512
+"""
+import os
+import json
+import time
+import argparse
+import threading
+from math import floor
+import torch
+import torch.nn as nn
+from .network import get_module_names
+from .custom_layers import ConcatTable, minibatch_std_concat_layer, equalized_conv2d, equalized_linear
+
+
+def profiled_modules(net, prefix):
+    # [(name, module)]: top-level blocks, fade-in branches, minibatch-std layers.
+    out = []
+    blocks = dict(net.model.named_children())
+    for name in get_module_names(net.model):
+        m = blocks[name]
+        out.append(('{}/{}'.format(prefix, name), m))
+        if isinstance(m, ConcatTable):
+            out += [('{}/{}.layer1'.format(prefix, name), m.layer1), ('{}/{}.layer2'.format(prefix, name), m.layer2)]
+    for name, m in net.model.named_modules():
+        if isinstance(m, minibatch_std_concat_layer):
+            out.append(('{}/{}'.format(prefix, name), m))
+    return out
+
+
+def flop_modules(net):
+    # layers whose flops are counted; the nn.Conv2d / nn.Linear inside equalized layers are skipped
+    # (the fused layer calls F.conv2d with their weight directly).
+    inner = set()
+    for m in net.modules():
+        if isinstance(m, equalized_conv2d):
+            inner.add(id(m.conv))
+        elif isinstance(m, equalized_linear):
+            inner.add(id(m.linear))
+    return [m for m in net.modules() if isinstance(m, (equalized_conv2d, equalized_linear, nn.Conv2d, nn.ConvTranspose2d, nn.Linear))
+            and id(m) not in inner]
+
+
+def layer_flops(m, inputs, output):
+    if isinstance(m, equalized_conv2d):
+        m = m.conv
+    elif isinstance(m, equalized_linear):
+        m = m.linear
+    if isinstance(m, nn.Linear):
+        return 2 * output.numel() * m.in_features
+    if isinstance(m, nn.ConvTranspose2d):
+        return 2 * inputs[0].numel() * m.out_channels * m.kernel_size[0] * m.kernel_size[1] // m.groups
+    return 2 * output.numel() * (m.in_channels // m.groups) * m.kernel_size[0] * m.kernel_size[1]
+
+
+def tensors(x):
+    if torch.is_tensor(x):
+        return [x]
+    if isinstance(x, (list, tuple)):
+        return [t for v in x for t in tensors(v)]
+    return []
+
+
+def backward_nodes(roots, stops):
+    # autograd nodes reachable from roots, stopping at stops (the grad_fn of the module inputs) and
+    # at parameter leaves (AccumulateGrad nodes are shared by every call of a network).
+    seen, nodes, todo = set(), [], [r for r in roots if r is not None]
+    while len(todo) > 0:
+        node = todo.pop()
+        if id(node) in seen or id(node) in stops or type(node).__name__ == 'AccumulateGrad':
+            continue
+        seen.add(id(node))
+        nodes.append(node)
+        todo.extend(f for f, _ in node.next_functions if f is not None)
+    return nodes
+
+
+class module_profiler:
+    '''
+    hooks G / D while attached; every forward and backward call becomes one record.
+    a backward record times each autograd node the module's forward created, so its busy time does
+    not depend on the order the engine runs parallel branches in.
+    '''
+    def __init__(self, cuda=False):
+        self.cuda = cuda
+        self.handles = []
+        self.local = threading.local()          # .stack: this thread's open forward calls, [name, start, flops]
+        self.records = []           # [name, 'forward', start, end, flops] / [name, 'backward', [[pre, post] per node], flops]
+        self.base = None
+
+    def stamp(self):
+        if self.cuda:
+            e = torch.cuda.Event(enable_timing=True)
+            e.record()
+            return e
+        return time.perf_counter()
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def attach(self, nets):
+        ''' nets: {'G': G, 'D': D} (the modules holding .model). '''
+        self.detach()
+        self.base = self.stamp()
+        for prefix, net in nets.items():
+            for name, m in profiled_modules(net, prefix):
+                self.handles.append(m.register_forward_pre_hook(self.forward_pre_hook(name)))
+                self.handles.append(m.register_forward_hook(self.forward_hook(name)))
+            for m in flop_modules(net):
+                self.handles.append(m.register_forward_hook(self.flop_hook))
+
+    def detach(self):
+        for h in self.handles:
+            h.remove()
+        self.handles = []
+        self.local = threading.local()
+
+    def forward_pre_hook(self, name):
+        def hook(module, inputs):
+            self.stack().append([name, self.stamp(), 0])
+        return hook
+
+    def forward_hook(self, name):
+        def hook(module, inputs, output):
+            stack = self.stack()
+            if name not in [entry[0] for entry in stack]:
+                return
+            while stack[-1][0] != name:
+                stack.pop()         # left open by a forward that raised.
+            _, start, flops = stack.pop()
+            self.records.append([name, 'forward', start, self.stamp(), flops])
+            if not torch.is_grad_enabled():
+                return
+            stops = set(id(t.grad_fn) for t in tensors(inputs) if t.grad_fn is not None)
+            nodes = backward_nodes([t.grad_fn for t in tensors(output)], stops)
+            if len(nodes) == 0:
+                return
+            timings = []
+            for node in nodes:
+                timing = [None, None]
+                timings.append(timing)
+                node.register_prehook(lambda grad_outputs, timing=timing: timing.__setitem__(0, self.stamp()))
+                node.register_hook(lambda grad_inputs, grad_outputs, timing=timing: timing.__setitem__(1, self.stamp()))
+            self.records.append([name, 'backward', timings, 2 * flops])
+        return hook
+
+    def flop_hook(self, module, inputs, output):
+        stack = self.stack()
+        if len(stack) > 0:
+            flops = layer_flops(module, inputs, output)
+            for entry in stack:
+                entry[2] = entry[2] + flops
+
+    def seconds(self, s):
+        if self.cuda:
+            return self.base.elapsed_time(s) / 1000.0
+        return s - self.base
+
+    def collect(self):
+        '''
+        [(name, kind, start_s, end_s, busy_s, flops)] of all finished calls; clears the records.
+        backward start / end span the module's first and last node, busy is the sum over its nodes.
+        '''
+        if self.cuda:
+            torch.cuda.synchronize()
+        done = []
+        for record in self.records:
+            if record[1] == 'forward':
+                name, kind, a, b, flops = record
+                a, b = self.seconds(a), self.seconds(b)
+                done.append((name, kind, a, b, b - a, flops))
+                continue
+            name, kind, timings, flops = record
+            spans = [(self.seconds(a), self.seconds(b)) for a, b in timings if a is not None and b is not None]
+            if len(spans) > 0:
+                done.append((name, kind, min(a for a, _ in spans), max(b for _, b in spans), sum(b - a for a, b in spans), flops))
+        self.records = []
+        return done
+
+
+def summarize(records, n_iters):
+    ''' per-module rows sorted by total busy time: [name, calls, fwd ms, bwd ms, total ms/iter, GFLOP/iter, GFLOP/s]. '''
+    stats = {}
+    for name, kind, start, end, busy, flops in records:
+        s = stats.setdefault(name, {'calls': 0, 'forward': 0.0, 'backward': 0.0, 'flops': 0})
+        s[kind] = s[kind] + busy
+        s['flops'] = s['flops'] + flops
+        if kind == 'forward':
+            s['calls'] = s['calls'] + 1
+    rows = []
+    for name, s in sorted(stats.items(), key=lambda kv: -(kv[1]['forward'] + kv[1]['backward'])):
+        total = s['forward'] + s['backward']
+        rows.append([name, s['calls'] // max(n_iters, 1), '{:.3f}'.format(1000 * s['forward'] / n_iters),
+                     '{:.3f}'.format(1000 * s['backward'] / n_iters), '{:.3f}'.format(1000 * total / n_iters),
+                     '{:.3f}'.format(s['flops'] / 1e9 / n_iters), '{:.1f}'.format(s['flops'] / 1e9 / total) if total > 0 else '-'])
+    return ['module', 'calls/iter', 'fwd ms', 'bwd ms', 'total ms', 'GFLOP', 'GFLOP/s'], rows
+
+
+def chrome_trace(records):
+    # trace event format: one row per network and direction.
+    tids = {}
+    events = []
+    for name, kind, start, end, busy, flops in records:
+        tid = tids.setdefault('{} {}'.format(name.split('/')[0], kind), len(tids) + 1)
+        events.append({'name': name, 'cat': kind, 'ph': 'X', 'pid': 1, 'tid': tid, 'ts': start * 1e6,
+                       'dur': max(end - start, 0.0) * 1e6, 'args': {'busy_ms': busy * 1e3, 'gflop': flops / 1e9}})
+    for label, tid in tids.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': label}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_profile(path, records, n_iters, title=''):
+    from .benchmark import print_table
+    import io
+    import contextlib
+    header, rows = summarize(records, n_iters)
+    buf = io.StringIO()
+    with contextlib.redirect_stdout(buf):
+        print(title)
+        print_table(header, rows)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.txt', 'w') as f:
+        f.write(buf.getvalue())
+    with open(path + '.json', 'w') as f:
+        json.dump(chrome_trace(records), f)
+    return buf.getvalue()
+
+
+class stage_profiler:
+    ''' profiles n_iters iterations of every (resolution, phase) stage after warmup iterations in it. '''
+    def __init__(self, path, n_iters=20, warmup=10, cuda=False):
+        self.path = path
+        self.n_iters = n_iters
+        self.warmup = warmup
+        self.profiler = module_profiler(cuda)
+        self.stage = None
+        self.count = 0
+        self.done = set()
+
+    def begin(self, trainer):
+        ''' call before the forward passes of an iteration. '''
+        stage = (min(floor(trainer.resl), trainer.max_resl), trainer.phase)
+        if stage != self.stage:
+            if len(self.profiler.handles) > 0:
+                self.finish()           # the stage ended inside the window.
+            self.stage = stage
+            self.count = 0
+        self.count = self.count + 1
+        if self.count == self.warmup + 1 and stage not in self.done:
+            self.profiler.attach({'G': trainer.G.module, 'D': trainer.D.module})
+            self.start_iter = self.count
+
+    def end(self, trainer):
+        ''' call after the optimizer steps of an iteration. '''
+        if len(self.profiler.handles) > 0 and self.count - self.start_iter + 1 >= self.n_iters:
+            self.finish()
+
+    def finish(self):
+        records = self.profiler.collect()
+        self.profiler.detach()
+        n = self.count - self.start_iter + 1
+        resl, phase = self.stage
+        self.done.add(self.stage)
+        text = write_profile(os.path.join(self.path, 'R{}_{}'.format(resl, phase)), records, n,
+                             '[profile] {}px {} ({} iterations)'.format(int(pow(2, resl)), phase, n))
+        print(text)
+
+    def close(self):
+        ''' writes a window that training ended in. '''
+        if len(self.profiler.handles) > 0:
+            self.finish()
+
+
+if __name__ == '__main__':
+    from .config import config
+    from . import network as net
+
+    parser = argparse.ArgumentParser('PGGAN module profiler')
+    parser.add_argument('--resl', type=int, default=5)
+    parser.add_argument('--fadein', type=bool, default=False)         # profile a mid-transition structure.
+    parser.add_argument('--batch', type=int, default=16)
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--out', type=str, default='repo/profile/standalone')   # writes <out>.txt and <out>.json
+    args, _ = parser.parse_known_args()
+    if config.num_threads > 0:
+        torch.set_num_threads(config.num_threads)
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    G = net.Generator(config, resl=args.resl, fadein=args.fadein).to(device)
+    D = net.Discriminator(config, resl=args.resl, fadein=args.fadein).to(device)
+    if args.fadein:
+        G.model.fadein_block.alpha = D.model.fadein_block.alpha = 0.5
+    imsize = int(pow(2, args.resl))
+    mse = nn.MSELoss()
+    x = torch.rand(args.batch, config.nc, imsize, imsize, device=device).mul_(2).sub_(1)
+    z = torch.randn(args.batch, config.nz, device=device)
+    real, fake = torch.ones(args.batch, device=device), torch.zeros(args.batch, device=device)
+
+    def train_step():
+        # the trainer's losses, without optimizer updates.
+        x_tilde = G(z)
+        loss_d = mse(D(x).squeeze(), real) + mse(D(x_tilde.detach()).squeeze(), fake)
+        loss_d.backward()
+        loss_g = mse(D(x_tilde).squeeze(), real)
+        loss_g.backward()
+
+    for _ in range(args.warmup):
+        train_step()
+    prof = module_profiler(device == 'cuda')
+    prof.attach({'G': G, 'D': D})
+    start = time.time()
+    for _ in range(args.iters):
+        train_step()
+    records = prof.collect()
+    wall = (time.time() - start) / args.iters
+    prof.detach()
+    print(write_profile(args.out, records, args.iters, '[profile] {}px{} batch {}: {:.1f} ms/iter (profiled)'.format(
+        imsize, ' fade-in' if args.fadein else '', args.batch, 1000 * wall)))
+    print('[profile] trace --> {}.json'.format(args.out))
@@ -0,0 +1,272 @@
+""" project.py
+projects real images into the latent space of a trained Generator (GAN inversion).
+
+many targets are optimized together as one batch: --slots targets at a time, each with --restarts
+random starting latents in the same batch (restart r of target i starts from latent_sampler sample
+i * restarts + r, so results do not depend on batching). the loss of every row is
+    mean squared pixel error + --feature_weight * mean squared feature error
+(features of a local extractor, --feature_model: a TorchScript module or an inception_v3 state_dict,
+as for fid). the latents are updated with Adam kept per row, so rows do not interact.
+a target stops when its best restart has not improved by --tol (relative) for --patience steps, or
+after --max_steps; its rows are then refilled with the next target, so the batch stays full.
+
+output (--out_dir), indexed by the position of the target in [--start, --stop) of the image folder:
+  + latents.npy   [N, nz] float32, the best latent of each target.
+  + index.tsv     row, dataset index, image path, loss, psnr (dB, pixel error only), steps, restart.
+  + meta.json     settings; a run with the same out_dir and settings skips finished targets.
+
+usage: python -m rgen.project --checkpoint repo/model/ckpt_R8_T6000.pth --targets /data/retina --stop 1000 --out_dir repo/projection
+"""
+import os
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+from .sampling import latent_sampler
+
+
+class row_adam:
+    ''' Adam over the rows of a [M, nz] latent batch, each row with its own step count. '''
+    def __init__(self, lr=0.05, betas=(0.9, 0.999), eps=1e-8):
+        self.lr = lr
+        self.betas = betas
+        self.eps = eps
+
+    def init(self, z):
+        return {'m': torch.zeros_like(z), 'v': torch.zeros_like(z), 't': torch.zeros(z.size(0), 1, device=z.device)}
+
+    def step(self, z, grad, state):
+        b1, b2 = self.betas
+        state['t'].add_(1)
+        state['m'].mul_(b1).add_(grad, alpha=1 - b1)
+        state['v'].mul_(b2).addcmul_(grad, grad, value=1 - b2)
+        m_hat = state['m'] / (1 - b1 ** state['t'])
+        v_hat = state['v'] / (1 - b2 ** state['t'])
+        return z - self.lr * m_hat / (v_hat.sqrt() + self.eps)
+
+
+def psnr(mse):
+    # images in [-1, 1] (peak-to-peak 2).
+    return 10 * np.log10(4.0 / max(mse, 1e-12))
+
+
+class projector:
+    '''
+    G: Generator (eval mode). feature_net: None or a module taking [-1, 1] images at feature_size.
+    run(targets) consumes (key, index, image [C, H, W] in [-1, 1]) triples (index seeds the restarts)
+    and yields one result dict per target, in the order targets finish:
+    {'key', 'z', 'loss', 'pixel', 'steps', 'restart'}.
+    '''
+    def __init__(self, G, nz, slots=16, restarts=4, lr=0.05, max_steps=500, patience=50, tol=1e-3,
+                 feature_net=None, feature_weight=0.0, feature_size=299, seed=0):
+        self.G = G
+        self.nz = nz
+        self.slots = slots
+        self.restarts = restarts
+        self.adam = row_adam(lr)
+        self.max_steps = max_steps
+        self.patience = patience
+        self.tol = tol
+        self.feature_net = feature_net if feature_weight > 0 else None
+        self.feature_weight = feature_weight
+        self.feature_size = feature_size
+        self.sampler = latent_sampler(nz, seed)
+        self.device = next(G.parameters()).device
+        self.steps = 0              # batch steps run so far.
+        self.rows = 0               # latent rows updated so far.
+
+    def features(self, x):
+        x = F.interpolate(x, size=(self.feature_size, self.feature_size), mode='bilinear', align_corners=False)
+        return self.feature_net(x).flatten(1)
+
+    def losses(self, z, x, fx):
+        # per-row (total, pixel) losses.
+        y = self.G(z)
+        pixel = (y - x).pow(2).mean(dim=(1, 2, 3))
+        if self.feature_net is None:
+            return pixel, pixel
+        return pixel + self.feature_weight * (self.features(y) - fx).pow(2).mean(dim=1), pixel
+
+    def new_rows(self, index, image):
+        # the restarts of one target: latents, repeated target image (and its features).
+        R = self.restarts
+        z = self.sampler([index * R + r for r in range(R)]).to(self.device)
+        x = image.to(self.device).unsqueeze(0).expand(R, -1, -1, -1)
+        fx = None
+        if self.feature_net is not None:
+            with torch.no_grad():
+                fx = self.features(x[:1]).expand(R, -1)
+        return z, x, fx
+
+    def run(self, targets):
+        targets = iter(targets)
+        R = self.restarts
+        z = x = fx = state = None
+        best_loss = best_pixel = best_z = None
+        owners = []                 # per target slot: {'key', 'steps', 'best', 'last'}
+        exhausted = False
+        while True:
+            # refill free slots.
+            new = []
+            while not exhausted and len(owners) + len(new) < self.slots:
+                try:
+                    key, index, image = next(targets)
+                except StopIteration:
+                    exhausted = True
+                    break
+                new.append((key, self.new_rows(index, image)))
+            if len(new) > 0:
+                nz_ = torch.cat([rows[0] for _, rows in new])
+                nx = torch.cat([rows[1] for _, rows in new])
+                nfx = torch.cat([rows[2] for _, rows in new]) if self.feature_net is not None else None
+                ns = self.adam.init(nz_)
+                cat = lambda a, b: b if a is None else torch.cat([a, b])
+                z, x, fx = cat(z, nz_), cat(x, nx), cat(fx, nfx)
+                state = ns if state is None else {k: torch.cat([state[k], ns[k]]) for k in state}
+                best_loss = cat(best_loss, torch.full((len(nz_),), float('inf'), device=self.device))
+                best_pixel = cat(best_pixel, torch.full((len(nz_),), float('inf'), device=self.device))
+                best_z = cat(best_z, nz_.clone())
+                owners += [{'key': key, 'steps': 0, 'best': float('inf'), 'last': 0} for key, _ in new]
+            if len(owners) == 0:
+                return
+
+            # one Adam step for every row.
+            z = z.detach().requires_grad_(True)
+            loss, pixel = self.losses(z, x, fx)
+            grad, = torch.autograd.grad(loss.sum(), z)
+            with torch.no_grad():
+                loss, pixel = loss.detach(), pixel.detach()
+                better = loss < best_loss
+                best_loss = torch.where(better, loss, best_loss)
+                best_pixel = torch.where(better, pixel, best_pixel)
+                best_z = torch.where(better.unsqueeze(1), z.detach(), best_z)
+                z = self.adam.step(z.detach(), grad, state)
+            self.steps = self.steps + 1
+            self.rows = self.rows + len(z)
+
+            # early stopping per target (its best restart).
+            target_best = best_loss.view(-1, R).min(dim=1)[0].tolist()
+            keep = []
+            for i, owner in enumerate(owners):
+                owner['steps'] = owner['steps'] + 1
+                if target_best[i] < owner['best'] * (1 - self.tol):
+                    owner['best'] = target_best[i]
+                    owner['last'] = owner['steps']
+                if owner['steps'] - owner['last'] >= self.patience or owner['steps'] >= self.max_steps:
+                    r = int(best_loss[i * R:(i + 1) * R].argmin())
+                    yield {'key': owner['key'], 'z': best_z[i * R + r].cpu().numpy(), 'loss': best_loss[i * R + r].item(),
+                           'pixel': best_pixel[i * R + r].item(), 'steps': owner['steps'], 'restart': r}
+                else:
+                    keep.append(i)
+            if len(keep) < len(owners):
+                rows = torch.tensor([i * R + r for i in keep for r in range(R)], dtype=torch.int64, device=self.device)
+                z, x, best_loss, best_pixel, best_z = z[rows], x[rows], best_loss[rows], best_pixel[rows], best_z[rows]
+                fx = fx[rows] if fx is not None else None
+                state = {k: v[rows] for k, v in state.items()}
+                owners = [owners[i] for i in keep]
+
+
+def read_index(path):
+    # finished rows of index.tsv.
+    done = set()
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f.read().splitlines()[1:]:
+                if line.strip():
+                    done.add(int(line.split('\t')[0]))
+    return done
+
+
+if __name__ == '__main__':
+    from .config import config
+    from . import checkpoint as CK
+    from . import dataloader as DL
+    from .sampling import write_meta
+    from .metrics import uint8_resize, load_feature_extractor
+
+    parser = argparse.ArgumentParser('PGGAN latent projection')
+    parser.add_argument('--checkpoint', type=str, required=True)        # gen_*.pth.tar or ckpt_*.pth
+    parser.add_argument('--targets', type=str, required=True)           # image folder root (same layout as the training data).
+    parser.add_argument('--out_dir', type=str, default='repo/projection')
+    parser.add_argument('--start', type=int, default=0)                 # first image (dataset order).
+    parser.add_argument('--stop', type=int, default=0)                  # last image (exclusive). (0: all)
+    parser.add_argument('--slots', type=int, default=16)                # targets optimized at once.
+    parser.add_argument('--restarts', type=int, default=4)              # random starts per target.
+    parser.add_argument('--lr', type=float, default=0.05)
+    parser.add_argument('--max_steps', type=int, default=500)
+    parser.add_argument('--patience', type=int, default=50)             # steps without improvement before a target stops.
+    parser.add_argument('--tol', type=float, default=1e-3)              # relative improvement that counts.
+    parser.add_argument('--feature_model', type=str, default='')        # local feature extractor for the feature loss.
+    parser.add_argument('--feature_weight', type=float, default=0.0)    # (0: pixel loss only)
+    parser.add_argument('--feature_size', type=int, default=299)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--num_threads', type=int, default=0)           # torch intra-op threads. (0: default)
+    parser.add_argument('--log_every', type=int, default=50)            # finished targets between progress lines.
+    args, _ = parser.parse_known_args()
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    G, info = CK.load_model(args.checkpoint, 'gen', config)
+    G = G.eval().to(device)
+    for p in G.parameters():
+        p.requires_grad_(False)
+    feature_net = None
+    if args.feature_weight > 0:
+        if not args.feature_model:
+            raise SystemExit('[project] --feature_weight needs --feature_model.')
+        feature_net = load_feature_extractor(args.feature_model, device)
+        for p in feature_net.parameters():
+            p.requires_grad_(False)
+
+    imsize = G(torch.zeros(1, config.nz, device=device)).size(-1)
+    dataset = DL.image_folder(args.targets, loader=DL.draft_loader(imsize),
+                              transform=uint8_resize(imsize))
+    stop = len(dataset) if args.stop <= 0 else min(args.stop, len(dataset))
+    n = stop - args.start
+    os.makedirs(args.out_dir, exist_ok=True)
+    write_meta(args.out_dir, {'checkpoint': os.path.abspath(args.checkpoint), 'targets': os.path.abspath(args.targets),
+                              'start': args.start, 'stop': stop, 'nz': config.nz, 'imsize': imsize, 'seed': args.seed,
+                              'restarts': args.restarts, 'lr': args.lr, 'max_steps': args.max_steps, 'patience': args.patience,
+                              'tol': args.tol, 'feature_model': os.path.abspath(args.feature_model) if args.feature_model else '',
+                              'feature_weight': args.feature_weight})
+    latents_path = os.path.join(args.out_dir, 'latents.npy')
+    mode = 'r+' if os.path.exists(latents_path) else 'w+'
+    latents = np.lib.format.open_memmap(latents_path, mode=mode, dtype=np.float32, shape=(n, config.nz))
+    index_path = os.path.join(args.out_dir, 'index.tsv')
+    done = read_index(index_path)
+    if not os.path.exists(index_path):
+        with open(index_path, 'w') as f:
+            f.write('\t'.join(['row', 'index', 'path', 'loss', 'psnr', 'steps', 'restart']) + '\n')
+    todo = [row for row in range(n) if row not in done]
+    print('[project] {} targets at {}px ({} done), {} slots x {} restarts.'.format(n, imsize, len(done), args.slots, args.restarts))
+
+    def targets():
+        for row in todo:
+            img, _ = dataset[args.start + row]
+            yield row, args.start + row, img.float().mul_(2.0 / 255.0).sub_(1.0)
+
+    engine = projector(G, config.nz, args.slots, args.restarts, args.lr, args.max_steps, args.patience, args.tol,
+                       feature_net, args.feature_weight, args.feature_size, args.seed)
+    start = time.time()
+    count, psnrs = 0, []
+    with open(index_path, 'a') as f:
+        for result in engine.run(targets()):
+            row = result['key']
+            latents[row] = result['z']
+            psnrs.append(psnr(result['pixel']))
+            # the latent is written before its index line, so a listed row is always complete.
+            latents.flush()
+            f.write('{}\t{}\t{}\t{:.6f}\t{:.2f}\t{}\t{}\n'.format(row, args.start + row, dataset.samples[args.start + row][0], result['loss'],
+                                                                   psnrs[-1], result['steps'], result['restart']))
+            f.flush()
+            count = count + 1
+            if count % args.log_every == 0:
+                elapsed = time.time() - start
+                print('[project] {}/{} targets, {:.1f} targets/min, mean psnr {:.2f}dB'.format(count, len(todo), 60 * count / elapsed, np.mean(psnrs[-args.log_every:])))
+    elapsed = time.time() - start
+    if count > 0:
+        print('[project] {} targets in {:.1f}s: {:.1f} targets/min on {} ({:.1f} batch steps/s, {:.0f} latent updates/s), mean psnr {:.2f}dB'.format(
+            count, elapsed, 60 * count / elapsed, device, engine.steps / elapsed, engine.rows / elapsed, np.mean(psnrs)))
+    print('[project] latents --> {}, index --> {}'.format(latents_path, index_path))
@@ -0,0 +1,168 @@
+""" quantize.py
+post-training int8 quantization of a flushed Generator for CPU inference.
+
+  + the equalized-LR scale of every equalized_conv2d is folded into a plain nn.Conv2d.
+  + runs of upsample / conv / leaky relu are quantized to int8 (eager-mode static quantization,
+    per-channel weights), calibrated on random latents.
+  + pixelwise_norm_layer (a per-pixel rms over channels) and the to_rgb block stay in float;
+    activations are dequantized before them and quantized again after.
+the generator has no linear layers; a non-equalized nn.Linear would be quantized the same way.
+reports speed, size and the image difference to the fp32 generator, and saves a TorchScript
+int8 generator.
+
+usage: python -m rgen.quantize --checkpoint repo/model/ckpt_R8_T6000.pth --out_dir repo/export
+"""
+import io
+import os
+import copy
+import time
+import argparse
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, prepare, convert
+from .custom_layers import equalized_conv2d, equalized_linear, fadein_layer, fused_conv_leaky_pixelnorm, pixelwise_norm_layer
+
+
+# layers that run on quantized tensors.
+QUANTIZABLE = (nn.Conv2d, nn.Linear, nn.LeakyReLU, nn.ReLU, nn.Upsample)
+
+
+def fold_equalized(m):
+    # equalized_conv2d / equalized_linear --> nn.Conv2d / nn.Linear with the scale folded into the weight.
+    if isinstance(m, equalized_conv2d):       # also fused_conv_leaky_pixelnorm; leaf_modules() adds its leaky / norm.
+        c = m.conv
+        layer = nn.Conv2d(c.in_channels, c.out_channels, c.kernel_size, c.stride, c.padding)
+        layer.weight.data.copy_(c.weight.data * m.scale)
+    elif isinstance(m, equalized_linear):
+        layer = nn.Linear(m.linear.in_features, m.linear.out_features)
+        layer.weight.data.copy_(m.linear.weight.data * m.scale)
+    else:
+        return copy.deepcopy(m)         # prepare() attaches observers; G itself stays untouched.
+    layer.bias.data.copy_(m.bias.data)
+    return layer
+
+
+def leaf_modules(model):
+    # layers in forward order (flushed generators are plain Sequentials); equalized layers count as one.
+    if isinstance(model, fused_conv_leaky_pixelnorm):
+        return [model, nn.LeakyReLU(model.negative_slope), pixelwise_norm_layer()]
+    if isinstance(model, nn.Identity):
+        return []                   # placeholders next to fused layers.
+    if isinstance(model, (equalized_conv2d, equalized_linear)) or len(list(model.children())) == 0:
+        return [model]
+    return [leaf for m in model.children() for leaf in leaf_modules(m)]
+
+
+class quantized_generator(nn.Module):
+    '''
+    flat float copy of a flushed Generator with QuantStub/DeQuantStub around the int8 runs.
+    call prepare(), run calibration batches, then convert().
+    '''
+    def __init__(self, G, engine='x86'):
+        super(quantized_generator, self).__init__()
+        if any(isinstance(m, fadein_layer) for m in G.model.modules()):
+            raise ValueError('only flushed generators can be quantized (the checkpoint is mid-transition).')
+        self.nz = G.nz
+        leaves = [fold_equalized(m) for m in leaf_modules(G.model)]
+        convs = [i for i, m in enumerate(leaves) if isinstance(m, nn.Conv2d)]
+        n_rgb = len(leaves) - convs[-1]           # to_rgb: the last conv (and tanh) stay in float.
+
+        qconfig = get_default_qconfig(engine)
+        layers = []
+        quantized = False
+        for i, m in enumerate(leaves):
+            int8 = i < len(leaves) - n_rgb and isinstance(m, QUANTIZABLE)
+            if int8 and not quantized:
+                layers.append(QuantStub(qconfig))
+            elif not int8 and quantized:
+                layers.append(DeQuantStub(qconfig))
+            quantized = int8
+            m.qconfig = qconfig if int8 else None
+            layers.append(m)
+        self.model = nn.Sequential(*layers)
+
+    def forward(self, z):
+        return self.model(z.view(z.size(0), -1, 1, 1))
+
+
+def quantize_generator(G, n_calib=128, batch_size=32, engine='x86', seed=0):
+    ''' returns the int8 generator of a flushed (eval-mode) G, calibrated on n_calib random latents. '''
+    torch.backends.quantized.engine = engine
+    model = quantized_generator(G, engine).eval()
+    prepare(model, inplace=True)
+    generator = torch.Generator().manual_seed(seed)
+    with torch.no_grad():
+        for start in range(0, n_calib, batch_size):
+            model(torch.randn(min(batch_size, n_calib - start), G.nz, generator=generator, device='cpu'))
+    return convert(model)
+
+
+def model_bytes(model):
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell()
+
+
+def throughput(model, nz, batch_size, n_iter=5):
+    z = torch.randn(batch_size, nz)
+    with torch.no_grad():
+        model(z)                # warm-up.
+        start = time.time()
+        for _ in range(n_iter):
+            model(z)
+    return batch_size * n_iter / (time.time() - start)
+
+
+def quality(G, Gq, nz, n_images=64, batch_size=32, seed=1):
+    ''' mean abs difference and psnr (images in [-1, 1]) of the int8 generator against fp32. '''
+    generator = torch.Generator().manual_seed(seed)
+    sq_err, abs_err, n = 0.0, 0.0, 0
+    with torch.no_grad():
+        for start in range(0, n_images, batch_size):
+            z = torch.randn(min(batch_size, n_images - start), nz, generator=generator, device='cpu')
+            x, xq = G(z).clamp(-1, 1), Gq(z).clamp(-1, 1)
+            sq_err = sq_err + (x - xq).pow(2).sum().item()
+            abs_err = abs_err + (x - xq).abs().sum().item()
+            n = n + x.numel()
+    mse = sq_err / n
+    psnr = 10 * torch.log10(torch.tensor(4.0 / max(mse, 1e-12))).item()        # peak-to-peak range is 2.
+    return abs_err / n, psnr
+
+
+if __name__ == '__main__':
+    from math import floor
+    from .config import config
+    from . import checkpoint as CK
+    from .benchmark import print_table
+
+    parser = argparse.ArgumentParser('PGGAN int8 quantization')
+    parser.add_argument('--checkpoint', type=str, required=True)        # gen_*.pth.tar or ckpt_*.pth (flushed).
+    parser.add_argument('--out_dir', type=str, default='repo/export')
+    parser.add_argument('--engine', type=str, default='x86')            # quantized backend: x86, fbgemm, qnnpack, onednn.
+    parser.add_argument('--n_calib', type=int, default=128)             # calibration latents.
+    parser.add_argument('--batch_sizes', type=str, default='1,16')      # benchmark batch sizes.
+    parser.add_argument('--num_threads', type=int, default=0)           # torch intra-op threads. (0: default)
+    args, _ = parser.parse_known_args()
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    G, info = CK.load_model(args.checkpoint, 'gen', config)
+    G.eval()
+    start = time.time()
+    Gq = quantize_generator(G, args.n_calib, engine=args.engine)
+    print('[quantize] calibrated on {} latents in {:.1f}s'.format(args.n_calib, time.time() - start))
+
+    rows = [['size', '{:.1f}MB'.format(model_bytes(G) / 2 ** 20), '{:.1f}MB'.format(model_bytes(Gq) / 2 ** 20),
+             '{:.2f}x'.format(model_bytes(G) / float(model_bytes(Gq)))]]
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        fp32, int8 = throughput(G, config.nz, batch_size), throughput(Gq, config.nz, batch_size)
+        rows.append(['img/s (batch {})'.format(batch_size), '{:.1f}'.format(fp32), '{:.1f}'.format(int8), '{:.2f}x'.format(int8 / fp32)])
+    print_table(['', 'fp32', 'int8', 'ratio'], rows)
+    mae, psnr = quality(G, Gq, config.nz)
+    print('[quantize] int8 vs fp32: mean abs diff {:.4f}, psnr {:.1f}dB'.format(mae, psnr))
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    path = os.path.join(args.out_dir, 'gen_R{}_T{}_int8.pt'.format(int(floor(info['resl'])), info.get('globalTick', 0)))
+    with torch.no_grad():
+        torch.jit.trace(Gq, torch.randn(2, config.nz)).save(path)
+    print('[quantize] torchscript --> {}'.format(path))
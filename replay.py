@@ -0,0 +1,87 @@
+""" replay.py
+replay pool of generated samples for the discriminator (--replay_size N samples, 0: off).
+
+every iteration the fakes of the G forward are pushed into a fixed-size ring (float16, on the
+device of the fakes), overwriting the oldest. the pool then lets D see more fakes than G produces:
+  + --replay_mix f:  a fraction f of the fakes in the D step is replaced by stored ones.
+  + --n_critic k:    k - 1 extra D updates per G update, each on a new real batch and fakes drawn
+                     from the pool (which already holds the fakes of this iteration).
+every stored sample is tagged with the iteration, resolution and phase it was generated in;
+samples older than --replay_max_age iterations are not drawn (0: no limit), and the pool is
+cleared when the networks grow (the image size changes). staleness of the drawn samples (age,
+share generated in an earlier phase) is accumulated per (resolution, phase) and reported by stats().
+the pool is not saved in checkpoints; a resumed run starts with an empty pool.
+"""
+import torch
+
+
+class replay_pool:
+    def __init__(self, size, max_age=0, seed=0):
+        self.size = size
+        self.max_age = max_age
+        self.generator = torch.Generator().manual_seed(seed)
+        self.stages = {}            # (resl, phase) --> {'drawn', 'age_sum', 'max_age', 'other_phase'}
+        self.clear()
+
+    def clear(self):
+        self.data = None
+        self.iters = torch.full((self.size,), -1, dtype=torch.int64)       # -1: empty slot.
+        self.phases = [None] * self.size
+        self.head = 0
+
+    def __len__(self):
+        return int((self.iters >= 0).sum())
+
+    def push(self, x, it, resl, phase):
+        ''' stores the rows of x (a detached fake batch) generated at iteration it. '''
+        if self.data is not None and self.data.shape[1:] != x.shape[1:]:
+            self.clear()
+        if self.data is None:
+            self.data = torch.empty((self.size,) + tuple(x.shape[1:]), dtype=torch.float16, device=x.device)
+        n = min(x.size(0), self.size)
+        slots = (self.head + torch.arange(n)) % self.size
+        self.data[slots.to(self.data.device)] = x[-n:].detach().to(torch.float16)
+        self.iters[slots] = it
+        for s in slots.tolist():
+            self.phases[s] = (resl, phase)
+        self.head = (self.head + n) % self.size
+
+    def candidates(self, it):
+        valid = self.iters >= 0
+        if self.max_age > 0:
+            valid &= (it - self.iters) <= self.max_age
+        return valid.nonzero().squeeze(1)
+
+    def draw(self, n, it, resl, phase):
+        ''' n stored fakes (with replacement), as float32; None if nothing can be drawn. '''
+        rows = self.candidates(it)
+        if len(rows) == 0 or n == 0:
+            return None
+        pick = rows[torch.randint(0, len(rows), (n,), generator=self.generator)]
+        ages = it - self.iters[pick]
+        stage = self.stages.setdefault((resl, phase), {'drawn': 0, 'age_sum': 0, 'max_age': 0, 'other_phase': 0})
+        stage['drawn'] = stage['drawn'] + n
+        stage['age_sum'] = stage['age_sum'] + int(ages.sum())
+        stage['max_age'] = max(stage['max_age'], int(ages.max()))
+        stage['other_phase'] = stage['other_phase'] + sum(1 for s in pick.tolist() if self.phases[s] != (resl, phase))
+        return self.data[pick.to(self.data.device)].float()
+
+    def mix(self, x, fraction, it, resl, phase, transform=None):
+        '''
+        x with its last round(fraction * N) rows replaced by stored fakes (x itself if there are none).
+        transform (e.g. the augmentation x went through) is applied to the stored fakes.
+        '''
+        n = int(round(fraction * x.size(0)))
+        old = self.draw(n, it, resl, phase) if n > 0 and self.data is not None and self.data.shape[1:] == x.shape[1:] else None
+        if old is None:
+            return x
+        old = old.to(x.dtype)
+        return torch.cat([x[:x.size(0) - n], old if transform is None else transform(old)])
+
+    def stats(self, resl, phase):
+        # staleness of the fakes drawn in (resl, phase) so far.
+        s = self.stages.get((resl, phase))
+        if s is None or s['drawn'] == 0:
+            return None
+        return {'drawn': s['drawn'], 'mean_age': s['age_sum'] / float(s['drawn']), 'max_age': s['max_age'],
+                'other_phase': s['other_phase'] / float(s['drawn'])}
@@ -0,0 +1,163 @@
+""" sampling.py
+reproducible sampling from a trained Generator.
+
+sample #i always gets the same latent: z_i is drawn from a Philox stream keyed by (seed, i), so
+any index range can be regenerated without touching the indices before it.
+samples are written in shards of --shard_size consecutive indices; a shard's file name is its index
+range, shards are written atomically and existing shards are skipped. processes given disjoint
+--start/--stop ranges, or the same range with different --rank/--world, never write the same shard.
+
+usage:
+    python -m rgen.sampling --checkpoint repo/model/ckpt_R8_T6000.pth --start 0 --stop 1000000 --format npy
+    python -m rgen.sampling --checkpoint repo/model/ckpt_R8_T6000.pth --stop 1000000 --rank 3 --world 8 --format png
+"""
+import os
+import json
+import shutil
+import argparse
+import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+
+class latent_sampler:
+    '''
+    maps integer sample indices to latents.
+    truncation > 0 redraws every component outside [-truncation, truncation] (from the same stream).
+    norm_latent applies the pixelwise normalization of the generator's first block to z.
+    '''
+    def __init__(self, nz, seed=0, truncation=0.0, norm_latent=False):
+        self.nz = nz
+        self.seed = seed
+        self.truncation = truncation
+        self.norm_latent = norm_latent
+
+    def latent(self, index):
+        rng = np.random.Generator(np.random.Philox(key=((self.seed & 0xffffffffffffffff) << 64) | int(index)))
+        z = rng.standard_normal(self.nz, dtype=np.float32)
+        if self.truncation > 0:
+            mask = np.abs(z) > self.truncation
+            while mask.any():
+                z[mask] = rng.standard_normal(int(mask.sum()), dtype=np.float32)
+                mask = np.abs(z) > self.truncation
+        return z
+
+    def __call__(self, indices):
+        z = torch.from_numpy(np.stack([self.latent(i) for i in indices]))
+        if self.norm_latent:
+            z = z / torch.sqrt(torch.mean(z ** 2, dim=1, keepdim=True) + 1e-8)
+        return z
+
+
+def to_uint8(x):
+    # [N, C, H, W] in [-1, 1] --> [N, H, W, C] uint8.
+    x = x.detach().float().cpu().add(1.0).mul_(127.5).round_().clamp_(0, 255)
+    return x.to(torch.uint8).permute(0, 2, 3, 1).numpy()
+
+
+def generate(G, sampler, indices, batch_size=64):
+    ''' yields (indices, uint8 images [N, H, W, C]) batch by batch. '''
+    device = next(G.parameters()).device
+    for i in range(0, len(indices), batch_size):
+        batch = indices[i:i + batch_size]
+        with torch.no_grad():
+            yield batch, to_uint8(G(sampler(batch).to(device)))
+
+
+def shard_ranges(start, stop, shard_size, rank=0, world=1):
+    # shards are aligned to multiples of shard_size, clipped to [start, stop) and dealt round-robin.
+    shards = []
+    for k in range(start // shard_size, (stop + shard_size - 1) // shard_size):
+        if k % world == rank:
+            shards.append((max(start, k * shard_size), min(stop, (k + 1) * shard_size)))
+    return shards
+
+
+def shard_name(a, b, fmt):
+    name = 'shard_{:09d}_{:09d}'.format(a, b)
+    return name + '.npy' if fmt == 'npy' else name
+
+
+def write_images(images, indices, path, fmt):
+    from PIL import Image
+    for img, index in zip(images, indices):
+        Image.fromarray(img).save(os.path.join(path, '{:09d}.{}'.format(index, fmt)))
+
+
+def write_shard(G, sampler, a, b, out_dir, fmt, batch_size, pool):
+    path = os.path.join(out_dir, shard_name(a, b, fmt))
+    tmp_path = path + '.tmp'
+    indices = list(range(a, b))
+    if fmt == 'npy':
+        shard = None
+        for batch, images in generate(G, sampler, indices, batch_size):
+            if shard is None:
+                shard = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(indices),) + images.shape[1:])
+            shard[batch[0] - a:batch[-1] - a + 1] = images
+        shard.flush()
+        del shard
+        os.replace(tmp_path, path)
+    else:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        # image encoding overlaps with generating the next batch.
+        futures = [pool.submit(write_images, images, batch, tmp_path, fmt)
+                   for batch, images in generate(G, sampler, indices, batch_size)]
+        for f in futures:
+            f.result()
+        os.rename(tmp_path, path)
+
+
+def write_meta(out_dir, meta):
+    path = os.path.join(out_dir, 'meta.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            old = json.load(f)
+        if old != meta:
+            raise ValueError('{} was sampled with different settings: {}'.format(out_dir, old))
+        return
+    with open(path + '.{}.tmp'.format(os.getpid()), 'w') as f:
+        json.dump(meta, f, indent=2, sort_keys=True)
+    os.replace(path + '.{}.tmp'.format(os.getpid()), path)
+
+
+if __name__ == '__main__':
+    import time
+    from .config import config
+    from . import checkpoint as CK
+
+    parser = argparse.ArgumentParser('PGGAN sampling')
+    parser.add_argument('--checkpoint', type=str, required=True)        # gen_*.pth.tar or ckpt_*.pth
+    parser.add_argument('--out_dir', type=str, default='repo/samples')
+    parser.add_argument('--start', type=int, default=0)                 # first sample index.
+    parser.add_argument('--stop', type=int, default=10000)              # last sample index (exclusive).
+    parser.add_argument('--shard_size', type=int, default=10000)        # samples per shard file.
+    parser.add_argument('--rank', type=int, default=0)                  # this process writes shards k with k % world == rank.
+    parser.add_argument('--world', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--truncation', type=float, default=0.0)        # resample |z| > truncation. (0: off)
+    parser.add_argument('--norm_latent', type=bool, default=False)
+    parser.add_argument('--format', type=str, default='npy', choices=['npy', 'png', 'jpg'])
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_threads', type=int, default=0)           # torch intra-op threads. (0: default)
+    parser.add_argument('--io_threads', type=int, default=4)            # image encoding threads.
+    args, _ = parser.parse_known_args()
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    G, info = CK.load_model(args.checkpoint, 'gen', config)
+    G.eval()
+    os.makedirs(args.out_dir, exist_ok=True)
+    write_meta(args.out_dir, {'checkpoint': os.path.abspath(args.checkpoint), 'seed': args.seed, 'nz': config.nz,
+                              'truncation': args.truncation, 'norm_latent': args.norm_latent, 'format': args.format,
+                              'shard_size': args.shard_size})
+    sampler = latent_sampler(config.nz, args.seed, args.truncation, args.norm_latent)
+
+    with ThreadPoolExecutor(max_workers=args.io_threads) as pool:
+        for a, b in shard_ranges(args.start, args.stop, args.shard_size, args.rank, args.world):
+            if os.path.exists(os.path.join(args.out_dir, shard_name(a, b, args.format))):
+                print('[skip] shard {}-{} exists.'.format(a, b))
+                continue
+            start = time.time()
+            write_shard(G, sampler, a, b, args.out_dir, args.format, args.batch_size, pool)
+            print('[sampling] shard {}-{}: {:.1f} img/s'.format(a, b, (b - a) / (time.time() - start)))
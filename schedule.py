@@ -0,0 +1,306 @@
+""" schedule.py
+the progressive-growing schedule of a run, computed before training.
+
+replays the resolution rules of the original per-iteration scheduler for the whole run:
+resl grows by 1 / (2 trns_tick + 2 stab_tick) every tick (TICK images), and every resolution
+passes gtrns --> gstab --> dtrns --> dstab (trns_tick / stab_tick ticks each). the result is
+  + segments: runs of iterations with the same resolution, tick, phase, batch size and learning
+    rate. fade-in alphas grow linearly inside a segment.
+  + events by iteration: flush_gen, flush_dis and grow (a grow also decays the learning rate and
+    switches to the batch size of the new resolution).
+  + n_iters: iterations of the whole run, the loop bound of trainer.train().
+the trainer reads the state of each iteration with at() (O(1), iterations are visited in order).
+a resumed run only needs globalIter to continue, and it stops where a fresh run would stop.
+
+planner: iterations, images and estimated time per (resolution, phase) stage. step costs are
+seconds per iteration per stage, timed on synthetic batches with --measure (and saved with
+--costs_out), or read back with --costs; costs scale linearly with the batch size.
+    python -m rgen.schedule --max_resl 8 --measure True --costs_out repo/step_costs.json --nz 512 --ngf 512 --ndf 512
+    python -m rgen.schedule --max_resl 9 --trns_tick 300 --batch_table '512:4' --costs repo/step_costs.json --price_per_hour 2.5
+"""
+import json
+import time
+import bisect
+import argparse
+from math import floor
+from collections import namedtuple
+
+
+BATCH_TABLE = {4:32, 8:32, 16:32, 32:16, 64:16, 128:16, 256:12, 512:3, 1024:1}  # change this according to available gpu memory.
+
+# start / end: first / one past the last iteration (globalIter). resl, tick, phase, lr: after each
+# iteration. kimgs, alpha_gen, alpha_dis: after the first iteration, growing by batchsize, d_gen and
+# d_dis per iteration (alpha None: no fade-in layer).
+segment = namedtuple('segment', ['start', 'end', 'resl', 'tick', 'phase', 'batchsize', 'lr', 'kimgs',
+                                 'alpha_gen', 'alpha_dis', 'd_gen', 'd_dis'])
+
+
+def batch_table(spec=''):
+    # BATCH_TABLE with overrides, e.g. '256:8,512:4'.
+    table = dict(BATCH_TABLE)
+    for item in spec.split(','):
+        if item.strip():
+            imsize, batchsize = item.split(':')
+            table[int(imsize)] = int(batchsize)
+    return table
+
+
+class schedule:
+    def __init__(self, config):
+        self.trns_tick = config.trns_tick
+        self.stab_tick = config.stab_tick
+        self.TICK = config.TICK
+        self.max_resl = config.max_resl
+        self.lr = config.lr
+        self.lr_decay = float(config.lr_decay)
+        self.batch_table = batch_table(config.batch_table)
+        self.segments = []
+        self.starts = []
+        self.events = {}            # globalIter --> [(event, resl)]
+        self.cursor = 0
+        self.build()
+
+    def batchsize(self, resl):
+        return int(self.batch_table[pow(2, min(floor(resl), self.max_resl))])
+
+    def build(self):
+        T, S, TICK, max_resl = self.trns_tick, self.stab_tick, self.TICK, self.max_resl
+        delta = 1.0 / (2 * T + 2 * S)
+        resl, tick, kimgs, lr, phase = 2, 0, 0, self.lr, 'init'
+        bs = self.batchsize(2)
+        alpha = {'gen': None, 'dis': None}
+        it = 0
+        for step in range(2, max_resl + 1 + 5):
+            remaining = len(range(0, (T * 2 + S * 2) * TICK, bs))
+            while remaining > 0:
+                it = it + 1
+                remaining = remaining - 1
+                d_alpha = 1.0 * bs / T / TICK
+                inc = {'gen': 0.0, 'dis': 0.0}
+
+                # fade-in and phase of the current resolution.
+                if alpha['gen'] is not None:
+                    if resl % 1.0 < T * delta:
+                        alpha['gen'] = min(alpha['gen'] + d_alpha, 1.0)
+                        inc['gen'] = d_alpha
+                        phase = 'gtrns'
+                    elif resl % 1.0 < (T + S) * delta:
+                        phase = 'gstab'
+                if alpha['dis'] is not None:
+                    if (T + S) * delta <= resl % 1.0 < (S + T * 2) * delta:
+                        alpha['dis'] = min(alpha['dis'] + d_alpha, 1.0)
+                        inc['dis'] = d_alpha
+                        phase = 'dtrns'
+                    elif resl % 1.0 >= (S + T * 2) * delta and phase != 'final':
+                        phase = 'dstab'
+
+                prev_kimgs = kimgs
+                kimgs = kimgs + bs
+                ticked = (kimgs % TICK) < (prev_kimgs % TICK)
+                if ticked:
+                    tick = tick + 1
+                    prev_resl = floor(resl)
+                    resl = max(2, min(10.5, resl + delta))
+                    if alpha['gen'] is not None and resl % 1.0 >= (T + S) * delta and prev_resl != 2:
+                        self.events.setdefault(it, []).append(('flush_gen', floor(resl)))
+                        alpha['gen'] = None
+                        phase = 'dtrns'
+                    elif alpha['dis'] is not None and floor(resl) != prev_resl and prev_resl != 2:
+                        self.events.setdefault(it, []).append(('flush_dis', floor(resl)))
+                        alpha['dis'] = None
+                        if floor(resl) < max_resl and phase != 'final':
+                            phase = 'gtrns'
+                    if floor(resl) != prev_resl and floor(resl) < max_resl + 1:
+                        self.events.setdefault(it, []).append(('grow', floor(resl)))
+                        lr = lr * self.lr_decay
+                        bs = self.batchsize(resl)
+                        alpha = {'gen': 0.0, 'dis': 0.0}
+                    if floor(resl) >= max_resl and resl % 1.0 >= (S + T * 2) * delta:
+                        phase = 'final'
+                        resl = max_resl + (S + T * 2) * delta
+                self.add(it, 1, resl, tick, phase, bs, lr, kimgs, alpha, inc)
+
+                # until the next tick, every iteration repeats the one before (same resl, so same phase).
+                if not ticked:
+                    k = min(remaining, (TICK - 1 - kimgs % TICK) // bs)
+                    if k > 0:
+                        step_alpha = lambda n: {key: None if a is None else min(a + n * inc[key], 1.0) for key, a in alpha.items()}
+                        self.add(it + 1, k, resl, tick, phase, bs, lr, kimgs + bs, step_alpha(1), inc)
+                        kimgs = kimgs + k * bs
+                        alpha = step_alpha(k)
+                        it = it + k
+                        remaining = remaining - k
+        self.n_iters = it
+        self.starts = [s.start for s in self.segments]
+
+    def add(self, it, n, resl, tick, phase, bs, lr, kimgs, alpha, inc):
+        # n iterations from it; kimgs / alpha: after the first of them.
+        last = self.segments[-1] if len(self.segments) > 0 else None
+        if last is not None and last.end == it and (last.resl, last.tick, last.phase, last.batchsize, last.lr) == (resl, tick, phase, bs, lr) \
+                and (last.alpha_gen is None) == (alpha['gen'] is None) and (last.alpha_dis is None) == (alpha['dis'] is None) \
+                and (last.d_gen, last.d_dis) == (inc['gen'], inc['dis']):
+            self.segments[-1] = last._replace(end=it + n)
+            return
+        self.segments.append(segment(it, it + n, resl, tick, phase, bs, lr, kimgs, alpha['gen'], alpha['dis'], inc['gen'], inc['dis']))
+
+    def find(self, it):
+        # index of the segment holding iteration it; sequential lookups only move the cursor.
+        seg = self.segments[self.cursor]
+        if seg.start <= it < seg.end:
+            return self.cursor
+        if self.cursor + 1 < len(self.segments) and self.segments[self.cursor + 1].start <= it < self.segments[self.cursor + 1].end:
+            self.cursor = self.cursor + 1
+        else:
+            self.cursor = min(max(bisect.bisect_right(self.starts, it) - 1, 0), len(self.segments) - 1)
+        return self.cursor
+
+    def at(self, it):
+        '''
+        state after iteration it (globalIter, 1 ... n_iters; 0: before training):
+        {'resl', 'tick', 'phase', 'kimgs', 'batchsize', 'lr', 'alpha_gen', 'alpha_dis'} (alpha None: no fade-in).
+        '''
+        if it <= 0:
+            return {'resl': 2, 'tick': 0, 'phase': 'init', 'kimgs': 0, 'batchsize': self.batchsize(2), 'lr': self.lr,
+                    'alpha_gen': None, 'alpha_dis': None}
+        seg = self.segments[self.find(min(it, self.n_iters))]
+        k = min(it, self.n_iters) - seg.start
+        alpha = lambda a, d: None if a is None else min(1.0, a + k * d)
+        return {'resl': seg.resl, 'tick': seg.tick, 'phase': seg.phase, 'kimgs': seg.kimgs + k * seg.batchsize,
+                'batchsize': seg.batchsize, 'lr': seg.lr, 'alpha_gen': alpha(seg.alpha_gen, seg.d_gen),
+                'alpha_dis': alpha(seg.alpha_dis, seg.d_dis)}
+
+    def stages(self):
+        ''' [{'resl', 'phase', 'start', 'iters', 'images', 'batchsize', 'lr'}], one per (resolution, phase, batch size) in order of first appearance. '''
+        out = {}
+        for seg in self.segments:
+            key = (min(floor(seg.resl), self.max_resl), seg.phase, seg.batchsize)
+            if key not in out:
+                out[key] = {'resl': key[0], 'phase': seg.phase, 'start': seg.start, 'iters': 0, 'images': 0, 'batchsize': seg.batchsize, 'lr': seg.lr}
+            out[key]['iters'] = out[key]['iters'] + seg.end - seg.start
+            out[key]['images'] = out[key]['images'] + (seg.end - seg.start) * seg.batchsize
+        return list(out.values())
+
+
+# (G fade-in alpha, D fade-in alpha) of the structure trained in each phase; None: flushed.
+PHASE_STRUCTURE = {'init': (None, None), 'gtrns': (0.5, 0.0), 'gstab': (1.0, 0.0), 'dtrns': (None, 0.5),
+                   'dstab': (None, 1.0), 'final': (None, 1.0)}
+
+
+def measure_costs(config, table, resls, phases, n_iter=5):
+    ''' {'R{resl}_{phase}': [seconds per iteration, batch size]} of a synthetic train step (forward, backward, Adam). '''
+    import torch
+    import torch.nn as nn
+    from torch.optim import Adam
+    from . import network as net
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    mse = nn.MSELoss()
+    costs = {}
+    for resl in resls:
+        for phase in phases:
+            if (resl == 2) != (phase == 'init') or phase == 'final':
+                continue
+            g_alpha, d_alpha = PHASE_STRUCTURE[phase]
+            bs = int(table[pow(2, resl)])
+            G = net.Generator(config, resl=resl, fadein=g_alpha is not None).to(device)
+            D = net.Discriminator(config, resl=resl, fadein=d_alpha is not None).to(device)
+            for m, alpha in [(G, g_alpha), (D, d_alpha)]:
+                if alpha is not None:
+                    m.model.fadein_block.alpha = alpha
+            opt_g = Adam(G.parameters(), lr=config.lr, betas=(config.beta1, config.beta2))
+            opt_d = Adam(D.parameters(), lr=config.lr, betas=(config.beta1, config.beta2))
+            imsize = int(pow(2, resl))
+            x = torch.rand(bs, config.nc, imsize, imsize, device=device).mul_(2).sub_(1)
+            real, fake = torch.ones(bs, device=device), torch.zeros(bs, device=device)
+
+            def step():
+                # the trainer's updates on synthetic data.
+                G.zero_grad()
+                D.zero_grad()
+                x_tilde = G(torch.randn(bs, config.nz, device=device))
+                loss_d = mse(D(x).squeeze(), real) + mse(D(x_tilde.detach()).squeeze(), fake)
+                loss_d.backward()
+                opt_d.step()
+                loss_g = mse(D(x_tilde).squeeze(), real)
+                loss_g.backward()
+                opt_g.step()
+
+            step()
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            start = time.time()
+            for _ in range(n_iter):
+                step()
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            costs['R{}_{}'.format(resl, phase)] = [(time.time() - start) / n_iter, bs]
+            print('[schedule] {}px {}: {:.1f} ms/iter at batch {}'.format(imsize, phase, 1000 * costs['R{}_{}'.format(resl, phase)][0], bs))
+    return costs
+
+
+def stage_cost(costs, resl, phase, batchsize):
+    # seconds per iteration, scaled to batchsize (None if the stage was not measured).
+    if phase == 'final':
+        phase = 'dstab'             # the last resolution keeps its D fade-in layer at alpha 1.
+    elif phase == 'init' and resl > 2:
+        phase = 'gtrns'             # the grow iteration itself.
+    key = 'R{}_{}'.format(resl, phase)
+    if key not in costs:
+        return None
+    seconds, measured = costs[key]
+    return seconds * batchsize / float(measured)
+
+
+if __name__ == '__main__':
+    from .config import config
+    from .benchmark import print_table
+
+    parser = argparse.ArgumentParser('PGGAN schedule planner')
+    parser.add_argument('--costs', type=str, default='')               # step costs saved with --costs_out.
+    parser.add_argument('--measure', type=bool, default=False)          # time a synthetic train step per stage of this schedule.
+    parser.add_argument('--measure_iters', type=int, default=5)
+    parser.add_argument('--costs_out', type=str, default='')           # save measured costs (json).
+    parser.add_argument('--price_per_hour', type=float, default=0.0)    # machine price, for the cost estimate. (0: off)
+    parser.add_argument('--events', type=bool, default=False)           # also list every grow / flush event.
+    args, _ = parser.parse_known_args()
+    if config.num_threads > 0:
+        import torch
+        torch.set_num_threads(config.num_threads)
+
+    sched = schedule(config)
+    stages = sched.stages()
+    costs = {}
+    if args.costs:
+        with open(args.costs) as f:
+            costs = json.load(f)['costs']
+    if args.measure:
+        resls = sorted(set(s['resl'] for s in stages))
+        costs.update(measure_costs(config, sched.batch_table, resls, list(PHASE_STRUCTURE), args.measure_iters))
+        if args.costs_out:
+            with open(args.costs_out, 'w') as f:
+                json.dump({'nz': config.nz, 'ngf': config.ngf, 'ndf': config.ndf, 'costs': costs}, f, indent=2)
+            print('[schedule] step costs --> {}'.format(args.costs_out))
+
+    rows = []
+    total, known = 0.0, True
+    for s in stages:
+        n = s['iters']
+        per_iter = stage_cost(costs, s['resl'], s['phase'], s['batchsize'])
+        if per_iter is None:
+            known = False
+        else:
+            total = total + n * per_iter
+        rows.append([int(pow(2, s['resl'])), s['phase'], s['start'], n, '{:.1f}'.format(s['images'] / 1000.0), s['batchsize'],
+                     '{:.6f}'.format(s['lr']), '-' if per_iter is None else '{:.1f}'.format(1000 * per_iter),
+                     '-' if per_iter is None else '{:.2f}'.format(n * per_iter / 3600.0)])
+    print_table(['imsize', 'phase', 'first iter', 'iters', 'kimg', 'batch', 'lr', 'ms/iter', 'hours'], rows)
+    if args.events:
+        for it in sorted(sched.events):
+            for event, resl in sched.events[it]:
+                print('[schedule] iter {:8d}  {} ({}px)'.format(it, event, int(pow(2, resl))))
+    print('[schedule] {} iterations, {:.1f} kimg, {} grow / {} flush events'.format(
+        sched.n_iters, sched.at(sched.n_iters)['kimgs'] / 1000.0, sum(e == 'grow' for v in sched.events.values() for e, _ in v),
+        sum(e.startswith('flush') for v in sched.events.values() for e, _ in v)))
+    if len(costs) > 0:
+        print('[schedule] estimated time: {:.1f} hours{}{}'.format(total / 3600.0, '' if known else ' (stages without costs excluded)',
+              ', cost: {:.2f}'.format(total / 3600.0 * args.price_per_hour) if args.price_per_hour > 0 else ''))
@@ -0,0 +1,252 @@
+""" score.py
+scores images with a trained Discriminator (higher: more like the training data), for triaging
+generated or incoming images.
+
+sources (--source): a directory tree of images (any layout), or .npy shards written by rgen.sampling
+(a shard file or a directory of them). images are decoded and resized to the checkpoint's resolution
+by --num_workers DataLoader workers (as the trainer loads them) and scored --batch_size at a time.
+
+minibatch_std_concat_layer makes D's output depend on the rest of the batch. by default (--mbstd frozen)
+its statistic is frozen once from --reference_images real images (--reference, default: the training
+data) in batches of the training batch size at this resolution, so a score depends only on its image,
+not on the batch size or on what else is in the batch. --mbstd batch keeps the batch statistic (as in
+training; scores then change with the batch composition).
+the reference images are scored as well, so thresholds can be given relative to real images:
+--min_ref_pct 5 keeps the images that score at least as high as the 5th percentile of the reference.
+
+output: --out holds the columns key (image path, or shard:row) and score, as .npz or .parquet (needs pyarrow);
+<out>.json holds the settings and the reference score percentiles; with a threshold, the kept keys
+are listed in <out>.kept.txt. --scores re-filters an existing score file without scoring again.
+
+usage:
+    python -m rgen.score --checkpoint repo/model/ckpt_R8_T6000.pth --source repo/samples --out repo/scores/samples.npz --min_ref_pct 5
+    python -m rgen.score --scores repo/scores/samples.npz --min_score 2.5
+"""
+import os
+import json
+import argparse
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader, Subset
+from PIL import Image
+from . import dataloader as DL
+from .custom_layers import minibatch_std_concat_layer
+from .metrics import to_uint8_tensor
+
+
+class image_files(Dataset):
+    # every image under root (sorted walk) --> (uint8 [C, H, W] at imsize, path).
+    def __init__(self, root, imsize):
+        self.imsize = imsize
+        self.loader = DL.draft_loader(imsize)
+        self.paths = []
+        for dirpath, _, fnames in sorted(os.walk(root, followlinks=True)):
+            self.paths += [os.path.join(dirpath, f) for f in sorted(fnames) if f.lower().endswith(DL.IMG_EXTENSIONS)]
+
+    def __getitem__(self, index):
+        img = DL.resize_nearest(self.imsize)(self.loader(self.paths[index]))
+        return to_uint8_tensor()(img), self.paths[index]
+
+    def __len__(self):
+        return len(self.paths)
+
+
+class npy_shards(Dataset):
+    # uint8 [N, H, W, C] shards (rgen.sampling --format npy) --> (uint8 [C, H, W] at imsize, 'shard:row').
+    def __init__(self, paths, imsize):
+        self.imsize = imsize
+        self.paths = paths
+        self.rows = []
+        for k, path in enumerate(paths):
+            n = np.load(path, mmap_mode='r').shape[0]
+            self.rows += [(k, i) for i in range(n)]
+        self.shards = {}            # opened lazily, once per worker.
+
+    def __getitem__(self, index):
+        k, i = self.rows[index]
+        if k not in self.shards:
+            self.shards[k] = np.load(self.paths[k], mmap_mode='r')
+        img = np.ascontiguousarray(self.shards[k][i])
+        if img.shape[0] != self.imsize:
+            img = np.array(DL.resize_nearest(self.imsize)(Image.fromarray(img)))
+        return torch.from_numpy(img).permute(2, 0, 1), '{}:{}'.format(self.paths[k], i)
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def open_source(path, imsize):
+    if path.endswith('.npy'):
+        return npy_shards([path], imsize)
+    shards = sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.npy'))
+    return npy_shards(shards, imsize) if len(shards) > 0 else image_files(path, imsize)
+
+
+def batches(dataset, batch_size, num_workers, pin_memory=False):
+    # yields (float [N, C, H, W] in [-1, 1], keys).
+    for x, keys in DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=pin_memory):
+        yield x.float().mul_(2.0 / 255.0).sub_(1.0), list(keys)
+
+
+class scorer:
+    '''
+    D: Discriminator. freeze(batches) fixes the statistic of every minibatch_std_concat_layer to its
+    mean over the given batches of real images; scores are then independent of batching.
+    '''
+    def __init__(self, D, device='cpu'):
+        self.D = D.eval().to(device)
+        self.device = device
+        self.layers = [m for m in D.modules() if isinstance(m, minibatch_std_concat_layer)]
+
+    def freeze(self, batches):
+        sums = [0.0] * len(self.layers)
+
+        def hook(k):
+            def record(module, inputs):
+                sums[k] = sums[k] + module.statistic(inputs[0]).mean(dim=0, keepdim=True)
+            return record
+        self.unfreeze()
+        handles = [m.register_forward_pre_hook(hook(k)) for k, m in enumerate(self.layers)]
+        n = 0
+        with torch.no_grad():
+            for x in batches:
+                self.D(x.to(self.device))
+                n = n + 1
+        for h in handles:
+            h.remove()
+        if n == 0:
+            raise ValueError('freeze() needs at least one reference batch.')
+        for m, s in zip(self.layers, sums):
+            m.frozen = s / n
+        return n
+
+    def unfreeze(self):
+        for m in self.layers:
+            m.frozen = None
+
+    def __call__(self, x):
+        ''' [N, C, H, W] in [-1, 1] --> [N] float scores (cpu). '''
+        with torch.no_grad():
+            return self.D(x.to(self.device)).view(-1).float().cpu()
+
+
+def write_columns(path, columns):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if path.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        pq.write_table(pa.table({k: pa.array(v) for k, v in columns.items()}), path)
+    else:
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **columns)
+        os.replace(path + '.tmp', path)
+
+
+def read_columns(path):
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        table = pq.read_table(path)
+        return {k: table.column(k).to_numpy() for k in table.column_names}
+    with np.load(path) as f:
+        return {k: f[k] for k in f.files}
+
+
+def threshold(scores, min_score=None, max_score=None):
+    # boolean mask of the scores inside [min_score, max_score] (None: open).
+    keep = np.ones(len(scores), dtype=bool)
+    if min_score is not None:
+        keep &= scores >= min_score
+    if max_score is not None:
+        keep &= scores <= max_score
+    return keep
+
+
+if __name__ == '__main__':
+    import time
+    from math import floor
+    from .config import config
+    from . import checkpoint as CK
+    from .schedule import batch_table
+
+    parser = argparse.ArgumentParser('PGGAN discriminator scores')
+    parser.add_argument('--checkpoint', type=str, default='')           # ckpt_*.pth or dis_*.pth.tar
+    parser.add_argument('--source', type=str, default='')               # image directory, .npy shard or directory of shards.
+    parser.add_argument('--out', type=str, default='repo/scores/scores.npz')     # .npz or .parquet
+    parser.add_argument('--scores', type=str, default='')               # existing score file: only apply the thresholds.
+    parser.add_argument('--mbstd', type=str, default='frozen', choices=['frozen', 'batch'])
+    parser.add_argument('--reference', type=str, default='')            # real images for the frozen statistic and percentiles. ('': train_data_root)
+    parser.add_argument('--reference_images', type=int, default=1024)
+    parser.add_argument('--reference_batch', type=int, default=0)       # (0: the training batch size at this resolution)
+    parser.add_argument('--min_score', type=float, default=None)
+    parser.add_argument('--max_score', type=float, default=None)
+    parser.add_argument('--min_ref_pct', type=float, default=None)      # keep scores >= this percentile of the reference scores.
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    args, _ = parser.parse_known_args()
+
+    if args.scores:
+        # filter only.
+        out = args.scores
+        with open(out + '.json') as f:
+            meta = json.load(f)
+        columns = read_columns(out)
+    else:
+        if not args.checkpoint or not args.source:
+            raise SystemExit('[score] --checkpoint and --source are needed (or --scores to filter an existing file).')
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        D, info = CK.load_model(args.checkpoint, 'dis', config)
+        imsize = int(pow(2, floor(info['resl'])))
+        engine = scorer(D, device)
+        out = args.out
+        meta = {'checkpoint': os.path.abspath(args.checkpoint), 'source': os.path.abspath(args.source), 'imsize': imsize,
+                'mbstd': args.mbstd, 'reference': '', 'reference_images': 0, 'reference_percentiles': None}
+
+        reference = args.reference or config.train_data_root
+        if args.mbstd == 'frozen' or args.min_ref_pct is not None:
+            ref = image_files(reference, imsize)
+            order = torch.randperm(len(ref), generator=torch.Generator().manual_seed(args.seed), device='cpu')
+            ref = Subset(ref, order[:args.reference_images].tolist())
+            ref_batch = args.reference_batch if args.reference_batch > 0 else batch_table(config.batch_table)[imsize]
+            start = time.time()
+            if args.mbstd == 'frozen':
+                # the last reference batch is dropped if it is short: D saw full batches in training.
+                n = engine.freeze(x for x, _ in batches(ref, ref_batch, args.num_workers) if len(x) == ref_batch or len(ref) < ref_batch)
+                print('[score] minibatch std frozen from {} reference batches of {} ({:.1f}s).'.format(n, ref_batch, time.time() - start))
+            ref_scores = np.concatenate([engine(x).numpy() for x, _ in batches(ref, args.batch_size, args.num_workers)])
+            meta['reference'] = os.path.abspath(reference)
+            meta['reference_images'] = len(ref_scores)
+            meta['reference_percentiles'] = [float(v) for v in np.percentile(ref_scores, range(101))]
+            print('[score] reference scores: 5% {:.3f}, median {:.3f}, 95% {:.3f}'.format(*np.percentile(ref_scores, [5, 50, 95])))
+        else:
+            print('[score] --mbstd batch: scores depend on batch size and composition.')
+
+        dataset = open_source(args.source, imsize)
+        print('[score] {} images from {} at {}px.'.format(len(dataset), args.source, imsize))
+        keys, scores = [], []
+        start = time.time()
+        for x, k in batches(dataset, args.batch_size, args.num_workers, pin_memory=device == 'cuda'):
+            scores.append(engine(x).numpy())
+            keys += k
+        elapsed = time.time() - start
+        columns = {'key': np.array(keys), 'score': np.concatenate(scores) if scores else np.zeros(0, np.float32)}
+        write_columns(out, columns)
+        with open(out + '.json', 'w') as f:
+            json.dump(meta, f, indent=2)
+        print('[score] {} images in {:.1f}s ({:.0f} img/s) --> {}'.format(len(keys), elapsed, len(keys) / max(elapsed, 1e-9), out))
+
+    scores = columns['score']
+    if len(scores) > 0:
+        print('[score] scores: min {:.3f}, 5% {:.3f}, median {:.3f}, 95% {:.3f}, max {:.3f}'.format(
+            scores.min(), *np.percentile(scores, [5, 50, 95]), scores.max()))
+    min_score = args.min_score
+    if args.min_ref_pct is not None:
+        if meta['reference_percentiles'] is None:
+            raise SystemExit('[score] --min_ref_pct needs reference scores; score again with --reference.')
+        ref_min = float(np.interp(args.min_ref_pct, range(101), meta['reference_percentiles']))
+        min_score = ref_min if min_score is None else max(min_score, ref_min)
+    if min_score is not None or args.max_score is not None:
+        keep = threshold(scores, min_score, args.max_score)
+        with open(out + '.kept.txt', 'w') as f:
+            f.write(''.join('{}\n'.format(k) for k in columns['key'][keep]))
+        print('[score] kept {}/{} images in [{}, {}] --> {}'.format(int(keep.sum()), len(scores), min_score, args.max_score, out + '.kept.txt'))
@@ -0,0 +1,141 @@
+""" sweep.py
+evaluates every generator checkpoint in a directory with metrics.py, across a process pool.
+  + single-file (ckpt_R*_T*.pth) and legacy (gen_R*_T*.pth.tar) checkpoints are picked up.
+  + real-image statistics are computed once per resolution (in this process) into the shared
+    --eval_cache before any worker starts, so workers only read the cache.
+  + scores are appended to <dir>/scores.tsv as they finish; checkpoints already listed there are
+    skipped, so `--watch` can run next to training and only score new snapshots.
+
+usage: python -m rgen.sweep --dir repo/model --workers 4 --threads 2 --eval_metrics swd --watch 300
+"""
+import os
+import re
+import sys
+import glob
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+PATTERNS = ['ckpt_R*_T*.pth', 'gen_R*_T*.pth.tar']
+COLUMNS = ['checkpoint', 'tick', 'resl', 'phase', 'metric', 'value', 'time']
+
+
+def find_checkpoints(path):
+    # [(fname, resl, tick)] sorted by resolution, then tick.
+    found = []
+    for pattern in PATTERNS:
+        for ckpt_path in glob.glob(os.path.join(path, pattern)):
+            fname = os.path.basename(ckpt_path)
+            match = re.match(r'(?:ckpt|gen)_R(\d+)_T(\d+)', fname)
+            if match:
+                found.append((fname, int(match.group(1)), int(match.group(2))))
+    return sorted(found, key=lambda x: (x[1], x[2], x[0]))
+
+
+def read_scores(path):
+    # rows of a scores.tsv as dicts (empty if it does not exist yet).
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        lines = f.read().splitlines()
+    return [dict(zip(lines[0].split('\t'), line.split('\t'))) for line in lines[1:] if line]
+
+
+def append_scores(path, rows):
+    is_new = not os.path.exists(path)
+    with open(path, 'a') as f:
+        if is_new:
+            f.write('\t'.join(COLUMNS) + '\n')
+        for row in rows:
+            f.write('\t'.join(str(row[k]) for k in COLUMNS) + '\n')
+
+
+# per-worker state; set up once by init_worker().
+worker = {}
+
+
+def init_worker(argv, num_threads):
+    import torch
+    from .config import get_config
+    torch.set_num_threads(num_threads)
+    worker['config'] = get_config(argv)
+    worker['evaluators'] = {}
+
+
+def score_checkpoint(ckpt_path):
+    ''' runs in a pool worker. returns the scores.tsv rows of one checkpoint. '''
+    from math import floor
+    from . import checkpoint as CK
+    from . import metrics
+
+    start = time.time()
+    G, info = CK.load_model(ckpt_path, 'gen', worker['config'])
+    resl = int(floor(info['resl']))
+    if resl not in worker['evaluators']:
+        worker['evaluators'][resl] = metrics.get_evaluator(worker['config'], resl)
+    results = worker['evaluators'][resl].evaluate(G)
+    elapsed = '{:.1f}'.format(time.time() - start)
+    return [{'checkpoint': os.path.basename(ckpt_path), 'tick': info.get('globalTick', ''), 'resl': resl,
+             'phase': info.get('phase', ''), 'metric': k, 'value': '{:.6f}'.format(v), 'time': elapsed}
+            for k, v in results.items()]
+
+
+def print_ranking(rows, rank_by, top):
+    from .benchmark import print_table
+    ranked = sorted((r for r in rows if r['metric'] == rank_by), key=lambda r: float(r['value']))
+    table = [[i + 1, r['tick'], r['resl'], r['phase'], '{:.3f}'.format(float(r['value'])), r['time'] + 's', r['checkpoint']]
+             for i, r in enumerate(ranked[:top])]
+    print_table(['rank', 'tick', 'resl', 'phase', rank_by, 'time', 'checkpoint'], table)
+
+
+def sweep(args, argv, pool):
+    from .config import get_config
+    from . import metrics
+
+    scores_path = os.path.join(args.dir, 'scores.tsv')
+    done = set(r['checkpoint'] for r in read_scores(scores_path))
+    todo = [c for c in find_checkpoints(args.dir) if c[0] not in done]
+    if len(todo) > 0:
+        # fill the shared real-statistics cache once per resolution before dispatching.
+        config = get_config(argv)
+        for resl in sorted(set(r for _, r, _ in todo)):
+            metrics.get_evaluator(config, resl).real_stats()
+
+        futures = {pool.submit(score_checkpoint, os.path.join(args.dir, fname)): fname for fname, _, _ in todo}
+        for future in as_completed(futures):
+            try:
+                rows = future.result()
+            except Exception as e:
+                # e.g. a legacy file still being written; retried on the next scan.
+                print('[sweep] {} failed: {}'.format(futures[future], e))
+                continue
+            append_scores(scores_path, rows)
+            print('[sweep] ' + '  '.join('{}: {}'.format(r['metric'], r['value']) for r in rows) +
+                  '  ({}s) {}'.format(rows[0]['time'], futures[future]))
+    return len(todo)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('PGGAN checkpoint sweep')
+    parser.add_argument('--dir', type=str, default='repo/model')      # directory with the snapshots.
+    parser.add_argument('--workers', type=int, default=2)             # evaluation processes.
+    parser.add_argument('--threads', type=int, default=1)             # torch intra-op threads per worker.
+    parser.add_argument('--rank_by', type=str, default='swd')         # metric the table is sorted by (lower is better).
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--watch', type=int, default=0)               # rescan every specified seconds. (0: scan once)
+    args, _ = parser.parse_known_args()
+    argv = sys.argv[1:]
+
+    # spawn: workers must not inherit torch thread pools from a forked parent.
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=ctx, initializer=init_worker,
+                             initargs=(argv, args.threads)) as pool:
+        while True:
+            n_new = sweep(args, argv, pool)
+            if n_new > 0 or args.watch == 0:
+                print_ranking(read_scores(os.path.join(args.dir, 'scores.tsv')), args.rank_by, args.top)
+            if args.watch == 0:
+                break
+            time.sleep(args.watch)
@@ -0,0 +1,95 @@
+""" test_minibatch_std.py
+minibatch_std_concat_layer against the per-sample reference in benchmark.py.
+
+usage (the package importable as rgen):
+    python -m pytest -q tests
+"""
+import pytest
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from rgen.benchmark import mbstd_reference
+from rgen.custom_layers import minibatch_std_concat_layer
+
+
+MODES = ['all', 'flat', 'spatial', 'none', 'gpool', 'group1', 'group4', 'group64']
+BATCHES = [1, 4, 6, 7, 16]          # 6, 7: not divisible by 4 (groupN falls back to a smaller group).
+
+
+@pytest.mark.parametrize('mode', MODES)
+@pytest.mark.parametrize('batch', BATCHES)
+def test_matches_reference(mode, batch):
+    torch.manual_seed(batch)
+    layer = minibatch_std_concat_layer(mode, num_new_features=2 if 'group' in mode else 1)
+    x = torch.randn(batch, 8, 4, 4, dtype=torch.float64)
+    y = layer(x)
+    assert torch.allclose(y, mbstd_reference(layer, x), rtol=1e-6, atol=1e-6)
+    assert y.size(1) == layer.out_channels(8)
+
+
+@pytest.mark.parametrize('n, batch, expected', [(4, 16, 4), (4, 6, 3), (4, 7, 1), (4, 2, 2), (64, 48, 48), (64, 100, 50), (1, 5, 1)])
+def test_group_size(n, batch, expected):
+    assert minibatch_std_concat_layer('group%d' % n).group_size(batch) == expected
+
+
+def test_group_fallback_uses_full_groups():
+    # batch 6 with group4: groups of 3, samples i and i + 2 share a statistic.
+    layer = minibatch_std_concat_layer('group4')
+    y = layer(torch.randn(6, 4, 2, 2))[:, 4:]
+    assert torch.equal(y[0], y[2]) and torch.equal(y[0], y[4])
+    assert not torch.equal(y[0], y[1])
+
+
+@pytest.mark.parametrize('mode, features, expected', [('all', 1, 17), ('flat', 1, 17), ('spatial', 1, 32), ('none', 1, 32),
+                                                      ('gpool', 1, 32), ('group4', 1, 17), ('group4', 4, 20)])
+def test_out_channels(mode, features, expected):
+    layer = minibatch_std_concat_layer(mode, num_new_features=features)
+    assert layer.out_channels(16) == expected
+    assert layer(torch.randn(8, 16, 4, 4)).size(1) == expected
+
+
+def test_num_new_features_validated():
+    with pytest.raises(AssertionError):
+        minibatch_std_concat_layer('group4', num_new_features=3, channels=16)
+    layer = minibatch_std_concat_layer('group4', num_new_features=3)
+    with pytest.raises(AssertionError):
+        layer.out_channels(16)
+    with pytest.raises(AssertionError):
+        layer(torch.randn(4, 16, 4, 4))
+    minibatch_std_concat_layer('group4', num_new_features=4, channels=16)
+    minibatch_std_concat_layer('all', num_new_features=3, channels=16)       # only groupN splits the channels.
+
+
+def test_frozen_statistic():
+    layer = minibatch_std_concat_layer('group4')
+    layer.frozen = layer.statistic(torch.randn(8, 4, 2, 2)).mean(dim=0, keepdim=True)
+    x = torch.randn(6, 4, 2, 2)
+    assert torch.equal(layer(x)[:3], layer(x[:3])[:3])
+
+
+class device_log(TorchDispatchMode):
+    # devices of every tensor an op produces.
+    def __init__(self):
+        super(device_log, self).__init__()
+        self.devices = set()
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        for t in (out if isinstance(out, (tuple, list)) else [out]):
+            if isinstance(t, torch.Tensor):
+                self.devices.add(t.device.type)
+        return out
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='needs cuda')
+@pytest.mark.parametrize('mode', MODES)
+def test_no_host_sync_on_cuda(mode):
+    layer = minibatch_std_concat_layer(mode)
+    x = torch.randn(6, 8, 4, 4, device='cuda', requires_grad=True)
+    torch.cuda.synchronize()
+    torch.cuda.set_sync_debug_mode('error')
+    try:
+        with device_log() as log:
+            layer(x).sum().backward()
+    finally:
+        torch.cuda.set_sync_debug_mode('default')
+    assert log.devices == {'cuda'}
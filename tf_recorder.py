@@ -1,109 +1,220 @@
-import torch
-import torchvision.utils as vutils
+""" tf_recorder.py
+buffered metrics recorder.
+
+add_* calls only append to an in-memory buffer; a background thread writes the buffer every
+flush_secs seconds, or as soon as it holds flush_items records. if a write fails, the thread stops
+and the exception is raised again by the next put / flush / close on the caller's thread.
+  + tensorboard events (if tensorboardX is installed).
+  + a columnar scalar log in <run>/scalars/: raw step / value / time / tag-id columns plus tags.txt,
+    appended on every flush. read_scalars() loads it back.
+the buffer is bounded by max_items: when it is full, pending images and histograms are dropped
+first, then pending scalars are downsampled (every other value of each tag is kept).
+"""
+import os
+import re
+import json
+import time
+import threading
 import numpy as np
-import torchvision.models as models
-import utils as utils
-from torchvision import datasets
-from tensorboardX import SummaryWriter
-import os, sys
-import utils as utils
+import torch
+from . import utils as utils
+
+
+def make_run_dir(root, prefix='try_'):
+    # allocates <root>/<prefix><n> with n one above the largest existing run. mkdir is atomic,
+    # so concurrent runs never share a directory.
+    os.makedirs(root, exist_ok=True)
+    ids = [int(n[len(prefix):]) for n in os.listdir(root) if re.match(re.escape(prefix) + r'\d+$', n)]
+    i = max(ids) + 1 if ids else 0
+    while True:
+        path = os.path.join(root, '{}{}'.format(prefix, i))
+        try:
+            os.mkdir(path)
+            return path
+        except FileExistsError:
+            i = i + 1
+
+
+COLUMNS = [('step', np.int64), ('value', np.float64), ('time', np.float64), ('tag', np.int32)]
+
+
+class scalar_log:
+    ''' append-only columnar scalar log: one raw file per column plus tags.txt (line n = tag id n). '''
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.tags = {}
+        self.files = {name: open(os.path.join(path, name), 'ab') for name, _ in COLUMNS}
+        self.tag_file = open(os.path.join(path, 'tags.txt'), 'a')
+
+    def append(self, rows):
+        # rows: [(tag, step, value, walltime)]
+        if len(rows) == 0:
+            return
+        ids = []
+        for tag, _, _, _ in rows:
+            if tag not in self.tags:
+                self.tags[tag] = len(self.tags)
+                self.tag_file.write(tag + '\n')
+            ids.append(self.tags[tag])
+        self.tag_file.flush()
+        columns = {'step': [r[1] for r in rows], 'value': [r[2] for r in rows], 'time': [r[3] for r in rows], 'tag': ids}
+        for name, dtype in COLUMNS:
+            np.asarray(columns[name], dtype=dtype).tofile(self.files[name])
+            self.files[name].flush()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.tag_file.close()
+
+
+def read_scalars(path):
+    ''' {tag: {'step', 'value', 'time'}} from a scalar_log directory (e.g. repo/tensorboard/try_3/scalars). '''
+    with open(os.path.join(path, 'tags.txt')) as f:
+        tags = f.read().splitlines()
+    cols = {name: np.fromfile(os.path.join(path, name), dtype=dtype) for name, dtype in COLUMNS}
+    n = min(len(c) for c in cols.values())          # a flush may have been cut short.
+    out = {}
+    for i, tag in enumerate(tags):
+        mask = cols['tag'][:n] == i
+        out[tag] = {name: cols[name][:n][mask] for name in ['step', 'value', 'time']}
+    return out
 
 
 class tf_recorder:
-    def __init__(self):
-        utils.mkdir('repo/tensorboard')
-        
-        for i in range(1000):
-            self.targ = 'repo/tensorboard/try_{}'.format(i)
-            if not os.path.exists(self.targ):
+    def __init__(self, root='repo/tensorboard', flush_secs=10.0, flush_items=1000, max_items=20000, use_tensorboard=True):
+        self.targ = make_run_dir(root)
+        self.flush_secs = flush_secs
+        self.flush_items = flush_items
+        self.max_items = max_items
+        self.n_dropped = 0              # images / histograms dropped under pressure.
+        self.n_downsampled = 0          # scalars dropped under pressure.
+
+        self.writer = None
+        if use_tensorboard:
+            try:
+                from tensorboardX import SummaryWriter      # optional; without it only the scalar log is written.
                 self.writer = SummaryWriter(self.targ)
-                break
-                
+            except ImportError:
+                print('[tf_recorder] tensorboardX is not installed; writing the scalar log only.')
+        self.scalars = scalar_log(os.path.join(self.targ, 'scalars'))
+
+        self.buffer = []
+        self.lock = threading.Lock()            # guards self.buffer.
+        self.write_lock = threading.Lock()      # one writer at a time (background thread or flush()).
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.error = None               # exception that stopped the writer thread.
+        self.thread = threading.Thread(target=self.run, name='tf_recorder', daemon=True)
+        self.thread.start()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, record):
+        self.check()
+        with self.lock:
+            self.buffer.append(record)
+            if len(self.buffer) > self.max_items:
+                self.shed()
+            n = len(self.buffer)
+        if n >= self.flush_items:
+            self.wakeup.set()
+
+    def shed(self):
+        # called with self.lock held.
+        scalars = [r for r in self.buffer if r[0] == 'scalar']
+        self.n_dropped = self.n_dropped + len(self.buffer) - len(scalars)
+        if len(scalars) > self.max_items // 2:
+            seen = {}
+            kept = []
+            for r in scalars:
+                seen[r[1]] = seen.get(r[1], -1) + 1
+                if seen[r[1]] % 2 == 0:
+                    kept.append(r)
+            self.n_downsampled = self.n_downsampled + len(scalars) - len(kept)
+            scalars = kept
+        self.buffer = scalars
+
     def add_scalar(self, index, val, niter):
-        self.writer.add_scalar(index, val, niter)
+        # val may be a tensor; it is converted on the writer thread.
+        self.put(('scalar', index, val.detach() if torch.is_tensor(val) else val, niter, time.time()))
 
     def add_scalars(self, index, group_dict, niter):
-        self.writer.add_scalar(index, group_dict, niter)
+        for k, v in group_dict.items():
+            self.add_scalar('{}/{}'.format(index, k), v, niter)
+
+    def add_histogram(self, index, x, niter):
+        self.put(('histogram', index, x.detach().cpu().clone() if torch.is_tensor(x) else np.array(x), niter, time.time()))
 
     def add_image_grid(self, index, ngrid, x, niter):
-        grid = utils.make_image_grid(x, ngrid)
-        self.writer.add_image(index, grid, niter)
+        self.put(('image_grid', index, (ngrid, x.detach().cpu().clone()), niter, time.time()))
 
     def add_image_single(self, index, x, niter):
-        self.writer.add_image(index, x, niter)
+        self.put(('image', index, x.detach().cpu().clone(), niter, time.time()))
 
     def add_graph(self, index, x_input, model):
-        torch.onnx.export(model, x_input, os.path.join(self.targ, "{}.proto".format(index)), verbose=True)
-        self.writer.add_graph_onnx(os.path.join(self.targ, "{}.proto".format(index)))
+        # written right away (rare); tensorboard only.
+        if self.writer is not None:
+            self.writer.add_graph(model, x_input)
+
+    def write_pending(self):
+        with self.write_lock:
+            with self.lock:
+                records, self.buffer = self.buffer, []
+            rows = []
+            for kind, index, val, niter, walltime in records:
+                if kind == 'scalar':
+                    val = float(val)
+                    rows.append((index, niter, val, walltime))
+                    if self.writer is not None:
+                        self.writer.add_scalar(index, val, niter, walltime=walltime)
+                elif self.writer is None:
+                    continue
+                elif kind == 'histogram':
+                    self.writer.add_histogram(index, val.numpy() if torch.is_tensor(val) else val, niter, walltime=walltime)
+                elif kind == 'image_grid':
+                    self.writer.add_image(index, utils.make_image_grid(val[1], val[0]), niter, walltime=walltime)
+                else:
+                    self.writer.add_image(index, val, niter, walltime=walltime)
+            self.scalars.append(rows)
+            if self.writer is not None:
+                self.writer.flush()
+
+    def run(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_secs)
+            self.wakeup.clear()
+            try:
+                self.write_pending()
+            except Exception as e:
+                print('[tf_recorder] writer thread stopped: {!r}'.format(e))
+                self.error = e
+                return
+
+    def flush(self):
+        self.check()
+        self.write_pending()
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        try:
+            if self.error is None:
+                self.write_pending()
+        finally:
+            self.scalars.close()
+            if self.writer is not None:
+                self.writer.close()
+        self.check()
 
     def export_json(self, out_file):
-        self.writer.export_scalars_to_json(out_file)
-
-
-
-
-
-
-
-
-'''
-resnet18 = models.resnet18(False)
-writer = SummaryWriter()
-for n_iter in range(100):
-    s1 = torch.rand(1) # value to keep
-    s2 = torch.rand(1)
-    writer.add_scalar('data/scalar1', s1[0], n_iter) #data grouping by `slash`
-    writer.add_scalar('data/scalar2', s2[0], n_iter)
-    writer.add_scalars('data/scalar_group', {"xsinx":n_iter*np.sin(n_iter),
-                                             "xcosx":n_iter*np.cos(n_iter),
-                                             "arctanx": np.arctan(n_iter)}, n_iter)
-dataset = datasets.MNIST('mnist', train=False, download=True)
-images = dataset.test_data[:100].float()
-label = dataset.test_labels[:100]
-features = images.view(100, 784)
-writer.add_embedding(features, metadata=label, label_img=images.unsqueeze(1))
-
-# export scalar data to JSON for external processing
-writer.export_scalars_to_json("./all_scalars.json")
-writer.close()
-'''
-
-
-
-'''
-resnet18 = models.resnet18(False)
-writer = SummaryWriter()
-sample_rate = 44100
-freqs = [262, 294, 330, 349, 392, 440, 440, 440, 440, 440, 440]
-
-for n_iter in range(100):
-    s1 = torch.rand(1) # value to keep
-    s2 = torch.rand(1)
-    writer.add_scalar('data/scalar1', s1[0], n_iter) #data grouping by `slash`
-    writer.add_scalar('data/scalar2', s2[0], n_iter)
-    writer.add_scalars('data/scalar_group', {"xsinx":n_iter*np.sin(n_iter),
-                                             "xcosx":n_iter*np.cos(n_iter),
-                                             "arctanx": np.arctan(n_iter)}, n_iter)
-    x = torch.rand(32, 3, 64, 64) # output from network
-    if n_iter%10==0:
-        x = vutils.make_grid(x, normalize=True, scale_each=True)
-        writer.add_image('Image', x, n_iter)
-        x = torch.zeros(sample_rate*2)
-        for i in range(x.size(0)):
-            x[i] = np.cos(freqs[n_iter//10]*np.pi*float(i)/float(sample_rate)) # sound amplitude should in [-1, 1]
-        writer.add_text('Text', 'text logged at step:'+str(n_iter), n_iter)
-        for name, param in resnet18.named_parameters():
-            writer.add_histogram(name, param.clone().cpu().data.numpy(), n_iter)
-        writer.add_pr_curve('xoxo', np.random.randint(2, size=100), np.random.rand(100), n_iter) #needs tensorboard 0.4RC or later
-dataset = datasets.MNIST('mnist', train=False, download=True)
-images = dataset.test_data[:100].float()
-label = dataset.test_labels[:100]
-features = images.view(100, 784)
-writer.add_embedding(features, metadata=label, label_img=images.unsqueeze(1))
-
-# export scalar data to JSON for external processing
-writer.export_scalars_to_json("./all_scalars.json")
-
-writer.close()
-'''
-
+        # {tag: [[walltime, step, value], ...]}, the layout tensorboard's scalar export uses.
+        self.flush()
+        scalars = read_scalars(self.scalars.path)
+        out = {tag: [[float(t), int(s), float(v)] for s, v, t in zip(c['step'], c['value'], c['time'])] for tag, c in scalars.items()}
+        with open(out_file, 'w') as f:
+            json.dump(out, f)
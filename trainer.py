@@ -1,21 +1,20 @@
-from torchvision.transforms import InterpolationMode
-
 from rgen import DEFAULT_CONFIG_PATH, PROJECT_ROOT
 from . import dataloader as DL
 from .config import config
 from . import network as net
-from math import floor, ceil
-from datetime import datetime
-import os, sys
-import re
+from . import checkpoint as CK
+from . import schedule as SC
+from . import augment as AU
+from math import floor
+import os
 # os.environ["CUDA_VISIBLE_DEVICES"] = "0,1,2,3"
 
 import torch
-import torchvision.transforms as transforms
+import torch.nn.functional as F
 from torch.autograd import Variable
 from torch.optim import Adam
 from tqdm import tqdm
-# import tf_recorder as tensorboard
+from . import tf_recorder as tensorboard
 from . import utils as utils
 import numpy as np
 
@@ -56,9 +55,51 @@ class trainer:
         self.flag_add_noise = self.config.flag_add_noise
         self.flag_add_drift = self.config.flag_add_drift
 
+        # the whole resolution schedule (see schedule.py).
+        self.schedule = SC.schedule(config)
+        print('[*] schedule: {} iterations, {:.1f} kimg.'.format(self.schedule.n_iters, self.schedule.at(self.schedule.n_iters)['kimgs'] / 1000.0))
+
+        # resume from a single-file checkpoint (see checkpoint.py).
+        # the networks are then built directly at the checkpoint's structure without init.
+        ckpt = None
+        if config.resume_training:
+            resume_path = PROJECT_ROOT.joinpath(config.resume_training)
+            ckpt = CK.load_checkpoint(resume_path)
+            self.G = net.Generator(config, resl=floor(ckpt['resl']), fadein=ckpt['flush']['gen'], init=False)
+            self.D = net.Discriminator(config, resl=floor(ckpt['resl']), fadein=ckpt['flush']['dis'], init=False)
+            self.G.load_state_dict(ckpt['gen']['state_dict'])
+            self.D.load_state_dict(ckpt['dis']['state_dict'])
+            if ckpt['gen']['scales'] is not None:
+                net.set_equalized_scales(self.G, ckpt['gen']['scales'])
+            if ckpt['dis']['scales'] is not None:
+                net.set_equalized_scales(self.D, ckpt['dis']['scales'])
+            self.resl = ckpt['resl']
+            self.lr = ckpt['learning_rate']
+            self.globalTick = ckpt['globalTick']
+            self.globalIter = ckpt['globalIter']
+            self.phase = ckpt['phase']
+            self.stack = ckpt['stack']
+            self.epoch = ckpt['epoch']
+            self.kimgs = ckpt['kimgs']
+            self.complete['dis'] = ckpt['complete']['dis']
+            self.complete['gen'] = ckpt['complete']['gen']
+            self.flag_flush_dis = ckpt['flush']['dis']
+            self.flag_flush_gen = ckpt['flush']['gen']
+            if self.flag_flush_gen:
+                self.fadein['gen'] = self.G.model.fadein_block
+                self.fadein['gen'].alpha = self.complete['gen'] / 100.0
+            if self.flag_flush_dis:
+                self.fadein['dis'] = self.D.model.fadein_block
+                self.fadein['dis'].alpha = self.complete['dis'] / 100.0
+            state = self.schedule.at(self.globalIter)
+            if (floor(state['resl']), state['alpha_gen'] is not None, state['alpha_dis'] is not None) != \
+                    (floor(self.resl), self.flag_flush_gen, self.flag_flush_dis):
+                raise ValueError('checkpoint does not match the schedule at iteration {} (trns_tick, stab_tick, TICK, max_resl or batch_table changed?).'.format(self.globalIter))
+        else:
+            self.G = net.Generator(config)
+            self.D = net.Discriminator(config)
+
         # network and cirterion
-        self.G = net.Generator(config)
-        self.D = net.Discriminator(config)
         print('Generator structure: ')
         print(self.G.model)
         print('Discriminator structure: ')
@@ -76,58 +117,52 @@ class trainer:
                     gpus.append(i)
                 self.G = torch.nn.DataParallel(self.G, device_ids=gpus).cuda()
                 self.D = torch.nn.DataParallel(self.D, device_ids=gpus).cuda()
+        else:
+            # without GPUs DataParallel just calls the module, and self.G.module stays valid.
+            self.G = torch.nn.DataParallel(self.G)
+            self.D = torch.nn.DataParallel(self.D)
 
-        # Load discriminator & generator checkpoints
-        if config.resume_training_D and config.resume_training_G:
-            resume_training = True
-        resume_path_D = PROJECT_ROOT.joinpath(config.resume_training_D)
-        resume_path_G = PROJECT_ROOT.joinpath(config.resume_training_G)
-        if resume_training and os.path.exists(resume_path_D) and os.path.exists(resume_path_G):
-            D_checkpoint = torch.load(resume_path_D)
-            G_checkpoint = torch.load(resume_path_G)
-            # Grow network according to checkpoint resl
-            new_resl = D_checkpoint['resl']
-            for resl in range(3, floor(new_resl) + 1):
-                self.lr = self.lr * float(self.config.lr_decay)
-                self.G.module.flush_network()
-                self.D.module.flush_network()
-                self.G.module.grow_network(resl)
-                self.D.module.grow_network(resl)
-            self.resl = new_resl
+        # batched augmentation of the D inputs (see augment.py).
+        self.augment = AU.get_augment(config)
+
+        # replay pool of generated samples for extra / mixed D updates (see replay.py).
+        self.replay = None
+        if config.replay_size > 0:
+            from .replay import replay_pool
+            self.replay = replay_pool(config.replay_size, config.replay_max_age, config.random_seed)
 
         # define tensors, ship model to cuda, and get dataloader.
         self.renew_everything()
-
-        # tensorboard
-        self.use_tb = False
-        '''if self.use_tb:
-            self.tb = tensorboard.tf_recorder()'''
-
-        self.lr = D_checkpoint['learning_rate']
-
-        # Load checkpoint
-        if resume_training and os.path.exists(resume_path_D) and os.path.exists(resume_path_G):
-            self.opt_d.load_state_dict(D_checkpoint['optimizer'])
-            if not len(D_checkpoint['state_dict']) == len(self.D.module.state_dict()):
-                self.D.module.flush_network()
-            self.D.module.load_state_dict(D_checkpoint['state_dict'])
-            self.opt_g.load_state_dict(G_checkpoint['optimizer'])
-            if not len(G_checkpoint['state_dict']) == len(self.G.module.state_dict()):
-                self.G.module.flush_network()
-            self.G.module.load_state_dict(G_checkpoint['state_dict'])
-            # match = re.search(r"R\d_T(\d*).pth.tar", "pggan/repo/model/dis_R6_T2400.pth.tar")
-            # self.globalTick = int(match(1))
-            self.globalTick = D_checkpoint['globalTick']
-            self.globalIter = D_checkpoint['globalIter']
-            self.phase = D_checkpoint['phase']
-            self.stack = D_checkpoint['stack']
-            self.epoch = D_checkpoint['epoch']
-            self.complete['dis'] = D_checkpoint['complete']
-            self.complete['gen'] = G_checkpoint['complete']
-            self.flag_flush_dis = D_checkpoint['flush']
-            self.flag_flush_gen = G_checkpoint['flush']
-
-            self.renew_everything()
+        if ckpt is not None:
+            if 'augment' in ckpt:
+                self.augment.load_state_dict(ckpt['augment'])
+            if 'data' in ckpt:
+                self.loader.load_state_dict(ckpt['data'])
+            else:
+                self.loader.seek(self.epoch * len(self.loader.dataset) + self.stack)     # older checkpoints.
+            if ckpt['opt_g'] is not None:
+                CK.load_optimizer_state_dict(self.opt_g, self.G.module, ckpt['opt_g'])
+            if ckpt['opt_d'] is not None:
+                CK.load_optimizer_state_dict(self.opt_d, self.D.module, ckpt['opt_d'])
+        self.ckpt_writer = CK.checkpoint_writer(delta=config.ckpt_delta)
+        self.evaluators = {}        # resl --> metrics.evaluator (real statistics are loaded once per resolution).
+
+        # tensorboard (buffered; written from a background thread).
+        self.use_tb = config.use_tb
+        if self.use_tb:
+            self.tb = tensorboard.tf_recorder(os.path.join(config.out_dir, 'tensorboard'))
+
+        # memory report (see memory.py).
+        self.mem = None
+        if config.mem_track_every > 0:
+            from . import memory
+            self.mem = memory.memory_tracker(os.path.join(config.out_dir, 'memory.json'), config.mem_track_every, config.mem_growth_window)
+
+        # per-module latency (see profiler.py).
+        self.prof = None
+        if config.profile_iters > 0:
+            from . import profiler
+            self.prof = profiler.stage_profiler(os.path.join(config.out_dir, 'profile'), config.profile_iters, config.profile_warmup, self.use_cuda)
 
     def resl_scheduler(self):
         '''
@@ -137,85 +172,51 @@ class trainer:
         step 2. (stab_tick) --> stabilize.
         step 3. (trns_tick) --> transition in discriminator.
         step 4. (stab_tick) --> stabilize.
+        the whole run is precomputed (see schedule.py); this applies the events and state of self.globalIter.
         '''
-        if floor(self.resl) != 2:
-            self.trns_tick = self.config.trns_tick
-            self.stab_tick = self.config.stab_tick
-
-        self.batchsize = self.loader.batchsize
-        delta = 1.0 / (2 * self.trns_tick + 2 * self.stab_tick)
-        d_alpha = 1.0 * self.batchsize / self.trns_tick / self.TICK
-
-        # update alpha if fade-in layer exist.
-        if self.fadein['gen'] is not None:
-            if self.resl % 1.0 < (self.trns_tick) * delta:
-                self.fadein['gen'].update_alpha(d_alpha)
-                self.complete['gen'] = self.fadein['gen'].alpha * 100
-                self.phase = 'gtrns'
-            elif self.resl % 1.0 >= (self.trns_tick) * delta and self.resl % 1.0 < (
-                    self.trns_tick + self.stab_tick) * delta:
-                self.phase = 'gstab'
-        if self.fadein['dis'] is not None:
-            if self.resl % 1.0 >= (self.trns_tick + self.stab_tick) * delta and self.resl % 1.0 < (
-                    self.stab_tick + self.trns_tick * 2) * delta:
-                self.fadein['dis'].update_alpha(d_alpha)
-                self.complete['dis'] = self.fadein['dis'].alpha * 100
-                self.phase = 'dtrns'
-            elif self.resl % 1.0 >= (self.stab_tick + self.trns_tick * 2) * delta and self.phase != 'final':
-                self.phase = 'dstab'
-
-        prev_kimgs = self.kimgs
-        self.kimgs = self.kimgs + self.batchsize
-        if (self.kimgs % self.TICK) < (prev_kimgs % self.TICK):
-            self.globalTick = self.globalTick + 1
-            # increase linearly every tick, and grow network structure.
-            prev_resl = floor(self.resl)
-            self.resl = self.resl + delta
-            self.resl = max(2, min(10.5, self.resl))  # clamping, range: 4 ~ 1024
-
-            # flush network.
-            if self.flag_flush_gen and self.resl % 1.0 >= (self.trns_tick + self.stab_tick) * delta and prev_resl != 2:
-                if self.fadein['gen'] is not None:
-                    self.fadein['gen'].update_alpha(d_alpha)
-                    self.complete['gen'] = self.fadein['gen'].alpha * 100
-                self.flag_flush_gen = False
+        state = self.schedule.at(self.globalIter)
+        self.resl = state['resl']
+        self.lr = state['lr']
+        self.globalTick = state['tick']
+        self.kimgs = state['kimgs']
+        self.phase = state['phase']
+
+        for event, resl in self.schedule.events.get(self.globalIter, []):
+            if event == 'flush_gen':
                 self.G.module.flush_network()  # flush G
                 print(self.G.module.model)
                 # self.Gs.module.flush_network()         # flush Gs
                 self.fadein['gen'] = None
-                self.complete['gen'] = 0.0
-                self.phase = 'dtrns'
-            elif self.flag_flush_dis and floor(self.resl) != prev_resl and prev_resl != 2:
-                if self.fadein['dis'] is not None:
-                    self.fadein['dis'].update_alpha(d_alpha)
-                    self.complete['dis'] = self.fadein['dis'].alpha * 100
-                self.flag_flush_dis = False
+            elif event == 'flush_dis':
                 self.D.module.flush_network()  # flush and,
                 print(self.D.module.model)
                 self.fadein['dis'] = None
-                self.complete['dis'] = 0.0
-                if floor(self.resl) < self.max_resl and self.phase != 'final':
-                    self.phase = 'gtrns'
-
-            # grow network.
-            if floor(self.resl) != prev_resl and floor(self.resl) < self.max_resl + 1:
-                self.lr = self.lr * float(self.config.lr_decay)
-                self.G.module.grow_network(floor(self.resl))
-                # self.Gs.grow_network(floor(self.resl))
-                self.D.module.grow_network(floor(self.resl))
+            elif event == 'grow':
+                self.G.module.grow_network(resl)
+                # self.Gs.grow_network(resl)
+                self.D.module.grow_network(resl)
                 self.renew_everything()
+                if self.replay is not None:
+                    self.replay.clear()         # stored fakes have the old image size.
                 self.fadein['gen'] = dict(self.G.module.model.named_children())['fadein_block']
                 self.fadein['dis'] = dict(self.D.module.model.named_children())['fadein_block']
-                self.flag_flush_gen = True
-                self.flag_flush_dis = True
 
-            if floor(self.resl) >= self.max_resl and self.resl % 1.0 >= (self.stab_tick + self.trns_tick * 2) * delta:
-                self.phase = 'final'
-                self.resl = self.max_resl + (self.stab_tick + self.trns_tick * 2) * delta
+        # update alpha if fade-in layer exist.
+        for key in ['gen', 'dis']:
+            alpha = state['alpha_' + key]
+            if self.fadein[key] is not None:
+                self.fadein[key].alpha = alpha
+            self.complete[key] = 0.0 if alpha is None else alpha * 100
+        self.flag_flush_gen = state['alpha_gen'] is not None
+        self.flag_flush_dis = state['alpha_dis'] is not None
+        self.batchsize = self.loader.batchsize
 
     def renew_everything(self):
-        # renew dataloader.
-        self.loader = DL.dataloader(config)
+        # renew dataloader. the data stream continues where the previous loader stopped.
+        data_state = self.loader.state_dict() if hasattr(self, 'loader') else None
+        self.loader = DL.dataloader(self.config)
+        if data_state is not None:
+            self.loader.load_state_dict(data_state)
         self.loader.renew(min(floor(self.resl), self.max_resl))
 
         # define tensors
@@ -232,7 +233,7 @@ class trainer:
             self.x_tilde = self.x.cuda()
             self.real_label = self.real_label.cuda()
             self.fake_label = self.fake_label.cuda()
-            torch.cuda.manual_seed(config.random_seed)
+            torch.cuda.manual_seed(self.config.random_seed)
 
         # wrapping autograd Variable.
         self.x = Variable(self.x)
@@ -255,24 +256,14 @@ class trainer:
                               weight_decay=0.0)
 
     def feed_interpolated_input(self, x):
-        if self.phase == 'gtrns' and floor(self.resl) > 2 and floor(self.resl) <= self.max_resl:
-            alpha = self.complete['gen'] / 100.0
-            transform = transforms.Compose([transforms.ToPILImage(),
-                                            transforms.Resize(size=int(pow(2, floor(self.resl) - 1)),
-                                                              interpolation=InterpolationMode.NEAREST),
-                                            transforms.Resize(size=int(pow(2, floor(self.resl))),
-                                                              interpolation=InterpolationMode.NEAREST),
-                                            transforms.ToTensor(),
-                                            ])
-            x_low = x.clone().add(1).mul(0.5)
-            for i in range(x_low.size(0)):
-                x_low[i] = transform(x_low[i]).mul(2).add(-1)
-            x = torch.add(x.mul(alpha), x_low.mul(1 - alpha))  # interpolated_x
-
-        if self.use_cuda:
-            return x.cuda()
-        else:
-            return x
+        # x is a uint8 batch from the loader ring; scaling to [-1, 1] is folded into the device copy.
+        x = DL.to_device_batch(x, 'cuda' if self.use_cuda else 'cpu')
+        alpha = self.complete['gen'] / 100.0
+        if self.phase == 'gtrns' and floor(self.resl) > 2 and floor(self.resl) <= self.max_resl and alpha < 1.0:
+            # nearest down/up-sampling by 2 for the whole batch (same pixels PIL NEAREST picks).
+            x_low = F.interpolate(x[:, :, 1::2, 1::2], scale_factor=2, mode='nearest')
+            x = torch.lerp(x_low, x, alpha)  # interpolated_x
+        return x
 
     def add_noise(self, x):
         # TODO: support more method of adding noise.
@@ -288,6 +279,33 @@ class trainer:
         z = Variable(torch.from_numpy(z)).cuda() if self.use_cuda else Variable(torch.from_numpy(z))
         return x + z
 
+    def critic_step(self):
+        '''
+        one extra D update on a new real batch. the fakes are drawn from the replay pool,
+        or generated again (without a graph) when there is no pool.
+        '''
+        it, imsize = self.globalIter, self.loader.imsize
+        x = self.feed_interpolated_input(self.loader.get_batch())
+        self.epoch, self.stack = divmod(self.loader.position, len(self.loader.dataset))
+        if self.flag_add_noise:
+            x = self.add_noise(x)
+        fake = None
+        if self.replay is not None:
+            fake = self.replay.draw(self.loader.batchsize, it, floor(self.resl), self.phase)
+        if fake is None:
+            with torch.no_grad():
+                fake = self.G(torch.randn(self.loader.batchsize, self.nz, device=self.z.device))
+        if self.augment.active(imsize):
+            x = self.augment(x, it)
+            fake = self.augment(fake, it)
+
+        self.D.zero_grad()
+        loss_d = self.mse(self.D(x).squeeze(), self.real_label) + \
+                 self.mse(self.D(fake), self.fake_label)
+        loss_d.backward()
+        self.opt_d.step()
+        return loss_d
+
     def train(self):
         # noise for test.
         self.z_test = torch.FloatTensor(16, self.nz)
@@ -296,78 +314,139 @@ class trainer:
         self.z_test = Variable(self.z_test, volatile=True)
         self.z_test.data.resize_(16, self.nz).normal_(0.0, 1.0)
 
-        for step in range(2, self.max_resl + 1 + 5):
-            for iter in tqdm(range(0, (self.trns_tick * 2 + self.stab_tick * 2) * self.TICK, self.loader.batchsize)):
-                self.globalIter = self.globalIter + 1
-                self.stack = self.stack + self.loader.batchsize
-                if self.stack > ceil(len(self.loader.dataset)):
-                    self.epoch = self.epoch + 1
-                    self.stack = int(self.stack % (ceil(len(self.loader.dataset))))
-
-                # reslolution scheduler.
-                self.resl_scheduler()
-
-                # zero gradients.
-                self.G.zero_grad()
-                self.D.zero_grad()
-
-                # update discriminator.
-                self.x.data = self.feed_interpolated_input(self.loader.get_batch())
-                if self.flag_add_noise:
-                    self.x = self.add_noise(self.x)
-                self.z.data.resize_(self.loader.batchsize, self.nz).normal_(0.0, 1.0)
-                self.x_tilde = self.G(self.z)
-
-                self.fx = self.D(self.x)
-                self.fx_tilde = self.D(self.x_tilde.detach())
-
-                loss_d = self.mse(self.fx.squeeze(), self.real_label) + \
-                         self.mse(self.fx_tilde, self.fake_label)
-                loss_d.backward()
-                self.opt_d.step()
-
-                # update generator.
-                fx_tilde = self.D(self.x_tilde)
-                loss_g = self.mse(fx_tilde.squeeze(), self.real_label.detach())
-                loss_g.backward()
-                self.opt_g.step()
-
-                # logging.
-                log_msg = ' [E:{0}][T:{1}][{2:6}/{3:6}]  errD: {4:.4f} | errG: {5:.4f} | [lr:{11:.5f}][cur:{6:.3f}][resl:{7:4}][{8}][{9:.1f}%][{10:.1f}%]'.format(
-                    self.epoch, self.globalTick, self.stack, len(self.loader.dataset), loss_d.item(), loss_g.item(),
-                    self.resl, int(pow(2, floor(self.resl))), self.phase, self.complete['gen'], self.complete['dis'],
-                    self.lr)
-                tqdm.write(log_msg)
-
-                # save model.
-                self.snapshot('repo/model')
-
-                # save image grid.
-                if self.globalIter % self.config.save_img_every == 0:
-                    with torch.no_grad():
-                        x_test = self.G(self.z_test)
-                    utils.mkdir('repo/save/grid')
-                    utils.save_image_grid(x_test.data, 'repo/save/grid/{0}_{1}_G{2:.2f}_D{3:.2f}.jpg'.format(
-                        int(self.globalIter / self.config.save_img_every), self.phase, self.complete['gen'],
-                        self.complete['dis']))
-                    utils.mkdir('repo/save/resl_{}'.format(int(floor(self.resl))))
-                    utils.save_image_single(x_test.data, 'repo/save/resl_{0}/{1}_{2}_G{3:.2f}_D{4:.2f}.jpg'.format(
-                        int(floor(self.resl)), int(self.globalIter / self.config.save_img_every), self.phase,
-                        self.complete['gen'], self.complete['dis']))
-
-                # tensorboard visualization.
+        for iter in tqdm(range(self.globalIter, self.schedule.n_iters), initial=self.globalIter, total=self.schedule.n_iters):
+            self.globalIter = self.globalIter + 1
+            # reslolution scheduler.
+            prev_tick = self.globalTick
+            self.resl_scheduler()
+            if self.prof is not None:
+                self.prof.begin(self)
+
+            # zero gradients.
+            self.G.zero_grad()
+            self.D.zero_grad()
+
+            # update discriminator.
+            self.x.data = self.feed_interpolated_input(self.loader.get_batch())
+            self.epoch, self.stack = divmod(self.loader.position, len(self.loader.dataset))
+            if self.flag_add_noise:
+                self.x = self.add_noise(self.x)
+            self.z.data.resize_(self.loader.batchsize, self.nz).normal_(0.0, 1.0)
+            self.x_tilde = self.G(self.z)
+            x_tilde = self.x_tilde
+            transform = None
+            if self.augment.active(self.loader.imsize):
+                # reals and fakes go through the same (differentiable) augmentations.
+                self.x = self.augment(self.x, self.globalIter)
+                x_tilde = self.augment(self.x_tilde, self.globalIter)
+                transform = lambda y: self.augment(y, self.globalIter)
+            fake = x_tilde.detach()
+            if self.replay is not None and self.config.replay_mix > 0:
+                fake = self.replay.mix(fake, self.config.replay_mix, self.globalIter, floor(self.resl), self.phase, transform)
+
+            self.fx = self.D(self.x)
+            self.fx_tilde = self.D(fake)
+
+            loss_d = self.mse(self.fx.squeeze(), self.real_label) + \
+                     self.mse(self.fx_tilde, self.fake_label)
+            loss_d.backward()
+            self.opt_d.step()
+            self.augment.update(self.fx, self.loader.batchsize)
+            if self.replay is not None:
+                self.replay.push(self.x_tilde.detach(), self.globalIter, floor(self.resl), self.phase)
+            # extra critic updates; loss_d stays the main update on this iteration's fakes.
+            critic_losses = [self.critic_step().detach() for _ in range(self.config.n_critic - 1)]
+
+            # update generator.
+            fx_tilde = self.D(x_tilde)
+            loss_g = self.mse(fx_tilde.squeeze(), self.real_label.detach())
+            loss_g.backward()
+            self.opt_g.step()
+
+            # logging.
+            log_msg = ' [E:{0}][T:{1}][{2:6}/{3:6}]  errD: {4:.4f} | errG: {5:.4f} | [lr:{11:.5f}][cur:{6:.3f}][resl:{7:4}][{8}][{9:.1f}%][{10:.1f}%]'.format(
+                self.epoch, self.globalTick, self.stack, len(self.loader.dataset), loss_d.item(), loss_g.item(),
+                self.resl, int(pow(2, floor(self.resl))), self.phase, self.complete['gen'], self.complete['dis'],
+                self.lr)
+            tqdm.write(log_msg)
+
+            # save model.
+            self.snapshot(os.path.join(self.config.out_dir, 'model'))
+
+            # evaluate at tick boundaries.
+            if self.config.eval_every_tick > 0 and self.globalTick != prev_tick and self.globalTick % self.config.eval_every_tick == 0:
+                self.evaluate(os.path.join(self.config.out_dir, 'eval'))
+
+            # save image grid.
+            if self.globalIter % self.config.save_img_every == 0:
+                with torch.no_grad():
+                    x_test = self.G(self.z_test)
+                save_dir = os.path.join(self.config.out_dir, 'save')
+                utils.mkdir(os.path.join(save_dir, 'grid'))
+                utils.save_image_grid(x_test.data, os.path.join(save_dir, 'grid', '{0}_{1}_G{2:.2f}_D{3:.2f}.jpg'.format(
+                    int(self.globalIter / self.config.save_img_every), self.phase, self.complete['gen'],
+                    self.complete['dis'])))
+                resl_dir = os.path.join(save_dir, 'resl_{}'.format(int(floor(self.resl))))
+                utils.mkdir(resl_dir)
+                utils.save_image_single(x_test.data, os.path.join(resl_dir, '{0}_{1}_G{2:.2f}_D{3:.2f}.jpg'.format(
+                    int(self.globalIter / self.config.save_img_every), self.phase,
+                    self.complete['gen'], self.complete['dis'])))
                 if self.use_tb:
-                    with torch.no_grad():
-                        x_test = self.G(self.z_test)
-                    self.tb.add_scalar('data/loss_g', loss_g[0].item(), self.globalIter)
-                    self.tb.add_scalar('data/loss_d', loss_d[0].item(), self.globalIter)
-                    self.tb.add_scalar('tick/lr', self.lr, self.globalIter)
-                    self.tb.add_scalar('tick/cur_resl', int(pow(2, floor(self.resl))), self.globalIter)
-                    '''IMAGE GRID
                     self.tb.add_image_grid('grid/x_test', 4, utils.adjust_dyn_range(x_test.data.float(), [-1,1], [0,1]), self.globalIter)
                     self.tb.add_image_grid('grid/x_tilde', 4, utils.adjust_dyn_range(self.x_tilde.data.float(), [-1,1], [0,1]), self.globalIter)
                     self.tb.add_image_grid('grid/x_intp', 4, utils.adjust_dyn_range(self.x.data.float(), [-1,1], [0,1]), self.globalIter)
-                    '''
+
+            # tensorboard visualization.
+            if self.use_tb and self.globalIter % self.config.display_tb_every == 0:
+                self.tb.add_scalar('data/loss_g', loss_g, self.globalIter)
+                self.tb.add_scalar('data/loss_d', loss_d, self.globalIter)
+                if len(critic_losses) > 0:
+                    self.tb.add_scalar('data/loss_d_critic', torch.stack(critic_losses).mean(), self.globalIter)
+                self.tb.add_scalar('tick/lr', self.lr, self.globalIter)
+                self.tb.add_scalar('tick/cur_resl', int(pow(2, floor(self.resl))), self.globalIter)
+                self.tb.add_scalars('tick/complete', self.complete, self.globalIter)
+                if self.replay is not None:
+                    stats = self.replay.stats(floor(self.resl), self.phase)
+                    if stats is not None:
+                        self.tb.add_scalar('data/replay_mean_age', stats['mean_age'], self.globalIter)
+                        self.tb.add_scalar('data/replay_other_phase', stats['other_phase'], self.globalIter)
+                if self.augment.ada_target > 0:
+                    self.tb.add_scalar('data/augment_p', self.augment.p, self.globalIter)
+                    if self.augment.rt is not None:
+                        self.tb.add_scalar('data/ada_rt', self.augment.rt, self.globalIter)
+
+            if self.prof is not None:
+                self.prof.end(self)
+            if self.mem is not None:
+                self.mem.step(self)
+
+        if self.use_tb:
+            self.tb.close()
+        if self.mem is not None:
+            self.mem.close()
+        if self.prof is not None:
+            self.prof.close()
+
+    def evaluate(self, path):
+        # sample-quality metrics of G at the current resolution, appended to <path>/metrics.tsv.
+        from . import metrics
+        resl = min(floor(self.resl), self.max_resl)
+        if resl not in self.evaluators:
+            self.evaluators[resl] = metrics.get_evaluator(self.config, resl, device='cuda' if self.use_cuda else 'cpu')
+        results = self.evaluators[resl].evaluate(self.G.module)
+        tqdm.write(' [eval][T:{}][resl:{}][{}]  '.format(self.globalTick, int(pow(2, resl)), self.phase) +
+                   '  '.join('{}: {:.3f}'.format(k, v) for k, v in results.items()))
+        if self.use_tb:
+            self.tb.add_scalars('eval', results, self.globalTick)
+        utils.mkdir(path)
+        log_path = os.path.join(path, 'metrics.tsv')
+        is_new = not os.path.exists(log_path)
+        with open(log_path, 'a') as f:
+            if is_new:
+                f.write('\t'.join(['globalTick', 'kimgs', 'resl', 'phase', 'metric', 'value']) + '\n')
+            for k, v in results.items():
+                f.write('{}\t{}\t{}\t{}\t{}\t{:.6f}\n'.format(self.globalTick, self.kimgs, resl, self.phase, k, v))
+        return results
 
     def get_state(self, target):
         if target == 'gen':
@@ -403,11 +482,9 @@ class trainer:
             }
             return state
         else:
+            # everything in one place; written by checkpoint.checkpoint_writer.
             state = {
                 'resl': self.resl,
-                'state_dict_D': self.D.module.state_dict(),
-                'state_dict_G': self.G.module.state_dict(),
-                'optimizer': self.opt_d.state_dict(),
                 'epoch': self.epoch,
                 'globalTick': self.globalTick,
                 'globalIter': self.globalIter,
@@ -415,33 +492,27 @@ class trainer:
                 'learning_rate': self.lr,
                 'phase': self.phase,
                 'kimgs': self.kimgs,
-                'complete_D': self.complete['dis'],
-                'complete_G': self.complete['gen'],
-                'flush': self.flag_flush_dis
+                'complete': {'gen': self.complete['gen'], 'dis': self.complete['dis']},
+                'flush': {'gen': self.flag_flush_gen, 'dis': self.flag_flush_dis},
+                'data': self.loader.state_dict(),
+                'augment': self.augment.state_dict(),
+                'gen': {'state_dict': self.G.module.state_dict(), 'scales': net.get_equalized_scales(self.G.module)},
+                'dis': {'state_dict': self.D.module.state_dict(), 'scales': net.get_equalized_scales(self.D.module)},
+                'opt_g': CK.optimizer_state_dict(self.opt_g, self.G.module),
+                'opt_d': CK.optimizer_state_dict(self.opt_d, self.D.module)
             }
             return state
 
-
     def snapshot(self, path):
-        if not os.path.exists(path):
-            if os.name == 'nt':
-                os.system('mkdir {}'.format(path.replace('/', '\\')))
-            else:
-                os.system('mkdir -p {}'.format(path))
-        # save every 100 tick if the network is in stab phase.
-        curr_time = datetime.now()
-        ndis = 'dis_R{}_T{}_{}.pth.tar'.format(int(floor(self.resl)), self.globalTick, str(curr_time))
-        ngen = 'gen_R{}_T{}_{}.pth.tar'.format(int(floor(self.resl)), self.globalTick, str(curr_time))
+        utils.mkdir(path)
+        # save every 50 tick if the network is in stab phase.
+        nckpt = 'ckpt_R{}_T{}.pth'.format(int(floor(self.resl)), self.globalTick)
         if self.globalTick % 50 == 0:
             if self.phase == 'gstab' or self.phase == 'dstab' or self.phase == 'final':
-                save_path = os.path.join(path, ndis)
+                save_path = os.path.join(path, nckpt)
                 if not os.path.exists(save_path):
-                    # Discriminator checkpoint
-                    torch.save(self.get_state('dis'), save_path)
-                    # Generator checkpoint
-                    save_path = os.path.join(path, ngen)  # update save path
-                    torch.save(self.get_state('gen'), save_path)
-                    print('[snapshot] model saved @ {}'.format(path))
+                    nref = self.ckpt_writer.save(save_path, self.get_state('all'))
+                    print('[snapshot] model saved @ {} ({} unchanged tensors referenced)'.format(save_path, nref))
 
 
 if __name__ == '__main__':
@@ -451,6 +522,8 @@ if __name__ == '__main__':
         print('  {}: {}'.format(k, v))
     print('-------------------------------------------------')
     torch.backends.cudnn.benchmark = True  # boost speed.
+    if config.num_threads > 0:
+        torch.set_num_threads(config.num_threads)
     trainer = trainer(config)
     trainer.train()
 
@@ -0,0 +1,202 @@
+""" tune.py
+runs many training configurations side by side on one machine.
+
+every configuration is a separate trainer process (config is parsed per process, so runs never share
+state) with its own --out_dir (<out_dir>/<run>/{model,eval,save,tensorboard}) and log.txt.
+  + --jobs processes run at once; each gets --threads torch/OpenMP threads and is pinned to its own
+    --threads cores (sched_setaffinity), so runs do not fight over cores.
+  + configurations: the cartesian product of --grid ('lr=0.001,0.002;eps_drift=0.001,0.01') and the
+    lines of --configs (one line of trainer arguments per configuration).
+    arguments tune.py does not know are passed to every run (e.g. --max_resl 5 --eval_every_tick 5).
+  + finished runs (<run>/status.json) are skipped when the sweep is started again.
+  + summary.tsv collects status, time, the last eval metrics (eval/metrics.tsv) and the final losses
+    (tensorboard scalar log) of every run.
+
+usage: python -m rgen.tune --out_dir repo/tune --jobs 4 --threads 8 --grid 'lr=0.001,0.003;flag_fused=True,False' --max_resl 5 --eval_every_tick 10
+"""
+import os
+import re
+import sys
+import json
+import glob
+import time
+import shlex
+import argparse
+import itertools
+import subprocess
+
+
+SUMMARY_COLUMNS = ['run', 'status', 'seconds', 'args', 'tick', 'kimgs', 'loss_g', 'loss_d']
+
+
+def parse_grid(spec):
+    # 'lr=0.001,0.002;flag_fused=True,False' --> [[('lr', '0.001'), ('lr', '0.002')], [('flag_fused', 'True'), ...]]
+    axes = []
+    for item in spec.split(';'):
+        if item.strip():
+            key, values = item.split('=', 1)
+            axes.append([(key.strip().lstrip('-'), v.strip()) for v in values.split(',')])
+    return axes
+
+
+def bool_options():
+    # options declared with type=bool, where argparse treats any non-empty string as True.
+    from .config import parser
+    return set(a.dest for a in parser._actions if a.type is bool)
+
+
+def to_argv(pairs):
+    flags = bool_options()
+    argv = []
+    for key, value in pairs:
+        if key in flags and value.lower() in ['false', '0', 'no', 'off']:
+            value = ''
+        argv += ['--' + key, value]
+    return argv
+
+
+def make_runs(grid, config_lines):
+    ''' [(name, argv)] for every combination of a --configs line and a --grid point. '''
+    lines = config_lines if len(config_lines) > 0 else ['']
+    runs = []
+    for line, point in itertools.product(lines, itertools.product(*parse_grid(grid))):
+        argv = shlex.split(line) + to_argv(point)
+        label = '_'.join('{}{}'.format(k, v) for k, v in point) or re.sub(r'[\s-]+', '_', line.strip()).strip('_') or 'base'
+        name = 'r{:03d}_{}'.format(len(runs), re.sub(r'[^\w.=-]', '', label))[:80]
+        runs.append((name, argv))
+    return runs
+
+
+def core_slots(jobs, threads):
+    # disjoint core sets, one per concurrent run; None where the platform cannot pin.
+    if not hasattr(os, 'sched_setaffinity'):
+        return [None] * jobs
+    cores = sorted(os.sched_getaffinity(0))
+    if jobs * threads > len(cores):
+        print('[tune] {} jobs x {} threads > {} cores; core sets overlap.'.format(jobs, threads, len(cores)))
+    return [[cores[(i * threads + k) % len(cores)] for k in range(threads)] for i in range(jobs)]
+
+
+def launch(name, argv, run_dir, threads, cores):
+    os.makedirs(run_dir, exist_ok=True)
+    cmd = [sys.executable, '-m', '{}.trainer'.format(__package__)] + argv + \
+          ['--out_dir', run_dir, '--num_threads', str(threads)]
+    with open(os.path.join(run_dir, 'cmd.txt'), 'w') as f:
+        f.write(' '.join(shlex.quote(c) for c in cmd) + '\n')
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads))
+    log = open(os.path.join(run_dir, 'log.txt'), 'ab')
+    preexec = (lambda: os.sched_setaffinity(0, cores)) if cores is not None else None
+    proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env, preexec_fn=preexec)
+    log.close()
+    return proc
+
+
+def read_status(run_dir):
+    path = os.path.join(run_dir, 'status.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_status(run_dir, status):
+    with open(os.path.join(run_dir, 'status.json.tmp'), 'w') as f:
+        json.dump(status, f, indent=2)
+    os.replace(os.path.join(run_dir, 'status.json.tmp'), os.path.join(run_dir, 'status.json'))
+
+
+def run_metrics(run_dir):
+    ''' last eval value per metric, the last tick / kimgs, and final losses (mean of the last 10 logged values). '''
+    from .sweep import read_scores
+    from .tf_recorder import read_scalars
+    out = {}
+    rows = read_scores(os.path.join(run_dir, 'eval', 'metrics.tsv'))
+    for r in rows:
+        out[r['metric']] = float(r['value'])
+        out['tick'], out['kimgs'] = r['globalTick'], r['kimgs']
+    logs = sorted(glob.glob(os.path.join(run_dir, 'tensorboard', 'try_*', 'scalars')), key=os.path.getmtime)
+    if len(logs) > 0 and os.path.exists(os.path.join(logs[-1], 'tags.txt')):
+        scalars = read_scalars(logs[-1])
+        for key, tag in [('loss_g', 'data/loss_g'), ('loss_d', 'data/loss_d')]:
+            if tag in scalars and len(scalars[tag]['value']) > 0:
+                out[key] = float(scalars[tag]['value'][-10:].mean())
+    return out
+
+
+def summarize(out_dir, runs, rank_by, started):
+    from .benchmark import print_table
+    rows = []
+    for name, argv in runs:
+        run_dir = os.path.join(out_dir, name)
+        status = read_status(run_dir) or {'status': 'running' if name in started else 'pending', 'seconds': ''}
+        row = dict(run=name, status=status['status'], seconds=status['seconds'], args=' '.join(shlex.quote(a) for a in argv))
+        row.update(run_metrics(run_dir))
+        rows.append(row)
+    metric_names = sorted(set(k for r in rows for k in r) - set(SUMMARY_COLUMNS))
+    columns = SUMMARY_COLUMNS + metric_names
+    with open(os.path.join(out_dir, 'summary.tsv'), 'w') as f:
+        f.write('\t'.join(columns) + '\n')
+        for r in rows:
+            f.write('\t'.join(str(r.get(k, '')) for k in columns) + '\n')
+
+    fmt = lambda v: '{:.4f}'.format(v) if isinstance(v, float) else str(v)
+    rows = sorted(rows, key=lambda r: (rank_by not in r, r.get(rank_by, 0.0)))
+    print_table(['run', 'status', 'seconds', 'tick'] + metric_names + ['loss_g', 'loss_d'],
+                [[r['run'], r['status'], r['seconds'], r.get('tick', '')] + [fmt(r.get(k, '')) for k in metric_names + ['loss_g', 'loss_d']]
+                 for r in rows])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('PGGAN multi-config training')
+    parser.add_argument('--out_dir', type=str, default='repo/tune')     # one subdirectory per run, plus summary.tsv.
+    parser.add_argument('--grid', type=str, default='')                 # 'key=v1,v2;key=v1,v2' (cartesian product).
+    parser.add_argument('--configs', type=str, default='')              # file with one line of trainer arguments per run.
+    parser.add_argument('--jobs', type=int, default=2)                  # concurrent trainer processes.
+    parser.add_argument('--threads', type=int, default=4)               # threads (and pinned cores) per trainer.
+    parser.add_argument('--rank_by', type=str, default='swd')           # summary is sorted by this metric (lower is better).
+    parser.add_argument('--poll', type=float, default=5.0)              # seconds between process checks.
+    parser.add_argument('--dry_run', type=bool, default=False)          # print the runs and exit.
+    args, base_argv = parser.parse_known_args()
+
+    config_lines = []
+    if args.configs:
+        with open(args.configs) as f:
+            config_lines = [l for l in f.read().splitlines() if l.strip() and not l.strip().startswith('#')]
+    runs = [(name, base_argv + argv) for name, argv in make_runs(args.grid, config_lines)]
+    os.makedirs(args.out_dir, exist_ok=True)
+    for name, argv in runs:
+        print('[tune] {}: {}'.format(name, ' '.join(argv)))
+    if args.dry_run:
+        raise SystemExit(0)
+
+    todo = [(name, argv) for name, argv in runs if (read_status(os.path.join(args.out_dir, name)) or {}).get('status') != 'ok']
+    print('[tune] {} runs ({} already finished), {} at a time.'.format(len(runs), len(runs) - len(todo), args.jobs))
+    slots = core_slots(args.jobs, args.threads)
+    active = {}         # slot --> (name, proc, start time)
+    started = set()
+    try:
+        while len(todo) > 0 or len(active) > 0:
+            for slot in [s for s in range(args.jobs) if s not in active]:
+                if len(todo) == 0:
+                    break
+                name, argv = todo.pop(0)
+                active[slot] = (name, launch(name, argv, os.path.join(args.out_dir, name), args.threads, slots[slot]), time.time())
+                started.add(name)
+                print('[tune] start {} (cores {})'.format(name, slots[slot]))
+            time.sleep(args.poll)
+            for slot, (name, proc, start) in list(active.items()):
+                code = proc.poll()
+                if code is None:
+                    continue
+                seconds = int(time.time() - start)
+                write_status(os.path.join(args.out_dir, name), {'status': 'ok' if code == 0 else 'failed({})'.format(code), 'seconds': seconds})
+                print('[tune] {} {} after {}s'.format(name, 'finished' if code == 0 else 'failed ({})'.format(code), seconds))
+                del active[slot]
+    except KeyboardInterrupt:
+        for name, proc, _ in active.values():
+            proc.terminate()
+        for name, proc, _ in active.values():
+            proc.wait()
+            write_status(os.path.join(args.out_dir, name), {'status': 'interrupted', 'seconds': ''})
+    summarize(args.out_dir, runs, args.rank_by, started)
+    print('[tune] summary --> {}'.format(os.path.join(args.out_dir, 'summary.tsv')))
@@ -3,10 +3,6 @@
 
 import os
 import torch
-import numpy as np
-import torchvision
-import torchvision.transforms as transforms
-import torchvision.utils as vutils
 import time
 
 
@@ -19,6 +15,7 @@ def adjust_dyn_range(x, drange_in, drange_out):
 
 
 def resize(x, size):
+    import torchvision.transforms as transforms
     transform = transforms.Compose([
         transforms.ToPILImage(),
         transforms.Scale(size),
@@ -79,10 +76,8 @@ def make_summary(writer, key, value, step):
 
 
 def mkdir(path):
-    if os.name == 'nt':
-        os.system('mkdir {}'.format(path.replace('/', '\\')))
-    else:
-        os.system('mkdir -p {}'.format(path))
+    # no shell: output paths may contain spaces (e.g. a sweep run directory).
+    os.makedirs(path, exist_ok=True)
 
 
 import torch
@@ -0,0 +1,251 @@
+""" video.py
+renders latent walks of a trained Generator as video.
+
+  + keyframes: slerp between seeded keyframe latents (optionally eased, optionally closed into a loop).
+  + loop: a closed noise loop, z(t) = (c + r * (a cos(2 pi t) + b sin(2 pi t))) / sqrt(1 + r^2), which
+    keeps z ~ N(0, I) for every frame and returns to the first frame exactly.
+every latent is a function of the frame index, so only the frames in flight are held in memory.
+a producer thread generates frames in batches into a bounded queue while the main thread hands them
+to the encoder: an ffmpeg subprocess (raw rgb24 on stdin) for video files, or an image sequence
+written by a thread pool.
+
+usage:
+    python -m rgen.video --checkpoint repo/model/ckpt_R8_T6000.pth --mode keyframes --n_keys 8 --frames_per_key 90 --out repo/video/walk.mp4
+    python -m rgen.video --checkpoint repo/model/ckpt_R8_T6000.pth --mode loop --n_frames 600 --radius 0.5 --out repo/video/frames --frame_format jpg
+"""
+import os
+import time
+import queue
+import shutil
+import argparse
+import threading
+import subprocess
+import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from .sampling import latent_sampler, to_uint8, write_images
+
+
+VIDEO_EXTS = ['.mp4', '.mkv', '.mov', '.webm', '.avi', '.gif']
+
+
+def slerp(a, b, t):
+    # a, b [N, nz], t [N, 1]. falls back to lerp for (nearly) parallel endpoints.
+    cos = (a * b).sum(dim=1, keepdim=True) / (a.norm(dim=1, keepdim=True) * b.norm(dim=1, keepdim=True))
+    omega = torch.acos(cos.clamp(-1.0, 1.0))
+    so = torch.sin(omega)
+    lerp = a * (1.0 - t) + b * t
+    safe = so.clamp(min=1e-6)
+    return torch.where(so > 1e-6, a * (torch.sin((1.0 - t) * omega) / safe) + b * (torch.sin(t * omega) / safe), lerp)
+
+
+def normalize(z):
+    # pixelwise normalization of the generator's first block (--norm_latent).
+    return z / torch.sqrt(torch.mean(z ** 2, dim=1, keepdim=True) + 1e-8)
+
+
+class keyframe_path:
+    '''
+    frames_per_key frames between consecutive keyframes (sample indices of latent_sampler).
+    loop: the last keyframe runs back into the first. ease: smoothstep timing, so the walk slows down at keyframes.
+    '''
+    def __init__(self, sampler, keys, frames_per_key, loop=False, ease=True, norm_latent=False):
+        self.z = sampler(keys)
+        self.frames_per_key = frames_per_key
+        self.loop = loop
+        self.ease = ease
+        self.norm_latent = norm_latent
+        self.n_frames = frames_per_key * len(keys) if loop else frames_per_key * (len(keys) - 1) + 1
+
+    def __call__(self, frames):
+        frames = torch.tensor(frames, dtype=torch.int64)
+        seg = torch.div(frames, self.frames_per_key, rounding_mode='floor')
+        t = (frames - seg * self.frames_per_key).float().div(self.frames_per_key).unsqueeze(1)
+        last = seg >= len(self.z) - 1
+        if not self.loop:           # the final frame is the last keyframe itself.
+            t[last] = 1.0
+            seg[last] = len(self.z) - 2
+        if self.ease:
+            t = t * t * (3.0 - 2.0 * t)
+        z = slerp(self.z[seg], self.z[(seg + 1) % len(self.z)], t)
+        return normalize(z) if self.norm_latent else z
+
+
+class noise_loop:
+    ''' closed loop of n_frames latents around a seeded center; radius sets how far the loop wanders. '''
+    def __init__(self, sampler, n_frames, radius=1.0, norm_latent=False):
+        self.c, self.a, self.b = sampler([0, 1, 2])
+        self.n_frames = n_frames
+        self.radius = radius
+        self.norm_latent = norm_latent
+
+    def __call__(self, frames):
+        theta = torch.tensor(frames, dtype=torch.float64).mul(2 * np.pi / self.n_frames).unsqueeze(1)
+        z = self.c + self.radius * (self.a * torch.cos(theta).float() + self.b * torch.sin(theta).float())
+        z = z / np.sqrt(1.0 + self.radius ** 2)
+        return normalize(z) if self.norm_latent else z
+
+
+class ffmpeg_writer:
+    ''' pipes raw rgb24 frames into an ffmpeg subprocess. '''
+    def __init__(self, path, fps, codec='libx264', crf=18):
+        if shutil.which('ffmpeg') is None:
+            raise RuntimeError('ffmpeg was not found on PATH; write an image sequence instead (--out <dir>).')
+        self.path = path
+        self.fps = fps
+        self.codec = codec
+        self.crf = crf
+        self.proc = None
+
+    def start(self, h, w):
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '{}x{}'.format(w, h),
+               '-r', str(self.fps), '-i', '-']
+        if not self.path.endswith('.gif'):
+            cmd += ['-c:v', self.codec, '-pix_fmt', 'yuv420p']
+            if self.codec.startswith('libx26'):
+                cmd += ['-crf', str(self.crf)]
+        self.proc = subprocess.Popen(cmd + [self.path], stdin=subprocess.PIPE)
+
+    def write(self, frames, images):
+        if self.proc is None:
+            self.start(images.shape[1], images.shape[2])
+        if images.shape[3] == 1:
+            images = np.repeat(images, 3, axis=3)
+        try:
+            self.proc.stdin.write(np.ascontiguousarray(images).tobytes())
+        except BrokenPipeError:
+            raise RuntimeError('ffmpeg exited early (code {}).'.format(self.proc.wait()))
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.stdin.close()
+            if self.proc.wait() != 0:
+                raise RuntimeError('ffmpeg failed with code {}.'.format(self.proc.returncode))
+
+
+class sequence_writer:
+    ''' numbered image files written by a thread pool; at most max_pending batches are queued. '''
+    def __init__(self, path, fmt='png', n_threads=4, max_pending=8):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.fmt = fmt
+        self.max_pending = max_pending
+        self.pool = ThreadPoolExecutor(max_workers=n_threads)
+        self.pending = []
+
+    def write(self, frames, images):
+        self.pending.append(self.pool.submit(write_images, images, frames, self.path, self.fmt))
+        while len(self.pending) > self.max_pending:
+            self.pending.pop(0).result()
+
+    def close(self):
+        for f in self.pending:
+            f.result()
+        self.pool.shutdown()
+
+
+def render(G, path, writer, batch_size=16, queue_size=4, log_every=10):
+    '''
+    generates path.n_frames frames in a producer thread and feeds them to writer in order.
+    returns {'frames', 'seconds', 'fps', 'generate', 'write'} (generate / write: busy seconds of each side).
+    '''
+    device = next(G.parameters()).device
+    q = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    busy = {'generate': 0.0, 'write': 0.0}
+
+    def produce():
+        try:
+            for start in range(0, path.n_frames, batch_size):
+                if stop.is_set():
+                    return
+                t = time.time()
+                frames = list(range(start, min(start + batch_size, path.n_frames)))
+                with torch.no_grad():
+                    images = to_uint8(G(path(frames).to(device)))
+                busy['generate'] = busy['generate'] + time.time() - t
+                q.put((frames, images))
+            q.put(None)
+        except BaseException as e:
+            q.put(e)
+
+    start = time.time()
+    producer = threading.Thread(target=produce, name='video_producer', daemon=True)
+    producer.start()
+    n = 0
+    try:
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            t = time.time()
+            writer.write(*item)
+            busy['write'] = busy['write'] + time.time() - t
+            n = n + len(item[0])
+            if log_every > 0 and (n // batch_size) % log_every == 0:
+                print('[video] {}/{} frames, {:.1f} frames/s'.format(n, path.n_frames, n / (time.time() - start)))
+        writer.close()
+    finally:
+        stop.set()
+        while producer.is_alive():          # unblock a producer waiting on a full queue.
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                producer.join(0.1)
+    elapsed = time.time() - start
+    return {'frames': n, 'seconds': elapsed, 'fps': n / elapsed, 'generate': busy['generate'], 'write': busy['write']}
+
+
+if __name__ == '__main__':
+    from .config import config
+    from . import checkpoint as CK
+
+    parser = argparse.ArgumentParser('PGGAN latent walk video')
+    parser.add_argument('--checkpoint', type=str, required=True)        # gen_*.pth.tar or ckpt_*.pth
+    parser.add_argument('--out', type=str, default='repo/video/walk.mp4')   # video file (.mp4, .mkv, .webm, .gif ...) or a directory for an image sequence.
+    parser.add_argument('--mode', type=str, default='keyframes', choices=['keyframes', 'loop'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keys', type=str, default='')                # keyframe sample indices, e.g. '3,17,42'. (default: 0 .. n_keys-1)
+    parser.add_argument('--n_keys', type=int, default=8)
+    parser.add_argument('--frames_per_key', type=int, default=60)
+    parser.add_argument('--close', type=bool, default=False)            # keyframes: return to the first keyframe.
+    parser.add_argument('--ease', type=bool, default=True)              # keyframes: slow down at keyframes.
+    parser.add_argument('--n_frames', type=int, default=600)            # loop: frames per loop.
+    parser.add_argument('--radius', type=float, default=1.0)            # loop: size of the loop around its center.
+    parser.add_argument('--truncation', type=float, default=0.0)        # resample |z| > truncation for keyframes / loop basis. (0: off)
+    parser.add_argument('--norm_latent', type=bool, default=False)
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--codec', type=str, default='libx264')
+    parser.add_argument('--crf', type=int, default=18)
+    parser.add_argument('--frame_format', type=str, default='png', choices=['png', 'jpg'])     # image sequence format.
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--queue', type=int, default=4)                 # generated batches waiting for the encoder.
+    parser.add_argument('--num_threads', type=int, default=0)           # torch intra-op threads. (0: default)
+    parser.add_argument('--io_threads', type=int, default=4)            # image sequence encoding threads.
+    args, _ = parser.parse_known_args()
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    G, info = CK.load_model(args.checkpoint, 'gen', config)
+    G.eval()
+    sampler = latent_sampler(config.nz, args.seed, args.truncation)
+    if args.mode == 'keyframes':
+        keys = [int(k) for k in args.keys.split(',')] if args.keys else list(range(args.n_keys))
+        if len(keys) < 2:
+            raise SystemExit('[video] a keyframe walk needs at least two keys.')
+        path = keyframe_path(sampler, keys, args.frames_per_key, args.close, args.ease, args.norm_latent)
+    else:
+        path = noise_loop(sampler, args.n_frames, args.radius, norm_latent=args.norm_latent)
+
+    if os.path.splitext(args.out)[1].lower() in VIDEO_EXTS:
+        if os.path.dirname(args.out):
+            os.makedirs(os.path.dirname(args.out), exist_ok=True)
+        writer = ffmpeg_writer(args.out, args.fps, args.codec, args.crf)
+    else:
+        writer = sequence_writer(args.out, args.frame_format, args.io_threads, max_pending=args.queue)
+    print('[video] {} frames ({:.1f}s at {} fps) --> {}'.format(path.n_frames, path.n_frames / float(args.fps), args.fps, args.out))
+    stats = render(G, path, writer, args.batch_size, args.queue)
+    print('[video] {} frames in {:.1f}s: {:.1f} frames/s (generate {:.1f}s, encode {:.1f}s)'.format(
+        stats['frames'], stats['seconds'], stats['fps'], stats['generate'], stats['write']))